@@ -1,23 +1,43 @@
 from datetime import timedelta, date, datetime
 from typing import Annotated
 from data import get_session
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
 from datetime import datetime, timedelta
-from model import User, AppUsage, Timesheet,Attendance, Screenshots, Projects, Applications, ProjectEmployee
+from model import User, AppUsage, Timesheet,Attendance, Screenshots, Projects, Applications, ProjectEmployee, AttendanceStatus, ApplicationStatus, ProjectStatus
 from auth.jwt_hasher import create_access_token, hash_password, get_current_user, bearer_scheme, check_hashed_password
 from sqlmodel import Session, select
 
-from sqlmodel import SQLModel, delete
+from sqlmodel import SQLModel, delete, func
 from typing import Optional, List
-from fastapi.responses import FileResponse
+from collections import Counter
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse
+from pathlib import Path
 from schema import CreateProject, UserInvite, UpdateUser, ApplicationRview
 from bg_tasks import send_invitation_email_task
-from auth.jwt_hasher import create_invite_token
+from auth.jwt_hasher import create_invite_token, revoke_user_tokens
+from auth.principal_cache import principal_cache
+from redis.asyncio import Redis
+from usage_queue import queue_lag
+from sockets.ws import notify
+from utils import build_invite_link
+from screenshots import screenshot_key, media_type, release_blob
+from storage import storage
+from http_cache import conditional_file
+from pagination import PageParams, paginate
+from exports import export_rows
 
 router = APIRouter(
     tags=['Admin']
 )
 
+r = Redis(
+    host="localhost",
+    port=6379,
+    db=0,
+    decode_responses=True
+)
+
 @router.post("/invite_users")
 async def invite_employee(
     user: UserInvite,
@@ -33,17 +53,21 @@ async def invite_employee(
     )
     invite_link = build_invite_link(token)
     send_invitation_email_task.delay(user.email, invite_link)
-    connection = active_connections.get(current_user.email)
-    if connection:
-        await connection.send_text("Invitation sent")
+    await notify(current_user.email, "Invitation sent")
 
     return {"detail": "Invitation queued"}
 
 @router.get('/get_all_employees')
-def view_all_employees( session:Session = Depends(get_session),
+def view_all_employees( response : Response,
+                    is_active : Optional[bool] = None,
+                    page : PageParams = Depends(),
+                    session:Session = Depends(get_session),
                     current_user : User = Depends(get_current_user("admin"))):
 
-    employees = session.exec(select(User).where(User.role == "employee")).all()   
+    query = select(User).where(User.role == "employee")
+    if is_active is not None:
+        query = query.where(User.is_active == is_active)
+    employees = paginate(session, query, User.id, response, page, descending=False)
     
     if employees is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
@@ -53,18 +77,43 @@ def view_all_employees( session:Session = Depends(get_session),
     
 # Get Activity    
 @router.get('/get_user_activity')
-def view_user_activity( employee_id : int ,session:Session = Depends(get_session),
+def view_user_activity( employee_id : int, response : Response,
+                    start_date : Optional[date] = None,
+                    end_date : Optional[date] = None,
+                    page : PageParams = Depends(),
+                    session:Session = Depends(get_session),
                     current_user : User = Depends(get_current_user("admin"))):
-
-    find_user(employee_id)
-    get_activity = session.exec(select(AppUsage).where(
-        AppUsage.employee_id == employee_id, AppUsage.role == "employee")).all() 
+    """An employee's app usage, newest first, one page at a time"""
+    find_user(session, employee_id)
+    query = select(AppUsage).where(
+        AppUsage.employee_id == employee_id, AppUsage.role == "employee")
+    if start_date:
+        query = query.where(AppUsage.timestamp >= datetime.combine(start_date, datetime.min.time()))
+    if end_date:
+        query = query.where(AppUsage.timestamp < datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
+    get_activity = paginate(session, query, AppUsage.id, response, page)
        
     if get_activity is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail = f"No activity found")
     return get_activity    
 
+# Ingestion lag of the background drain worker
+@router.get('/ingestion_lag')
+async def ingestion_lag(current_user : User = Depends(get_current_user("admin"))):
+    """Queue length and oldest queued event age per employee, most lagging first"""
+    lag = await queue_lag(r)
+    return {
+        "queues": len(lag),
+        "queued_events": sum(entry["queue_length"] for entry in lag),
+        "lag": lag
+    }
+
+# Hit ratio of the authenticated-user cache in this worker
+@router.get('/auth_cache_stats')
+def auth_cache_stats(current_user : User = Depends(get_current_user("admin"))):
+    return principal_cache.stats()
+
 # Get employee timesheet
 @router.get('/get_all_timesheets')
 def get_all_timesheets(
@@ -97,6 +146,54 @@ def get_all_timesheets(
         "idle_times": [{"timesheet_id": ts.id, "idle_seconds": ts.idle_seconds} for ts in timesheets]
     }
 
+# Initial state for the live activity stream at /ws/admin/activity
+@router.get('/activity_snapshot')
+def activity_snapshot(
+                    session:Session = Depends(get_session),
+                    current_user : User = Depends(get_current_user("admin"))):
+    """
+    Today's timesheets with app usage summed per timesheet and app and the
+    screenshot count, aggregated in SQL. Clients load this once and then
+    apply the deltas from the activity websocket instead of polling
+    get_all_timesheets.
+    """
+    as_of = datetime.now().timestamp()
+    timesheets = session.exec(select(Timesheet).where(
+        Timesheet.work_date == date.today())).all()
+    timesheet_ids = [ts.id for ts in timesheets]
+    if not timesheet_ids:
+        return {"as_of": as_of, "timesheets": []}
+
+    usage = session.exec(
+        select(AppUsage.timesheet_id, AppUsage.app, func.sum(AppUsage.duration))
+        .where(AppUsage.timesheet_id.in_(timesheet_ids))
+        .group_by(AppUsage.timesheet_id, AppUsage.app)
+    ).all()
+    apps_map: dict[int, dict[str, int]] = {}
+    for timesheet_id, app, duration in usage:
+        apps_map.setdefault(timesheet_id, {})[app] = duration
+
+    screenshot_counts = dict(session.exec(
+        select(Screenshots.timesheet_id, func.count(Screenshots.id))
+        .where(Screenshots.timesheet_id.in_(timesheet_ids))
+        .group_by(Screenshots.timesheet_id)
+    ).all())
+
+    return {
+        "as_of": as_of,
+        "timesheets": [{
+            "timesheet_id": ts.id,
+            "employee_id": ts.employee_id,
+            "status": ts.status,
+            "start_time": ts.start_time,
+            "end_time": ts.end_time,
+            "total_seconds": ts.total_seconds,
+            "idle_seconds": ts.idle_seconds,
+            "apps": apps_map.get(ts.id, {}),
+            "screenshots": screenshot_counts.get(ts.id, 0),
+        } for ts in timesheets]
+    }
+
 @router.get('/get_user_timesheet')
 def get_user_timesheet(employee_id: int,
                        session: Session = Depends(get_session),
@@ -133,14 +230,50 @@ def get_user_timesheet(employee_id: int,
         "app_usages_map": app_usages_map,
         "idle_times": [{"timesheet_id": ts.id, "idle_seconds": ts.idle_seconds} for ts in timesheets]
     }
+# Payroll export of timesheets, app usage or attendance
+@router.get('/export')
+def export_data(
+            dataset : str = Query(..., pattern="^(timesheets|app_usage|attendance)$"),
+            start_date : date = Query(...),
+            end_date : date = Query(...),
+            format : str = Query("csv", pattern="^(csv|ndjson)$"),
+            employee_ids : Optional[List[int]] = Query(None),
+            current_user : User = Depends(get_current_user("admin"))):
+    """
+    Stream a dataset for any date range and set of employees
+    (repeat employee_ids=..., or leave it out for everyone) as CSV or NDJSON
+    """
+    if end_date < start_date:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="end_date is before start_date")
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    filename = f"{dataset}_{start_date}_{end_date}.{format}"
+    return StreamingResponse(
+        export_rows(dataset, format, start_date, end_date, employee_ids),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 # Get employee attendance
 @router.post('/get_user_attendance')
-def view_user_attendance(employee_id : int ,session:Session = Depends(get_session),
+def view_user_attendance(employee_id : int, response : Response,
+                    start_date : Optional[date] = None,
+                    end_date : Optional[date] = None,
+                    attendance_status : Optional[AttendanceStatus] = None,
+                    page : PageParams = Depends(),
+                    session:Session = Depends(get_session),
                     current_user : User = Depends(get_current_user("admin"))):  
 
-    find_user(employee_id)
-    get_attendance = session.exec(select(Attendance).where(
-        Attendance.employee_id == employee_id)).all()   
+    find_user(session, employee_id)
+    query = select(Attendance).where(Attendance.employee_id == employee_id)
+    if start_date:
+        query = query.where(Attendance.current_date >= start_date)
+    if end_date:
+        query = query.where(Attendance.current_date <= end_date)
+    if attendance_status:
+        query = query.where(Attendance.status == attendance_status)
+    get_attendance = paginate(session, query, Attendance.id, response, page)
 
     if get_attendance is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
@@ -149,22 +282,36 @@ def view_user_attendance(employee_id : int ,session:Session = Depends(get_sessio
 
 
 @router.delete('/remove_employee')
-async def remove_employee( client_id : int,
+async def remove_employee( employee_id : int,
     session:Session = Depends(get_session),
     current_user : User = Depends(get_current_user("admin"))):
 
-    find_user(employee_id)
+    # Deletes, blob release and the sync redis and storage calls all block
+    await run_in_threadpool(delete_employee, session, employee_id)
+    return {'message' : 'Client and all their related data has been removed'}
+
+
+def delete_employee(session: Session, employee_id: int):
+    find_user(session, employee_id)
     employee = session.get(User, employee_id)
     if not employee or employee.role != 'employee': 
                 raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail = f"No employee with id {employee_id} found")
         
+    # Their screenshots go too; blobs nothing else points at are deleted
+    content_hashes = Counter(session.exec(select(Screenshots.content_hash).where(
+        Screenshots.employee_id == employee_id, Screenshots.content_hash.is_not(None))).all())
+    session.exec(delete(Screenshots).where(Screenshots.employee_id == employee_id))
+    unused_keys = []
+    for content_hash, count in content_hashes.items():
+        unused_keys += release_blob(session, content_hash, count)
+
     session.delete(employee) 
     session.commit()          
-        
- 
-        
-    return {'message' : 'Client and all their related data has been removed'} 
+    revoke_user_tokens(employee_id)
+    for key in unused_keys:
+        storage.delete(key)
+
    
 """ employee = session.get(User, employee_id)
     if not employee or employee.role != 'employee': 
@@ -237,50 +384,60 @@ def get_screenshots(
 @router.get('/get_users_screenshots')
 def get_users_screenshots(
             employee_id : int,
+            response : Response,
+            start_date : Optional[date] = None,
+            end_date : Optional[date] = None,
+            page : PageParams = Depends(),
             session:Session = Depends(get_session),
             current_user : User = Depends(get_current_user("admin"))):
-
-    end_date= date.today()
-    start_date = end_date - timedelta(days=7)
+    """An employee's screenshots, the last 7 days unless a range is given"""
+    end_date = end_date or date.today()
+    start_date = start_date or end_date - timedelta(days=7)
     
-    screenshots = session.exec(select(Screenshots).where(
+    screenshots = paginate(session, select(Screenshots).where(
         Screenshots.employee_id == employee_id,
         Screenshots.timestamp >= start_date,
-        Screenshots.timestamp <= end_date)).all()
+        Screenshots.timestamp <= end_date), Screenshots.id, response, page)
     
-    if not screenshots:
+    if not screenshots and page.cursor is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail = f"Screenshots not found ") 
     return screenshots      
 # Router for getting screenshot
 @router.get('/view_screenshot')
 def view_screenshot_file(screenshot_id : int,
+            request : Request,
+            variant : str = Query("full", pattern="^(thumb|full|original)$"),
             session:Session = Depends(get_session),
             current_user : User = Depends(get_current_user("admin"))):
 
     screenshot = session.exec(select(Screenshots).where(Screenshots.id == screenshot_id)).first()
-    if not screenshot:
+    key = screenshot_key(screenshot, variant) if screenshot else None
+    if not key:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail = f"Screenshot of id {screenshot_id} found ")
-    return FileResponse(screenshot.filepath, media_type="image/png")   
+    return conditional_file(request, key, lambda: storage.serve(key, media_type(key)),
+                            final=screenshot.compressed_path is not None)   
  
 # Downloading screenshot 
 @router.get('/download_screenshot')
 def download_screenshot(screenshot_id : int,
+            request : Request,
             session:Session = Depends(get_session),
             current_user : User = Depends(get_current_user("admin"))):
 
     
     screenshot = session.get(Screenshots, screenshot_id)
-    if not screenshot:
+    key = screenshot_key(screenshot, "original") if screenshot else None
+    if not key:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail = f"Screenshot of id {screenshot_id} found ")
         
-    return FileResponse(
-            path = screenshot.filepath,
-            filename = f"screenshot_{screenshot.id}_{screenshot.timestamp}.png",
-            media_type="image/png"
-        )
+    return conditional_file(request, key, lambda: storage.serve(
+            key,
+            media_type(key),
+            filename = f"screenshot_{screenshot.id}_{screenshot.timestamp}{Path(key).suffix}"
+        ))
 
 #Collective endpoint for admin to view employee
 @router.get('employee_stats')
@@ -467,22 +624,43 @@ def get_unassigned_employees(
 
 @router.get('/view_projects')
 def view_projects(
+            response: Response,
+            project_status: Optional[ProjectStatus] = None,
+            page: PageParams = Depends(),
             session: Session = Depends(get_session),
             current_user: User = Depends(get_current_user("admin"))):
     
-    projects = session.exec(select(Projects)).all()
-    if not projects:
+    query = select(Projects)
+    if project_status:
+        query = query.where(Projects.status == project_status)
+    projects = paginate(session, query, Projects.id, response, page, descending=False)
+    if not projects and page.cursor is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="No projects found")
     return projects
 
 @router.get('/view_applications')
 def view_applications(           
+            response : Response,
+            employee_id : Optional[int] = None,
+            application_status : Optional[ApplicationStatus] = None,
+            start_date : Optional[date] = None,
+            end_date : Optional[date] = None,
+            page : PageParams = Depends(),
             session:Session = Depends(get_session),
             current_user : User = Depends(get_current_user("admin"))):
-    
-    applications = session.exec(select(Applications)).all()
-    if not applications:
+    """Leave applications, newest first, one page at a time"""
+    query = select(Applications)
+    if employee_id:
+        query = query.where(Applications.employee_id == employee_id)
+    if application_status:
+        query = query.where(Applications.status == application_status)
+    if start_date:
+        query = query.where(Applications.created_at >= datetime.combine(start_date, datetime.min.time()))
+    if end_date:
+        query = query.where(Applications.created_at < datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
+    applications = paginate(session, query, Applications.id, response, page)
+    if not applications and page.cursor is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="No applications found")
     return applications
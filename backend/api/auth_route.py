@@ -1,13 +1,20 @@
 from datetime import timedelta
 from sqlmodel import SQLModel
 from typing import Annotated
-from data import get_session
+from data import get_session, get_async_session
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from model import User
-from schema import UserInput, UserLogin, ForgetPassword
-from auth.jwt_hasher import create_access_token, hash_password, check_hashed_password
+from schema import UserInput, UserLogin, ForgetPassword, RefreshToken
+from auth.jwt_hasher import create_access_token, create_refresh_token, decode_token, hash_password, check_hashed_password, bearer_scheme
+from auth.revocation import revocation_list
+from auth.passwords import hash_pool, HashPoolFull, verify_and_update
+from fastapi.security import HTTPAuthorizationCredentials
+from jose import JWTError
+from redis import RedisError
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from writer import writer
 from email.mime.text import MIMEText
 import smtplib
 from datetime import datetime, timedelta
@@ -20,22 +27,32 @@ router = APIRouter(
 )
 
 
+def raise_busy_503():
+    raise HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Too many logins in progress, try again shortly",
+    headers={"Retry-After": "1"}
+    )
+
+
 @router.post('/signup')
-def signup(
-    user : UserInput, session : Session = Depends(get_session)):
+async def signup(
+    user : UserInput, session : AsyncSession = Depends(get_async_session)):
     user.name = user.name.strip()
     user.username = user.username.strip()
     user.email = user.email.strip()
     user.password = user.password.strip()
     
     # Check if username already exists
-    existing_username = session.exec(select(User).where(User.username == user.username)).first()
+    existing_username = (await session.exec(select(User).where(User.username == user.username))).first()
     if existing_username:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Username already exists")
     
     try:
-        hashed_password = hash_password(user.password)
+        hashed_password = await hash_pool.run(hash_password, user.password)
+    except HashPoolFull:
+        raise_busy_503()
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=str(e))
@@ -47,33 +64,103 @@ def signup(
         password = hashed_password
     )    
     
-    session.add(create)
-    session.commit()
-    session.refresh(create)
+    await writer.run_async(lambda s: s.add(create))
     return {"message" : "User created"}
 
 # Login route
 @router.post('/signin')
-def signin(
+async def signin(
     user: UserLogin,
-    session : Session = Depends(get_session)
+    session : AsyncSession = Depends(get_async_session)
 ):
-    query = session.exec(select(User).where(User.username == user.username)).first()
+    query = (await session.exec(select(User).where(User.username == user.username))).first()
     if not query:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail = "Wrong username"
                     )
-    if not check_hashed_password(user.password, query.password):
+    try:
+        valid, new_hash = await hash_pool.run(verify_and_update, user.password, query.password)
+    except HashPoolFull:
+        raise_busy_503()
+    if not valid:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail = "Invalid password") 
+
+    # Stored hash used an outdated bcrypt cost; upgrade it while we have the password
+    if new_hash:
+        def upgrade_hash(session: Session) -> None:
+            stored = session.get(User, query.id)
+            stored.password = new_hash
+
+        await writer.run_async(upgrade_hash)
   
-    access_token = create_access_token(data = {'sub' : query.username,
-                                    'id' : query.id, 'role' : query.role})
+    claims = {'sub' : query.username, 'id' : query.id, 'role' : query.role}
     
     return {'message':'Login successful',
-            'access_token' : access_token,
+            'access_token' : create_access_token(data = claims),
+            'refresh_token' : create_refresh_token(data = claims),
             'token_type' : 'bearer'}    
 
+# Exchanging a refresh token for a new access token
+@router.post('/refresh')
+def refresh(
+    token: RefreshToken,
+    session : Session = Depends(get_session)
+):
+    """
+    Issue a new access token and rotate the refresh token;
+    the refresh token that was used is revoked
+    """
+    try:
+        payload = decode_token(token.refresh_token, token_type="refresh")
+    except JWTError:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Invalid refresh token",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+    user = session.get(User, payload.get("id"))
+    if not user or user.username != payload.get("sub"):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Invalid refresh token",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+    try:
+        claimed = revocation_list.claim_refresh_token(payload["jti"], payload["exp"])
+    except RedisError:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Try again shortly",
+                            headers={"Retry-After": "1"})
+    # Rotated tokens are single use; a replay, or the loser of two
+    # concurrent refreshes, is refused
+    if not claimed:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Refresh token already used",
+                            headers={"WWW-Authenticate": "Bearer"})
+    claims = {'sub' : user.username, 'id' : user.id, 'role' : user.role}
+
+    return {'access_token' : create_access_token(data = claims),
+            'refresh_token' : create_refresh_token(data = claims),
+            'token_type' : 'bearer'}
+
+# Revoking the current access token and its refresh token
+@router.post('/logout')
+def logout(
+    token: RefreshToken,
+    credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer_scheme)]
+):
+    try:
+        payload = decode_token(credentials.credentials, token_type="access")
+        revocation_list.revoke_token(payload["jti"], payload["exp"])
+    except JWTError:
+        pass
+    try:
+        payload = decode_token(token.refresh_token, token_type="refresh")
+        revocation_list.claim_refresh_token(payload["jti"], payload["exp"])
+    except JWTError:
+        pass
+
+    return {"message" : "Logged out"}
+
 
 # Generating OTP
 def send_otp(to_email: str, otp: str):
@@ -1,15 +1,25 @@
 from datetime import timedelta
 from typing import Annotated
-from data import get_session
-from fastapi import APIRouter, Depends, HTTPException, status, Query, File, UploadFile, Path
+from data import get_session, get_async_session
+from fastapi import APIRouter, Depends, HTTPException, status, Query, File, UploadFile, Path, Request, Response
 from datetime import datetime, timedelta, date
-from model import User, AppUsage, Timesheet, Attendance, Screenshots, ProjectEmployee, Projects, Applications, TimesheetStatus, AttendanceStatus, DashboardStats
+from model import User, AppUsage, Timesheet, Attendance, Screenshots, ScreenshotBlob, ProjectEmployee, Projects, Applications, TimesheetStatus, AttendanceStatus, DashboardStats
 from auth.jwt_hasher import create_access_token, hash_password, get_current_user, bearer_scheme, check_hashed_password
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from redis.asyncio import Redis
 from uuid import uuid4
+import asyncio
 import json
 from schema import UsageCreate, CreateApplication
+from live_stats import record_stop, read_live_stats
+from writer import writer
+from storage import storage
+from http_cache import conditional_json, conditional_file
+from sockets.activity import publish_activity
+from screenshots import save_upload, check_image, store_blob, near_duplicate, add_blob_ref, today_timesheet_id, cache_timesheet_id, screenshot_key, media_type, ScreenshotTooLarge, MAX_SCREENSHOT_BYTES
+from PIL import UnidentifiedImageError
+from usage_queue import usage_event, push_usage_events, parse_usage_batch, drain_usage, drain_idle_seconds, timesheet_queue_key
 from email.mime.text import MIMEText
 import smtplib
 import os
@@ -28,22 +38,27 @@ r = Redis(
     decode_responses=True
 )
 @router.post('/start_timesheet')
-async def start_timesheet(session:Session = Depends(get_session),
+async def start_timesheet(session:AsyncSession = Depends(get_async_session),
                current_user: User = Depends(get_current_user("employee"))):
     
-    existing = session.exec(
+    existing = (await session.exec(
         select(Timesheet).where(
             Timesheet.employee_id == current_user.id,
             Timesheet.work_date == date.today())
-    ).first()
+    )).first()
     
     if existing and existing.status == TimesheetStatus.INACTIVE:
 
-        existing.status = TimesheetStatus.ACTIVE
-        existing.end_time = None  
-        session.add(existing)
-        session.commit()
-        session.refresh(existing)
+        def reactivate(session: Session) -> Timesheet:
+            timesheet = session.get(Timesheet, existing.id)
+            timesheet.status = TimesheetStatus.ACTIVE
+            timesheet.end_time = None  
+            return timesheet
+
+        existing = await writer.run_async(reactivate)
+        await cache_timesheet_id(r, current_user.id, existing.id)
+        await publish_activity(r, "timesheet_started", employee_id=current_user.id,
+                               timesheet_id=existing.id, start_time=existing.start_time)
         return {"message": "Timesheet reactivated", "timesheet_id": existing.id}
     
     if existing and existing.status == TimesheetStatus.ACTIVE:  
@@ -57,168 +72,129 @@ async def start_timesheet(session:Session = Depends(get_session),
         status=TimesheetStatus.ACTIVE  
     )
 
-    session.add(timesheet)
-    session.commit()
-    session.refresh(timesheet)
+    await writer.run_async(lambda s: s.add(timesheet))
+    await cache_timesheet_id(r, current_user.id, timesheet.id)
 
     await r.rpush(
-        f"timesheet_{current_user.id}",
+        timesheet_queue_key(current_user.id),
         json.dumps({
             "event": "start",
             "time": timesheet.start_time.isoformat()
         })
     )
+    await publish_activity(r, "timesheet_started", employee_id=current_user.id,
+                           timesheet_id=timesheet.id, start_time=timesheet.start_time)
 
     return {"message": "Tracking started"}
 
 # Router for recieving data from the frontend and adding data to redis
 @router.post('/event_buffering')
 async def add_activity( usage: UsageCreate,
-                session:Session = Depends(get_session),
                 current_user: User = Depends(get_current_user("employee"))):
     
-    data = {
-        "event": "usage",
-        "app": usage.app,  # FIXED: Changed from usage.app_name to usage.app
-        "duration": usage.duration,
-        "timestamp": usage.timestamp.isoformat()
-    }
-
-    await r.rpush(f"queue_usage_{current_user.id}", json.dumps(data))
+    await push_usage_events(r, current_user.id, [usage_event(usage)])
 
     return "Tracking started successfully"
 
+# Bulk variant of event_buffering for agents that buffer usage locally
+@router.post('/event_buffering/bulk')
+async def add_activity_bulk(request: Request,
+                current_user: User = Depends(get_current_user("employee"))):
+    """
+    Accept a JSON array (or an application/x-ndjson body) of usage events
+    and push all valid ones to redis in one round trip.
+    Invalid events are skipped and reported back by their index.
+    """
+    body = await request.body()
+    ndjson = "ndjson" in request.headers.get("content-type", "")
+
+    try:
+        events, errors = parse_usage_batch(body, ndjson=ndjson)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e))
+
+    queued = await push_usage_events(r, current_user.id, events)
+
+    return {"queued": queued, "rejected": len(errors), "errors": errors}
+
 
 
 # Router for both stopping and syncing activity from redis to the database
 @router.post("/sync")
 async def sync_activity(
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     current_user: User = Depends(get_current_user("employee"))
 ):
-    timesheet = session.exec(
+    timesheet = (await session.exec(
         select(Timesheet).where(
             Timesheet.employee_id == current_user.id,
             Timesheet.work_date == date.today(),
             Timesheet.status == TimesheetStatus.ACTIVE  # FIXED: Changed from string to enum
         )
-    ).first()
+    )).first()
 
     if not timesheet:
         raise HTTPException(404, "No active timesheet")
 
-    rows = []
-    queue = f"queue_usage_{current_user.id}"
-
-    while True:
-        msg = await r.lpop(queue)
-        if not msg:
-            break
+    synced = await drain_usage(r, current_user.id, timesheet.id, current_user.role)
 
-        data = json.loads(msg)
-        if data.get("event") != "usage":
-            continue
-
-        # FIXED: Skip if required fields are missing
-        if not data.get("app") or not data.get("duration") or not data.get("timestamp"):
-            continue
-
-        rows.append(AppUsage(
-            employee_id=current_user.id,
-            timesheet_id=timesheet.id,  # FIXED: Added timesheet_id
-            role=current_user.role,  # FIXED: Added role field
-            app=data["app"],
-            duration=data["duration"],
-            timestamp=datetime.fromisoformat(data["timestamp"])
-        ))
-
-    if rows:
-        session.add_all(rows)
-        session.commit()
-
-    return {"synced": len(rows)}
+    return {"synced": synced}
 
 # Syncing queue with db
 @router.put('/stop_tracking')
-async def stop_tracking(session: Session = Depends(get_session),
+async def stop_tracking(session: AsyncSession = Depends(get_async_session),
                current_user: User = Depends(get_current_user("employee"))):
 
-    timesheet = session.exec(
+    timesheet = (await session.exec(
         select(Timesheet).where(
             Timesheet.employee_id == current_user.id,
             Timesheet.work_date == date.today(),
             Timesheet.status == TimesheetStatus.ACTIVE  # FIXED: Changed from string to enum
         )
-    ).first()
+    )).first()
 
     if not timesheet:
         raise HTTPException(404, "No active timesheet")
 
+    timesheet_id = timesheet.id
     start = timesheet.start_time  # FIXED: Using existing start_time, not modifying it
     end = datetime.now()  # FIXED: Changed from deprecated datetime.utcnow() to datetime.now()
     idle_seconds = timesheet.idle_seconds or 0
 
-    # drain timesheet events
-    queue_ts = f"timesheet_{current_user.id}"
-    while True:
-        msg = await r.lpop(queue_ts)
-        if not msg:
-            break
-
-        data = json.loads(msg)
-        if data["event"] == "idle":
-            idle_seconds += int(data["seconds"])
-
-    # drain usage events
-    rows = []
-    queue_usage = f"queue_usage_{current_user.id}"
-
-    while True:
-        msg = await r.lpop(queue_usage)
-        if not msg:
-            break
-
-        data = json.loads(msg)
-        if data.get("event") != "usage":
-            continue
-
-        # FIXED: Skip if required fields are missing
-        if not data.get("app") or not data.get("duration") or not data.get("timestamp"):
-            continue
-
-        rows.append(AppUsage(
-            employee_id=current_user.id,
-            timesheet_id=timesheet.id,  # FIXED: Added timesheet_id to link app usage to timesheet
-            role=current_user.role,  # FIXED: Added role field
-            app=data["app"],
-            duration=data["duration"],
-            timestamp=datetime.fromisoformat(data["timestamp"])
-        ))
-
-    if rows:
-        session.add_all(rows)
-
-    # FIXED: Only setting end_time here when stopping, not modifying start_time
-    timesheet.end_time = end
-    timesheet.total_seconds = (end - start).total_seconds()
-    timesheet.idle_seconds = idle_seconds
-    timesheet.status = TimesheetStatus.INACTIVE  # FIXED: Changed from string to enum
-
-    attendance = session.exec(
-        select(Attendance).where(
-            Attendance.employee_id == current_user.id,
-            Attendance.current_date == date.today()
-        )
-    ).first()
-
-    if not attendance:
-        session.add(Attendance(
-            employee_id=current_user.id,
-            current_date=date.today(),
-            status=AttendanceStatus.PRESENT  # FIXED: Changed from string to enum
-        ))
-
-    session.commit()
+    # drain timesheet and usage events
+    drained_idle = await drain_idle_seconds(r, current_user.id)
+    idle_seconds += drained_idle
+    await drain_usage(r, current_user.id, timesheet_id, current_user.role)
+
+    def close_timesheet(session: Session) -> None:
+        timesheet = session.get(Timesheet, timesheet_id)
+        # FIXED: Only setting end_time here when stopping, not modifying start_time
+        timesheet.end_time = end
+        timesheet.total_seconds = (end - start).total_seconds()
+        timesheet.idle_seconds = idle_seconds
+        timesheet.status = TimesheetStatus.INACTIVE  # FIXED: Changed from string to enum
+
+        attendance = session.exec(
+            select(Attendance).where(
+                Attendance.employee_id == current_user.id,
+                Attendance.current_date == date.today()
+            )
+        ).first()
+
+        if not attendance:
+            session.add(Attendance(
+                employee_id=current_user.id,
+                current_date=date.today(),
+                status=AttendanceStatus.PRESENT  # FIXED: Changed from string to enum
+            ))
+
+    await writer.run_async(close_timesheet)
+    await record_stop(r, current_user.id, drained_idle)
+    await publish_activity(r, "timesheet_stopped", employee_id=current_user.id,
+                           timesheet_id=timesheet_id, end_time=end,
+                           total_seconds=(end - start).total_seconds(),
+                           idle_seconds=idle_seconds)
 
     return {"message": "Tracking stopped"}
     
@@ -394,43 +370,82 @@ def update_task_status(
     return {"message" : "Task status has been updated"}
 
 
-BASE_DIR = Path(__file__).resolve().parents[2] / "screenshots"
-
 @router.post("/upload-screenshot")
 async def upload_screenshot(
+    request: Request,
     file: UploadFile = File(...),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     current_user = Depends(get_current_user("employee"))
 ):
-    date_folder = datetime.now().strftime("%Y-%m-%d")
-    save_dir = BASE_DIR / str(current_user.id) / date_folder
-    save_dir.mkdir(parents=True, exist_ok=True)
-    time_sheet = session.exec(
-        select(Timesheet).where(Timesheet.employee_id == current_user.id,
-                                Timesheet.work_date == date.today())).first()
-    if not time_sheet:
+    # Refuse oversized bodies before touching disk when the client says so up front
+    if int(request.headers.get("content-length") or 0) > MAX_SCREENSHOT_BYTES + 64 * 1024:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail="Screenshot too large")
+
+    timesheet_id = await today_timesheet_id(r, session, current_user.id)
+    if not timesheet_id:
         raise HTTPException(status_code=400,
                             detail="No active timesheet found for today")
-    screenshot_id = str(uuid4())
-    filename = f"{screenshot_id}.png"
-    file_path = save_dir / filename
 
-    with open(file_path, "wb") as f:
-        f.write(await file.read())
-        
-    relative_path = f"{current_user.id}/{date_folder}/{filename}"
-    screenshot = Screenshots(
-        employee_id=current_user.id,
-        timesheet_id=time_sheet.id,
-        filepath=relative_path,
-        timestamp=date.today()
-    )
-    session.add(screenshot)
-    session.commit()
+    try:
+        tmp_path, size_bytes, upload_hash = await save_upload(file)
+    except ScreenshotTooLarge:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail="Screenshot too large")
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Empty screenshot")
+
+    try:
+        await asyncio.to_thread(check_image, tmp_path)
+        # Identical (or, if enabled, near-identical) images are stored once
+        content_hash, phash = await near_duplicate(r, timesheet_id, tmp_path, upload_hash)
+        blob = await session.get(ScreenshotBlob, content_hash)
+        if not blob and content_hash != upload_hash:
+            # The image it resembles is not committed yet; store this one as is
+            content_hash = upload_hash
+            blob = await session.get(ScreenshotBlob, content_hash)
+        if blob:
+            relative_path = blob.filepath
+        else:
+            relative_path = await asyncio.to_thread(store_blob, tmp_path, content_hash)
+    except UnidentifiedImageError:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            detail="Screenshot is not an image")
+    finally:
+        # Gone already once stored; otherwise nothing else will clean it up
+        await asyncio.to_thread(tmp_path.unlink, missing_ok=True)
+
+    def add_screenshot(session: Session) -> Screenshots:
+        add_blob_ref(session, content_hash, relative_path, size_bytes, phash)
+        # Reuse the variants of an earlier copy of the same image
+        sibling = session.exec(select(Screenshots).where(
+            Screenshots.content_hash == content_hash,
+            Screenshots.compressed_path.is_not(None))).first()
+        screenshot = Screenshots(
+            employee_id=current_user.id,
+            timesheet_id=timesheet_id,
+            filepath=relative_path,
+            content_hash=content_hash,
+            compressed_path=sibling.compressed_path if sibling else None,
+            thumbnail_path=sibling.thumbnail_path if sibling else None,
+            timestamp=date.today()
+        )
+        session.add(screenshot)
+        return screenshot
+
+    screenshot = await writer.run_async(add_screenshot)
+    if not screenshot.compressed_path:
+        # Compressed copy and thumbnail are made by a worker
+        from tasks import process_screenshot
+        await asyncio.to_thread(process_screenshot.delay, screenshot.id)
+    await publish_activity(r, "screenshot_uploaded", employee_id=current_user.id,
+                           timesheet_id=timesheet_id, filepath=relative_path)
 
     return {
         "status": "ok",
-        "screenshot_id": str(screenshot_id)
+        "screenshot_id": str(screenshot.id),
+        "duplicate": blob is not None
     }
 
 
@@ -468,6 +483,7 @@ def list_screenshots(
             {
                 "id": s.id,
                 "image_url": f"{api_url}/{s.id}",
+                "thumbnail_url": f"{api_url}/{s.id}?variant=thumb",
                 "timestamp": s.timestamp,
                 "Appname": list(set([proper_app_name(a.app) for a in app_dict.get(s.timesheet_id, [])]))
             }
@@ -478,6 +494,8 @@ def list_screenshots(
 @router.get("/screenshot/{id}")
 def get_screenshot(
     id: int,
+    request: Request,
+    variant: str = Query("full", pattern="^(thumb|full|original)$"),
     session: Session = Depends(get_session),
     current_user = Depends(get_current_user("employee")),
 ):
@@ -486,15 +504,13 @@ def get_screenshot(
     if not s or s.employee_id != current_user.id:
         raise HTTPException(status_code=404)
 
-    # Clean the path just in case the DB stored it weirdly
-    clean_path = s.filepath.replace("screenshots/", "").replace("screenshots\\", "")
-    
-    full_path = BASE_DIR / clean_path
-    print(f"DEBUG: Looking for file at: {full_path}") 
-    if not full_path.exists():
-        raise HTTPException(status_code=404, detail=f"File not found on disk: {full_path}")
+    key = screenshot_key(s, variant)
+    if not key:
+        raise HTTPException(status_code=404, detail="File not found")
     
-    return FileResponse(full_path, media_type="image/png")
+    # Until the variants exist the URL is answered with the original
+    return conditional_file(request, key, lambda: storage.serve(key, media_type(key)),
+                            final=s.compressed_path is not None)
 
 
 @router.get('/get_employee_screenshots_week')
@@ -534,6 +550,7 @@ def get_employee_screenshots_week(
             {
                 "id": s.id,
                 "image_url": f"{api_url}/{s.id}",
+                "thumbnail_url": f"{api_url}/{s.id}?variant=thumb",
                 "timestamp": s.timestamp,
                 "Appname": list(set([proper_app_name(a.app) for a in app_dict.get(s.timesheet_id, [])]))
             }
@@ -614,27 +631,35 @@ def get_employee_timesheet_week(
 
 
 @router.get('/dashboard/stats')
-def get_dashboard_stats(
-    session: Session = Depends(get_session),
+async def get_dashboard_stats(
+    request: Request,
+    response: Response,
+    session: AsyncSession = Depends(get_async_session),
     current_user: User = Depends(get_current_user("employee"))
 ):
     """
-    Get pre-calculated dashboard stats for the current user (today's data)
-    Stats are calculated hourly by background job
+    Get dashboard stats for the current user (today's data)
+    Served from the redis counters updated at sync time, falling back to
+    the stats calculated by the background job; unchanged stats come back
+    as a 304
     """
     today = date.today()
     
     # Fetch pre-calculated stats from DashboardStats table
-    stats = session.exec(
+    stats = (await session.exec(
         select(DashboardStats).where(
             DashboardStats.employee_id == current_user.id,
             DashboardStats.stats_date == today
         )
-    ).first()
+    )).first()
+
+    live = await read_live_stats(r, current_user.id, stats)
+    if live:
+        return conditional_json(request, response, live)
     
     if not stats:
         # If stats haven't been calculated yet, return zeros
-        return {
+        return conditional_json(request, response, {
             "today": {
                 "hours": 0,
                 "idle_hours": 0,
@@ -644,7 +669,7 @@ def get_dashboard_stats(
             "attendance_status": "not_marked",
             "pending_applications": 0,
             "last_updated": None
-        }
+        })
     
     # Parse apps JSON
     apps_dict = json.loads(stats.apps_used) if stats.apps_used else {}
@@ -658,7 +683,7 @@ def get_dashboard_stats(
         for app_name, app_data in apps_dict.items()
     ]
     
-    return {
+    return conditional_json(request, response, {
         "today": {
             "hours": stats.total_hours,
             "idle_hours": stats.idle_hours,
@@ -668,11 +693,13 @@ def get_dashboard_stats(
         "attendance_status": stats.attendance_status,
         "pending_applications": stats.pending_applications,
         "last_updated": stats.updated_at.isoformat() if stats.updated_at else None
-    }
+    })
 
 
 @router.get('/dashboard/history')
 def get_dashboard_history(
+    request: Request,
+    response: Response,
     days: int = Query(7, ge=1, le=30),
     session: Session = Depends(get_session),
     current_user: User = Depends(get_current_user("employee"))
@@ -700,12 +727,12 @@ def get_dashboard_history(
             "attendance_status": stat.attendance_status
         })
     
-    return {
+    return conditional_json(request, response, {
         "period_days": days,
         "history": history,
         "average_hours": sum(s["hours"] for s in history) / len(history) if history else 0,
         "average_idle_pct": sum(s["idle_percentage"] for s in history) / len(history) if history else 0
-    }
+    })
 
 
 @router.get('/admin/dashboard/users-stats')
@@ -812,18 +839,20 @@ def get_admin_user_history(
 
 @router.post('/admin/dashboard/recalculate-now')
 def admin_recalculate_stats_now(
+    full: bool = Query(False),
     session: Session = Depends(get_session),
     current_user: User = Depends(get_current_user("admin"))
 ):
     """
     Admin endpoint: Manually trigger stats calculation (runs background job immediately)
-    Useful for testing or force-refreshing stats
+    Useful for testing or force-refreshing stats; full=true rebuilds today's
+    stats from scratch instead of folding in new usage only
     """
     from tasks import calculate_daily_stats
     
     try:
         # Trigger the background job
-        task = calculate_daily_stats.delay()
+        task = calculate_daily_stats.delay(full=full)
         return {
             "status": "success",
             "message": "Stats recalculation triggered",
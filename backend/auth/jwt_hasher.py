@@ -6,33 +6,53 @@ from fastapi import Depends, HTTPException, status
 from jose import JWTError, jwt
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from sqlmodel import Session, select
-from passlib.context import CryptContext
 from data import get_session
+from auth.passwords import hash_password, check_hashed_password
+from auth.principal_cache import principal_cache, PRINCIPAL_CACHE_ENABLED
+from auth.revocation import revocation_list
+from uuid import uuid4
 import bcrypt
 
 
-pwd = CryptContext(schemes = ['bcrypt'], deprecated = 'auto')
-
-
-def hash_password(password: str):
-    return pwd.hash(password.strip())
-
-def check_hashed_password(plain_pass: str, hashed_pass: str):
-    return pwd.verify(plain_pass.strip(), hashed_pass)
-
 SECRET_KEY: str = config('SECRET_KEY', cast=str, default='secret')
 ALGORITHM: str = config('ALGORITHM', cast=str, default='HS256')
-ACCESS_TOKEN_EXPIRE_MINUTES = 3000000
+ACCESS_TOKEN_EXPIRE_MINUTES: int = config('ACCESS_TOKEN_EXPIRE_MINUTES', cast=int, default=15)
+REFRESH_TOKEN_EXPIRE_DAYS: int = config('REFRESH_TOKEN_EXPIRE_DAYS', cast=int, default=7)
 
 bearer_scheme = HTTPBearer()
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
-    expire = datetime.now(timezone.utc) +( expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
+    now = datetime.now(timezone.utc)
+    expire = now +( expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    to_encode.update({"exp": expire, "iat": now, "jti": uuid4().hex, "type": "access"})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def create_refresh_token(data: dict):
+    to_encode = data.copy()
+    now = datetime.now(timezone.utc)
+    expire = now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    to_encode.update({"exp": expire, "iat": now, "jti": uuid4().hex, "type": "refresh"})
+    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+def decode_token(token: str, token_type: str = "access") -> dict:
+    """
+    Decode a token of the given type and make sure it has not been revoked.
+    Tokens without a jti predate revocation support and are refused.
+    """
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    if payload.get("type") != token_type or not payload.get("jti"):
+        raise JWTError("Wrong token type")
+    if revocation_list.is_revoked(payload):
+        raise JWTError("Token has been revoked")
+    return payload
+
+def revoke_user_tokens(user_id: int) -> None:
+    """Log a user out everywhere, e.g. when deleted, deactivated or re-roled"""
+    revocation_list.revoke_user(user_id)
+    principal_cache.invalidate_user(user_id)
+
 def get_current_user(required_role: Optional[str] = None):
  def inner(credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer_scheme)],
     session: Session = Depends(get_session)
@@ -44,7 +64,7 @@ def get_current_user(required_role: Optional[str] = None):
         headers={"WWW-Authenticate": "Bearer"},
      )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         username: str | None = payload.get("sub")
         user_id: int | None = payload.get("id")
         role : str | None = payload.get("role")
@@ -57,6 +77,14 @@ def get_current_user(required_role: Optional[str] = None):
                 detail="Access denied"
             )
 
+        # Revocation is checked above, so a token seen before resolves
+        # from the principal cache without a query
+        signature = token.rsplit(".", 1)[-1]
+        if PRINCIPAL_CACHE_ENABLED:
+            user = principal_cache.get(user_id, signature)
+            if user is not None and user.username == username and user.role == role:
+                return user
+
         query = select(User).where((User.username == username) & (User.id == user_id))
         user = session.exec(query).first()
         if user is None:
@@ -64,6 +92,9 @@ def get_current_user(required_role: Optional[str] = None):
     
         if user.role != role: 
             raise credentials_exception
+
+        if PRINCIPAL_CACHE_ENABLED:
+            principal_cache.set(user_id, signature, user)
         return user
     except JWTError:
        raise credentials_exception
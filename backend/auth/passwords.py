@@ -0,0 +1,69 @@
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from decouple import config
+from passlib.context import CryptContext
+
+# bcrypt cost factor; hashes made with any other cost are rehashed on login
+BCRYPT_ROUNDS: int = config('BCRYPT_ROUNDS', cast=int, default=12)
+# Processes dedicated to hashing, and how many hashes may wait for them
+HASH_POOL_WORKERS: int = config('HASH_POOL_WORKERS', cast=int, default=2)
+HASH_QUEUE_LIMIT: int = config('HASH_QUEUE_LIMIT', cast=int, default=64)
+
+pwd = CryptContext(
+    schemes=['bcrypt'],
+    deprecated='auto',
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+
+def hash_password(password: str):
+    return pwd.hash(password.strip())
+
+def check_hashed_password(plain_pass: str, hashed_pass: str):
+    return pwd.verify(plain_pass.strip(), hashed_pass)
+
+def verify_and_update(plain_pass: str, hashed_pass: str) -> tuple[bool, str | None]:
+    """Check a password and return a new hash if the stored one uses an outdated cost"""
+    return pwd.verify_and_update(plain_pass.strip(), hashed_pass)
+
+
+class HashPoolFull(Exception):
+    pass
+
+
+class HashPool():
+    """
+    Runs bcrypt in a small process pool so a login storm cannot occupy the
+    threadpool every other sync endpoint depends on. At most `queue_limit`
+    hashes are running or waiting; beyond that callers get HashPoolFull
+    right away and should answer 503. Workers are spawned rather than
+    forked, since forking a process that already runs threads (the event
+    loop's executors, the db writer, redis clients) can copy held locks.
+    """
+    def __init__(self, workers: int = HASH_POOL_WORKERS, queue_limit: int = HASH_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.executor: ProcessPoolExecutor | None = None
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    async def run(self, fn, *args):
+        with self.lock:
+            if self.in_flight >= self.queue_limit:
+                raise HashPoolFull()
+            self.in_flight += 1
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+hash_pool = HashPool()
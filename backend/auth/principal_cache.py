@@ -0,0 +1,119 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from decouple import config
+from redis import Redis
+from model import User
+
+PRINCIPAL_CACHE_ENABLED: bool = config('PRINCIPAL_CACHE_ENABLED', cast=bool, default=True)
+# Revoked tokens are refused before the cache is consulted, so entries can
+# live as long as an access token does
+PRINCIPAL_CACHE_TTL: int = config('PRINCIPAL_CACHE_TTL', cast=int, default=900)
+PRINCIPAL_CACHE_SIZE: int = config('PRINCIPAL_CACHE_SIZE', cast=int, default=10000)
+# Share resolved users across workers through redis as a second tier
+PRINCIPAL_CACHE_REDIS: bool = config('PRINCIPAL_CACHE_REDIS', cast=bool, default=False)
+
+# Only what the routes read from current_user; never the password hash or OTP
+CACHED_FIELDS = ("id", "name", "username", "role", "email", "is_active")
+
+
+class PrincipalCache():
+    """
+    Authenticated users keyed by (user id, token signature) so a request
+    carrying a token seen recently skips the User lookup. Entries live
+    PRINCIPAL_CACHE_TTL seconds in an in-process LRU and, optionally, in
+    redis where other workers can pick them up. invalidate_user() drops a
+    user from this process and from redis; other processes keep their local
+    entry until it expires, but refuse the user's revoked tokens first.
+    Any write to a CACHED_FIELDS column must call it (through
+    revoke_user_tokens) after committing; remove_employee is currently the
+    only route that changes those columns.
+    """
+    def __init__(self, max_size: int = PRINCIPAL_CACHE_SIZE, ttl: int = PRINCIPAL_CACHE_TTL,
+                 redis: Redis | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.redis = redis
+        self.entries: OrderedDict[tuple[int, str], tuple[float, dict]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int, signature: str) -> User | None:
+        key = (user_id, signature)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return User(**entry[1])
+            if entry:
+                del self.entries[key]
+
+        if self.redis:
+            cached = self.redis.get(self._redis_key(user_id, signature))
+            if cached:
+                fields = json.loads(cached)
+                self._store(key, fields)
+                with self.lock:
+                    self.redis_hits += 1
+                return User(**fields)
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, user_id: int, signature: str, user: User) -> None:
+        fields = {field: getattr(user, field) for field in CACHED_FIELDS}
+        self._store((user_id, signature), fields)
+        if self.redis:
+            with self.redis.pipeline() as pipe:
+                pipe.set(self._redis_key(user_id, signature), json.dumps(fields), ex=self.ttl)
+                pipe.sadd(self._redis_index(user_id), signature)
+                pipe.expire(self._redis_index(user_id), self.ttl)
+                pipe.execute()
+
+    def invalidate_user(self, user_id: int) -> None:
+        """Forget every cached token of a deleted, deactivated or re-roled user"""
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == user_id]:
+                del self.entries[key]
+
+        if self.redis:
+            signatures = self.redis.smembers(self._redis_index(user_id))
+            keys = [self._redis_key(user_id, signature) for signature in signatures]
+            self.redis.delete(self._redis_index(user_id), *keys)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.redis_hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "hit_ratio": round((self.hits + self.redis_hits) / lookups, 4) if lookups else 0
+            }
+
+    def _store(self, key: tuple[int, str], fields: dict) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, fields)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    @staticmethod
+    def _redis_key(user_id: int, signature: str) -> str:
+        return f"principal:{user_id}:{signature}"
+
+    @staticmethod
+    def _redis_index(user_id: int) -> str:
+        return f"principals:{user_id}"
+
+
+principal_cache = PrincipalCache(
+    redis=Redis(host="localhost", port=6379, db=0, decode_responses=True) if PRINCIPAL_CACHE_REDIS else None
+)
@@ -0,0 +1,127 @@
+import hashlib
+import threading
+import time
+from decouple import config
+from redis import Redis, RedisError
+
+# How often each process pulls the revocation state from redis
+REVOCATION_REFRESH_SECONDS: float = config('REVOCATION_REFRESH_SECONDS', cast=float, default=5)
+
+REVOKED_TOKENS = "revoked_tokens"  # sorted set of jti scored by token expiry
+TOKENS_VALID_AFTER = "tokens_valid_after"  # hash of user id -> epoch
+
+
+def used_refresh_key(jti: str) -> str:
+    return f"refresh_used:{jti}"
+
+
+class BloomFilter():
+    """Fixed size bloom filter over strings using double hashing"""
+    def __init__(self, size_bits: int = 1 << 20, hashes: int = 7):
+        self.size = size_bits
+        self.hashes = hashes
+        self.bits = bytearray(size_bits // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.sha256(item.encode()).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str) -> None:
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class RevocationList():
+    """
+    Revoked tokens live in redis: single tokens by jti until they expire,
+    and whole users through a "tokens valid after" epoch. Every process
+    keeps a bloom filter of revoked jtis and a copy of the epochs, pulled
+    from redis every REVOCATION_REFRESH_SECONDS, so checking a token is an
+    in-memory lookup; redis is only asked to confirm bloom filter hits.
+    That lag is fine for access tokens; refresh tokens are claimed in
+    redis on every use instead (claim_refresh_token).
+    """
+    def __init__(self, redis: Redis, refresh_seconds: float = REVOCATION_REFRESH_SECONDS):
+        self.redis = redis
+        self.refresh_seconds = refresh_seconds
+        self.bloom = BloomFilter()
+        self.valid_after: dict[int, float] = {}
+        self.refreshed_at = 0.0
+        self.lock = threading.Lock()
+
+    def revoke_token(self, jti: str, expires_at: float) -> None:
+        self.redis.zadd(REVOKED_TOKENS, {jti: expires_at})
+        with self.lock:
+            self.bloom.add(jti)
+
+    def claim_refresh_token(self, jti: str, expires_at: float) -> bool:
+        """
+        Mark a refresh token as spent. Returns False if it already was, so
+        of any number of concurrent uses on any worker exactly one wins.
+        Checked against redis every time rather than the bloom filter,
+        which lags by up to REVOCATION_REFRESH_SECONDS.
+        """
+        ttl = max(int(expires_at - time.time()), 1)
+        return bool(self.redis.set(used_refresh_key(jti), 1, nx=True, ex=ttl))
+
+    def revoke_user(self, user_id: int) -> None:
+        """
+        Invalidate every token issued to a user before this second; tokens
+        issued within the same second stay valid so an immediate re-login works
+        """
+        now = int(time.time())
+        self.redis.hset(TOKENS_VALID_AFTER, user_id, now)
+        with self.lock:
+            self.valid_after[user_id] = now
+
+    def is_revoked(self, payload: dict) -> bool:
+        self._refresh_if_stale()
+
+        issued_at = payload.get("iat", 0)
+        if issued_at < self.valid_after.get(payload.get("id"), 0):
+            return True
+
+        # Refresh tokens are single use and claimed atomically instead
+        if payload.get("type") == "refresh":
+            return False
+
+        jti = payload.get("jti")
+        if not jti or jti not in self.bloom:
+            return False
+        try:
+            return self.redis.zscore(REVOKED_TOKENS, jti) is not None
+        except RedisError:
+            # Rare path (bloom hit) with redis down: fail closed
+            return True
+
+    def _refresh_if_stale(self) -> None:
+        if time.monotonic() - self.refreshed_at < self.refresh_seconds:
+            return
+        with self.lock:
+            if time.monotonic() - self.refreshed_at < self.refresh_seconds:
+                return
+            try:
+                with self.redis.pipeline() as pipe:
+                    pipe.zremrangebyscore(REVOKED_TOKENS, "-inf", time.time())
+                    pipe.zrange(REVOKED_TOKENS, 0, -1)
+                    pipe.hgetall(TOKENS_VALID_AFTER)
+                    _, revoked, valid_after = pipe.execute()
+            except RedisError:
+                # Keep serving from the last snapshot and try again next time
+                self.refreshed_at = time.monotonic()
+                return
+
+            bloom = BloomFilter()
+            for jti in revoked:
+                bloom.add(jti)
+            self.bloom = bloom
+            self.valid_after = {int(user_id): float(epoch) for user_id, epoch in valid_after.items()}
+            self.refreshed_at = time.monotonic()
+
+
+revocation_list = RevocationList(Redis(host="localhost", port=6379, db=0, decode_responses=True))
@@ -1,15 +1,11 @@
 from fastapi import WebSocket, status, Depends
-from jose import jwt, JWTError, ExpiredSignatureError
+from jose import JWTError, ExpiredSignatureError
 from sqlmodel import Session, select
 from typing import Optional
 from datetime import timezone
 from data import get_session
 from model import User
-from decouple import config
-
-
-SECRET_KEY: str = config('SECRET_KEY')
-ALGORITHM: str = config('ALGORITHM', default='HS256')
+from auth.jwt_hasher import decode_token
 
 async def get_current_ws(
     websocket:WebSocket,
@@ -19,34 +15,34 @@ async def get_current_ws(
     async def close(code=status.WS_1008_POLICY_VIOLATION):
         await websocket.close(code=code)
         return None
-    
+
     token = websocket.query_params.get("token")
     if not token:
         return await close()
 
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
     except ExpiredSignatureError:
         print('token expired')
         return await close()
     except JWTError:
         print('invalid token')
         return await close()
-    
-    email = payload.get('sub')
+
+    username = payload.get('sub')
     user_id = payload.get("id")
     role = payload.get("role")
-    
-    
-    if not email or not user_id or not role:
+
+
+    if not username or not user_id or not role:
         print('missing credentials in token')
         return await close()
-        
-    user = session.exec(select(Users).where(Users.id == user_id, Users.email == email)).first()
+
+    user = session.exec(select(User).where(User.id == user_id, User.username == username)).first()
     if not user:
         print('User not found')
         return await close()
-    
+
     if required_role and user.role != required_role:
         print('role mismatch')
         return await close()
@@ -22,12 +22,16 @@ celery_app.conf.update(
 
 # Celery Beat schedule (periodic tasks)
 celery_app.conf.beat_schedule = {
-    'calculate-dashboard-stats-hourly': {
+    'calculate-dashboard-stats-incremental': {
         'task': 'tasks.calculate_daily_stats',
-        'schedule': crontab(minute=0),  # Run every hour at minute 0
+        'schedule': crontab(),  # Run every minute, folding in new usage only
     },
     'calculate-dashboard-stats-daily': {
         'task': 'tasks.calculate_all_users_weekly_stats',
         'schedule': crontab(hour=0, minute=0),  # Run daily at midnight
     },
+    'drain-usage-queues': {
+        'task': 'tasks.drain_usage_queues',
+        'schedule': float(os.getenv('DRAIN_FLUSH_INTERVAL', 5)),  # Seconds between drains
+    },
 }
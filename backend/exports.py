@@ -0,0 +1,93 @@
+import csv
+import io
+import json
+from datetime import date, datetime, timedelta
+from typing import Iterator
+from sqlmodel import Session, select
+from data import engine
+from model import Timesheet, AppUsage, Attendance
+
+# Rows fetched from the server-side cursor, and written out, per step
+EXPORT_BATCH_SIZE = 2000
+
+
+def day_start(day: date) -> datetime:
+    return datetime.combine(day, datetime.min.time())
+
+
+def timesheet_query(start_date: date, end_date: date):
+    columns = [Timesheet.id, Timesheet.employee_id, Timesheet.work_date, Timesheet.start_time,
+               Timesheet.end_time, Timesheet.total_seconds, Timesheet.idle_seconds, Timesheet.status]
+    return columns, (select(*columns)
+                     .where(Timesheet.work_date >= start_date, Timesheet.work_date <= end_date)
+                     .order_by(Timesheet.employee_id, Timesheet.work_date, Timesheet.id))
+
+
+def app_usage_query(start_date: date, end_date: date):
+    columns = [AppUsage.id, AppUsage.employee_id, AppUsage.timesheet_id, AppUsage.app,
+               AppUsage.duration, AppUsage.timestamp]
+    return columns, (select(*columns)
+                     .where(AppUsage.timestamp >= day_start(start_date),
+                            AppUsage.timestamp < day_start(end_date + timedelta(days=1)))
+                     .order_by(AppUsage.employee_id, AppUsage.timestamp, AppUsage.id))
+
+
+def attendance_query(start_date: date, end_date: date):
+    columns = [Attendance.id, Attendance.employee_id, Attendance.current_date, Attendance.status]
+    return columns, (select(*columns)
+                     .where(Attendance.current_date >= start_date, Attendance.current_date <= end_date)
+                     .order_by(Attendance.employee_id, Attendance.current_date, Attendance.id))
+
+
+EXPORTS = {
+    "timesheets": (timesheet_query, Timesheet.employee_id),
+    "app_usage": (app_usage_query, AppUsage.employee_id),
+    "attendance": (attendance_query, Attendance.employee_id),
+}
+
+
+def export_value(value):
+    value = getattr(value, "value", value)  # enums
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def export_rows(dataset: str, fmt: str, start_date: date, end_date: date,
+                employee_ids: list[int] | None = None) -> Iterator[str]:
+    """
+    Yield `dataset` for the date range as CSV or NDJSON text, one batch of
+    rows at a time. The session is opened here rather than taken from the
+    request, so it lives exactly as long as the response body. Rows come
+    from a server-side cursor (yield_per / stream_results) as plain
+    column tuples, so neither the driver nor the session's identity map
+    ever holds more than one batch and memory stays flat for any range.
+    """
+    build_query, employee_column = EXPORTS[dataset]
+    columns, statement = build_query(start_date, end_date)
+    if employee_ids:
+        statement = statement.where(employee_column.in_(employee_ids))
+    names = [column.key for column in columns]
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(names)
+
+    with Session(engine) as session:
+        result = session.execute(
+            statement.execution_options(yield_per=EXPORT_BATCH_SIZE, stream_results=True)
+        )
+        for rows in result.partitions():
+            for row in rows:
+                values = [export_value(value) for value in row]
+                if fmt == "csv":
+                    writer.writerow(values)
+                else:
+                    buffer.write(json.dumps(dict(zip(names, values))) + "\n")
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,65 @@
+import hashlib
+import json
+from fastapi import Request, Response
+
+# Screenshot files never change once written; they are behind auth, so
+# only the browser may keep them
+IMMUTABLE = "private, max-age=31536000, immutable"
+# Always ask, but let an unchanged body come back as an empty 304
+REVALIDATE = "private, no-cache"
+
+
+def etag_for(value) -> str:
+    """Strong ETag for a string or any JSON-serialisable value"""
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True, default=str)
+    return '"' + hashlib.sha256(value.encode()).hexdigest()[:32] + '"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    """True when If-None-Match already names `etag` (or is *)"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    candidates = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag in candidates
+
+
+def not_modified(etag: str, cache_control: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+
+def conditional_json(request: Request, response: Response, payload, cache_control: str = REVALIDATE):
+    """
+    Return `payload` with an ETag over its content, or an empty 304 when
+    the client already has it. `response` is the route's injected Response.
+    """
+    etag = etag_for(payload)
+    if is_not_modified(request, etag):
+        return not_modified(etag, cache_control)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = cache_control
+    return payload
+
+
+def conditional_file(request: Request, key: str, serve, final: bool = True) -> Response:
+    """
+    Serve a stored file with a strong ETag, or a 304 when the client
+    already has it. `serve` builds the full response. Files are immutable,
+    but a URL that is temporarily answered with a fallback file (`final`
+    False) has to be revalidated rather than cached for good. Redirects to
+    presigned URLs keep their own short Cache-Control and get no ETag, so
+    a stale one is never revalidated.
+    """
+    cache_control = IMMUTABLE if final else REVALIDATE
+    etag = etag_for(key)
+    if is_not_modified(request, etag):
+        return not_modified(etag, cache_control)
+    response = serve()
+    if response.status_code == 200:
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = cache_control
+    return response
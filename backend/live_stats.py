@@ -0,0 +1,98 @@
+import json
+import time
+from datetime import date, datetime
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from model import DashboardStats
+
+# Counters outlive the day they describe by one day, then expire
+STATS_TTL_SECONDS = 2 * 24 * 3600
+
+
+def live_stats_key(employee_id: int, day: date) -> str:
+    return f"stats_{employee_id}_{day.isoformat()}"
+
+
+def record_usage(pipe: Pipeline, employee_id: int, rows: list[dict]) -> None:
+    """
+    Queue counter increments for freshly committed AppUsage rows on a
+    pipeline, so they land in the same MULTI as the chunk acknowledgement
+    """
+    totals: dict[date, dict[str, int]] = {}
+    for row in rows:
+        apps = totals.setdefault(row["timestamp"].date(), {})
+        apps[row["app"]] = apps.get(row["app"], 0) + int(row["duration"])
+
+    now = time.time()
+    for day, apps in totals.items():
+        key = live_stats_key(employee_id, day)
+        pipe.hincrby(key, "total", sum(apps.values()))
+        for app_name, duration in apps.items():
+            pipe.hincrby(key, f"app:{app_name}", duration)
+        pipe.hset(key, "updated_at", now)
+        pipe.expire(key, STATS_TTL_SECONDS)
+
+
+async def record_stop(r: Redis, employee_id: int, idle_seconds: int) -> None:
+    """Count idle time drained at stop_tracking and mark the day as attended"""
+    key = live_stats_key(employee_id, date.today())
+    async with r.pipeline(transaction=True) as pipe:
+        if idle_seconds:
+            pipe.hincrby(key, "idle", idle_seconds)
+        pipe.hset(key, mapping={"attendance": "present", "updated_at": time.time()})
+        pipe.expire(key, STATS_TTL_SECONDS)
+        await pipe.execute()
+
+
+async def read_live_stats(r: Redis, employee_id: int, stats: DashboardStats | None) -> dict | None:
+    """
+    Today's dashboard stats from the redis counters, or None when the
+    counters are missing or behind the durable DashboardStats row
+    (e.g. after a redis restart) and the row should be served instead
+    """
+    counters = await r.hgetall(live_stats_key(employee_id, date.today()))
+    if not counters:
+        return None
+
+    apps = {
+        field[4:]: int(value)
+        for field, value in counters.items()
+        if field.startswith("app:")
+    }
+    total = int(counters.get("total", 0))
+
+    durable_apps = json.loads(stats.apps_used) if stats and stats.apps_used else {}
+    durable_total = sum(app_data.get("duration", 0) for app_data in durable_apps.values())
+    if total < durable_total:
+        return None
+
+    idle = int(counters.get("idle", 0))
+    if stats:
+        idle = max(idle, round(stats.idle_hours * 3600))
+
+    apps_list = [
+        {
+            "app_name": app_name,
+            "duration": duration,
+            "percentage": round(duration / total * 100, 2) if total > 0 else 0,
+            "hours": round(duration / 3600, 2)
+        }
+        for app_name, duration in sorted(apps.items(), key=lambda a: a[1], reverse=True)
+    ]
+
+    updated_at = counters.get("updated_at")
+    attendance_status = counters.get("attendance")
+    if not attendance_status:
+        attendance_status = stats.attendance_status if stats else "not_marked"
+
+    return {
+        "today": {
+            "hours": round(total / 3600, 2),
+            "idle_hours": round(idle / 3600, 2),
+            "idle_percentage": round(idle / total * 100, 2) if total > 0 else 0,
+            "apps": apps_list
+        },
+        "attendance_status": attendance_status,
+        "pending_applications": stats.pending_applications if stats else 0,
+        "last_updated": datetime.utcfromtimestamp(float(updated_at)).isoformat() if updated_at else None
+    }
@@ -1,12 +1,15 @@
 from fastapi import FastAPI, status
-from sqlmodel import SQLModel
 from data import engine
+from migrations import check_schema
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from api.employee import router as employee
 from api.admin import router as admin
 from api.auth_route import router as auth_route
+from sockets.ws import router as ws_router
+from api.employee import r as redis_client
+from usage_queue import recover_processing
 from pathlib import Path
 import os
 from fastapi.staticfiles import StaticFiles
@@ -20,6 +23,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count"],
 )
 
 @app.exception_handler(RequestValidationError)
@@ -34,8 +38,14 @@ async def validation_exception_handler(request, exc):
 app.include_router(employee, prefix="/employee", tags=["Employee"])
 app.include_router(auth_route, prefix="/auth", tags=["Authentication"])
 app.include_router(admin, prefix="/admin", tags=["Admin"])
+app.include_router(ws_router, tags=["WebSocket"])
 
-#  Create tables on startup
+#  Refuse to start on an outdated schema; run `python migrations.py upgrade`
 @app.on_event("startup")
 def on_startup() -> None:
-    SQLModel.metadata.create_all(engine)
\ No newline at end of file
+    check_schema(engine)
+
+#  Replay usage chunks orphaned by drains that died before acknowledging them
+@app.on_event("startup")
+async def recover_usage_queues() -> None:
+    await recover_processing(redis_client)
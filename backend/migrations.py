@@ -0,0 +1,244 @@
+"""
+Versioned schema migrations
+
+    python migrations.py status
+    python migrations.py upgrade [version]
+    python migrations.py downgrade <version>
+
+Migrations must be safe to run against a database that already has some
+of their objects: the baseline creates missing tables from the current
+models, so later steps check before adding anything.
+"""
+import sys
+from sqlalchemy import Engine, Connection, inspect, text
+from sqlmodel import SQLModel
+import model  # noqa: F401  registers every table on SQLModel.metadata
+from data import engine
+
+VERSION_TABLE = "schema_version"
+
+
+def create_index(conn: Connection, name: str, table: str, columns: list[str], unique: bool = False) -> None:
+    """
+    Create an index without blocking writes where the database allows it.
+    PostgreSQL builds it CONCURRENTLY, which has to happen outside of a
+    transaction, so whatever the migration did so far is committed first;
+    SQLite has no online builds and locks for the duration.
+    """
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    cols = ", ".join(f'"{column}"' for column in columns)
+    if conn.dialect.name == "postgresql":
+        conn.commit()
+        with conn.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as ddl:
+            ddl.execute(text(f'CREATE {kind} CONCURRENTLY IF NOT EXISTS {name} ON "{table}" ({cols})'))
+    else:
+        conn.execute(text(f'CREATE {kind} IF NOT EXISTS {name} ON "{table}" ({cols})'))
+
+
+def drop_index(conn: Connection, name: str) -> None:
+    if conn.dialect.name == "postgresql":
+        conn.commit()
+        with conn.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as ddl:
+            ddl.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    else:
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+
+def add_column(conn: Connection, table: str, column: str, ddl_type: str) -> None:
+    """Add a nullable column unless the table already has it"""
+    existing = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column not in existing:
+        conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {ddl_type}'))
+
+
+def drop_column(conn: Connection, table: str, column: str) -> None:
+    existing = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column in existing:
+        conn.execute(text(f'ALTER TABLE "{table}" DROP COLUMN "{column}"'))
+
+
+def create_tables(conn: Connection, names: list[str]) -> None:
+    SQLModel.metadata.create_all(conn, tables=[SQLModel.metadata.tables[n] for n in names])
+
+
+def drop_tables(conn: Connection, names: list[str]) -> None:
+    # One table at a time: drop_all on PostgreSQL also drops every enum
+    # type in the metadata, including ones tables outside `names` still use
+    for table in reversed(SQLModel.metadata.sorted_tables):
+        if table.name in names:
+            table.drop(conn, checkfirst=True)
+
+
+# 0001 - tables as they were before versioned migrations existed
+BASELINE_TABLES = [
+    "user", "timesheet", "attendance", "screenshots", "appusage", "projects",
+    "applications", "projectemployee", "tasks", "dashboardstats"
+]
+
+def baseline_up(conn: Connection) -> None:
+    create_tables(conn, BASELINE_TABLES)
+
+def baseline_down(conn: Connection) -> None:
+    drop_tables(conn, BASELINE_TABLES)
+
+
+# 0002 - high-water mark for incremental dashboard stats
+def stats_checkpoint_up(conn: Connection) -> None:
+    create_tables(conn, ["statscheckpoint"])
+
+def stats_checkpoint_down(conn: Connection) -> None:
+    drop_tables(conn, ["statscheckpoint"])
+
+
+# 0003 - indexes on the hot tracking-table filters
+TRACKING_INDEXES = [
+    ("ix_appusage_employee_id_timestamp", "appusage", ["employee_id", "timestamp"], False),
+    ("ix_appusage_timesheet_id", "appusage", ["timesheet_id"], False),
+    ("ix_appusage_timestamp", "appusage", ["timestamp"], False),
+    ("ix_timesheet_employee_id_work_date", "timesheet", ["employee_id", "work_date"], False),
+    ("ix_timesheet_work_date", "timesheet", ["work_date"], False),
+    ("ix_attendance_employee_id_current_date", "attendance", ["employee_id", "current_date"], False),
+    ("ix_screenshots_employee_id_timestamp", "screenshots", ["employee_id", "timestamp"], False),
+    ("ix_dashboardstats_stats_date", "dashboardstats", ["stats_date"], False),
+    ("uq_dashboardstats_employee_id_stats_date", "dashboardstats", ["employee_id", "stats_date"], True),
+]
+
+def tracking_indexes_up(conn: Connection) -> None:
+    # Keep only the newest stats row per employee and day so the unique index can be built
+    conn.execute(text(
+        "DELETE FROM dashboardstats WHERE id NOT IN "
+        "(SELECT MAX(id) FROM dashboardstats GROUP BY employee_id, stats_date)"
+    ))
+    for name, table, columns, unique in TRACKING_INDEXES:
+        create_index(conn, name, table, columns, unique)
+
+def tracking_indexes_down(conn: Connection) -> None:
+    for name, *_ in TRACKING_INDEXES:
+        drop_index(conn, name)
+
+
+# 0004 - compressed and thumbnail variants of each screenshot
+SCREENSHOT_VARIANT_COLUMNS = ["compressed_path", "thumbnail_path"]
+
+def screenshot_variants_up(conn: Connection) -> None:
+    for column in SCREENSHOT_VARIANT_COLUMNS:
+        add_column(conn, "screenshots", column, "VARCHAR")
+
+def screenshot_variants_down(conn: Connection) -> None:
+    for column in SCREENSHOT_VARIANT_COLUMNS:
+        drop_column(conn, "screenshots", column)
+
+
+# 0005 - content-addressed screenshot storage
+def screenshot_blobs_up(conn: Connection) -> None:
+    create_tables(conn, ["screenshotblob"])
+    add_column(conn, "screenshots", "content_hash", "VARCHAR")
+    create_index(conn, "ix_screenshots_content_hash", "screenshots", ["content_hash"])
+
+def screenshot_blobs_down(conn: Connection) -> None:
+    drop_index(conn, "ix_screenshots_content_hash")
+    drop_column(conn, "screenshots", "content_hash")
+    drop_tables(conn, ["screenshotblob"])
+
+
+# 0006 - ids seen by the stats job, folded in once their writers have committed
+STATS_SEEN_COLUMNS = [("seen_usage_id", "INTEGER"), ("seen_at", "TIMESTAMP")]
+
+def stats_seen_up(conn: Connection) -> None:
+    for column, ddl_type in STATS_SEEN_COLUMNS:
+        add_column(conn, "statscheckpoint", column, ddl_type)
+
+def stats_seen_down(conn: Connection) -> None:
+    for column, _ in STATS_SEEN_COLUMNS:
+        drop_column(conn, "statscheckpoint", column)
+
+
+# 0007 - queued usage events are inserted once, however often they are replayed
+def usage_event_ids_up(conn: Connection) -> None:
+    add_column(conn, "appusage", "event_id", "VARCHAR")
+    create_index(conn, "uq_appusage_event_id", "appusage", ["event_id"], unique=True)
+
+def usage_event_ids_down(conn: Connection) -> None:
+    drop_index(conn, "uq_appusage_event_id")
+    drop_column(conn, "appusage", "event_id")
+
+
+MIGRATIONS = [
+    (1, "baseline", baseline_up, baseline_down),
+    (2, "stats_checkpoint", stats_checkpoint_up, stats_checkpoint_down),
+    (3, "tracking_indexes", tracking_indexes_up, tracking_indexes_down),
+    (4, "screenshot_variants", screenshot_variants_up, screenshot_variants_down),
+    (5, "screenshot_blobs", screenshot_blobs_up, screenshot_blobs_down),
+    (6, "stats_seen", stats_seen_up, stats_seen_down),
+    (7, "usage_event_ids", usage_event_ids_up, usage_event_ids_down),
+]
+
+HEAD = MIGRATIONS[-1][0]
+
+
+def current_version(engine: Engine) -> int:
+    if not inspect(engine).has_table(VERSION_TABLE):
+        return 0
+    with engine.connect() as conn:
+        return conn.execute(text(f"SELECT MAX(version) FROM {VERSION_TABLE}")).scalar() or 0
+
+
+def set_version(conn: Connection, version: int) -> None:
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (version INTEGER NOT NULL)"))
+    conn.execute(text(f"DELETE FROM {VERSION_TABLE}"))
+    conn.execute(text(f"INSERT INTO {VERSION_TABLE} (version) VALUES (:version)"), {"version": version})
+
+
+def upgrade(engine: Engine, target: int = HEAD) -> list[str]:
+    """Apply every migration above the current version up to `target`"""
+    applied = []
+    current = current_version(engine)
+    for version, name, up, _ in MIGRATIONS:
+        if current < version <= target:
+            with engine.connect() as conn:
+                up(conn)
+                set_version(conn, version)
+                conn.commit()
+            applied.append(f"{version:04d}_{name}")
+    return applied
+
+
+def downgrade(engine: Engine, target: int) -> list[str]:
+    """Roll back every applied migration above `target`, newest first"""
+    reverted = []
+    current = current_version(engine)
+    for version, name, _, down in reversed(MIGRATIONS):
+        if target < version <= current:
+            with engine.connect() as conn:
+                down(conn)
+                set_version(conn, version - 1)
+                conn.commit()
+            reverted.append(f"{version:04d}_{name}")
+    return reverted
+
+
+def check_schema(engine: Engine) -> None:
+    """Refuse to start against a database that is not at the latest migration"""
+    current = current_version(engine)
+    if current != HEAD:
+        raise RuntimeError(
+            f"Database schema is at version {current}, expected {HEAD}. "
+            "Run `python migrations.py upgrade` before starting the API"
+        )
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+
+    if command == "status":
+        print(f"current: {current_version(engine)}, head: {HEAD}")
+    elif command == "upgrade":
+        target = int(sys.argv[2]) if len(sys.argv) > 2 else HEAD
+        for name in upgrade(engine, target):
+            print(f"applied {name}")
+    elif command == "downgrade" and len(sys.argv) > 2:
+        for name in downgrade(engine, int(sys.argv[2])):
+            print(f"reverted {name}")
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -1,5 +1,6 @@
 from datetime import datetime, date
 from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Index
 from pydantic import field_validator 
 import re
 from typing import Optional
@@ -36,6 +37,10 @@ class TimesheetStatus(str,Enum):
 
     
 class Timesheet(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_timesheet_employee_id_work_date", "employee_id", "work_date"),
+        Index("ix_timesheet_work_date", "work_date"),
+    )
     
     id: Optional[int] = Field(default=None, primary_key=True)
     employee_id: int = Field(foreign_key="user.id")
@@ -80,29 +85,57 @@ class AttendanceStatus(str,Enum):
     LEAVE = "leave"
     
 class Attendance(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_attendance_employee_id_current_date", "employee_id", "current_date"),
+    )
     id : int = Field(default = None, primary_key=True)
     employee_id : int = Field(foreign_key="user.id")
     current_date : date = Field(default = date.today(), nullable = False)
     status : AttendanceStatus = Field(default = AttendanceStatus.ABSENT, nullable=False)
     
+class ScreenshotBlob(SQLModel, table=True):
+    # One stored image, shared by every screenshot with the same content
+    content_hash : str = Field(primary_key=True)
+    filepath : str
+    size_bytes : int = Field(default=0)
+    ref_count : int = Field(default=0)
+    phash : Optional[str] = Field(default=None, nullable=True)
+    created_at : datetime = Field(default_factory=datetime.utcnow)
+
 class Screenshots(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_screenshots_employee_id_timestamp", "employee_id", "timestamp"),
+        Index("ix_screenshots_content_hash", "content_hash"),
+    )
     id : int = Field(default = None, primary_key=True)
     employee_id : int = Field(foreign_key="user.id")
     timesheet_id : int = Field(foreign_key="timesheet.id")
     filepath : str = Field(default=None)
     timestamp : date = Field(default = date.today(), nullable = False)   
+    # Filled in by tasks.process_screenshot once the variants exist
+    compressed_path : Optional[str] = Field(default=None, nullable=True)
+    thumbnail_path : Optional[str] = Field(default=None, nullable=True)
+    # sha256 of the stored image; NULL for uploads from before deduplication
+    content_hash : Optional[str] = Field(default=None, nullable=True)
 
 class AppUsage(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_appusage_employee_id_timestamp", "employee_id", "timestamp"),
+        Index("ix_appusage_timesheet_id", "timesheet_id"),
+        Index("ix_appusage_timestamp", "timestamp"),
+        Index("uq_appusage_event_id", "event_id", unique=True),
+    )
     id : int = Field(default = None, primary_key=True)
     employee_id : int = Field(foreign_key="user.id") 
     timesheet_id: Optional[int] = Field(
         default=None,
         foreign_key="timesheet.id"
     )
-    role : str = Field(foreign_key="user.role")
+    role : str = Field(nullable=False)  # Copied from user.role, which is not unique
     app : Optional[str] = Field(default=None, nullable=False)
     duration : Optional[int] = Field(default=None, nullable=False)
     timestamp: Optional[datetime] = Field(default_factory=datetime.utcnow)
+    event_id: Optional[str] = Field(default=None, nullable=True)  # Queued event it came from
     
     @field_validator("duration")
     @classmethod
@@ -166,10 +199,14 @@ class Tasks(SQLModel, table=True):
 
 
 class DashboardStats(SQLModel, table=True):
+    __table_args__ = (
+        Index("uq_dashboardstats_employee_id_stats_date", "employee_id", "stats_date", unique=True),
+        Index("ix_dashboardstats_stats_date", "stats_date"),
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
     employee_id: int = Field(foreign_key="user.id")
-    role : str = Field(foreign_key="user.role")
+    role : str = Field(nullable=False)  # Copied from user.role, which is not unique
     stats_date: date = Field(nullable=False)  # Date for which stats are calculated
     total_hours: float = Field(default=0)  # Total hours tracked
     idle_hours: float = Field(default=0)  # Total idle hours
@@ -178,4 +215,14 @@ class DashboardStats(SQLModel, table=True):
     attendance_status: Optional[str] = Field(default=None)  # present/absent/leave
     pending_applications: int = Field(default=0)  # Count of pending applications
     calculated_at: datetime = Field(default_factory=datetime.utcnow)
-    updated_at: datetime = Field(default_factory=datetime.utcnow)
\ No newline at end of file
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class StatsCheckpoint(SQLModel, table=True):
+
+    name: str = Field(primary_key=True)  # Which job the checkpoint belongs to
+    stats_date: date = Field(nullable=False)  # Day the folded totals belong to
+    last_usage_id: int = Field(default=0)  # Highest AppUsage.id already folded in
+    seen_usage_id: Optional[int] = Field(default=None)  # Highest AppUsage.id at seen_at
+    seen_at: Optional[datetime] = Field(default=None)  # When seen_usage_id was read
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
@@ -0,0 +1,50 @@
+from decouple import config
+from fastapi import Query, Response
+from sqlmodel import Session, select, func
+
+# Rows per page when the client does not ask for a size, and the most it may ask for
+DEFAULT_PAGE_SIZE: int = config('DEFAULT_PAGE_SIZE', cast=int, default=200)
+MAX_PAGE_SIZE: int = config('MAX_PAGE_SIZE', cast=int, default=1000)
+
+# Response headers; bodies stay plain arrays so existing clients keep working
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+TOTAL_COUNT_HEADER = "X-Total-Count"
+
+
+class PageParams():
+    """
+    limit/cursor/with_total query parameters shared by the list endpoints.
+    `cursor` is the X-Next-Cursor value of the previous page.
+    """
+    def __init__(self,
+                 limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                 cursor: int | None = Query(None),
+                 with_total: bool = Query(False)):
+        self.limit = limit
+        self.cursor = cursor
+        self.with_total = with_total
+
+
+def paginate(session: Session, statement, id_column, response: Response,
+             page: PageParams, descending: bool = True) -> list:
+    """
+    Run `statement` one keyset page at a time, ordered by `id_column`.
+    Pages continue from the cursor with a WHERE on the id instead of an
+    OFFSET, so every page costs the same however deep it is. The next
+    cursor goes in X-Next-Cursor when there are more rows, and the total
+    in X-Total-Count, but only when with_total asks for the extra COUNT.
+    """
+    if page.with_total:
+        total = session.exec(select(func.count()).select_from(statement.subquery())).one()
+        response.headers[TOTAL_COUNT_HEADER] = str(total)
+
+    if page.cursor is not None:
+        statement = statement.where(id_column < page.cursor if descending else id_column > page.cursor)
+    statement = statement.order_by(id_column.desc() if descending else id_column.asc())
+    # One extra row tells whether another page exists
+    rows = session.exec(statement.limit(page.limit + 1)).all()
+
+    if len(rows) > page.limit:
+        rows = rows[:page.limit]
+        response.headers[NEXT_CURSOR_HEADER] = str(getattr(rows[-1], id_column.key))
+    return rows
@@ -94,6 +94,9 @@ class UsageCreate(SQLModel):
     idle_duration: Optional[int] = None
     timestamp: datetime
 
+class RefreshToken(SQLModel):
+    refresh_token: str
+
 class ApplicationRview(SQLModel):
     app_id: int
     status: str
\ No newline at end of file
@@ -0,0 +1,253 @@
+import asyncio
+import hashlib
+import io
+from datetime import date, datetime
+from pathlib import Path
+from uuid import uuid4
+from decouple import config
+from fastapi import UploadFile
+from PIL import Image, UnidentifiedImageError
+from redis.asyncio import Redis
+from sqlalchemy import insert, update, delete
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from data import upsert
+from model import Timesheet, ScreenshotBlob
+from storage import storage, STORAGE_DIR
+
+# Largest screenshot accepted, in bytes
+MAX_SCREENSHOT_BYTES: int = config('MAX_SCREENSHOT_BYTES', cast=int, default=10 * 1024 * 1024)
+# Bytes read from the upload and written to disk per step
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# Cached timesheet ids outlive their day by an hour, then expire
+TIMESHEET_CACHE_TTL = 25 * 3600
+# Uploads are hashed into BLOB_DIR/ab/cd/<sha256>.png and stored once
+BLOB_DIR = "blobs"
+# Uploads are spooled here before they go to storage; on the same
+# filesystem as local storage so moving them in is a rename
+UPLOAD_TMP_DIR = STORAGE_DIR / "tmp"
+# Screenshots whose perceptual hash is within this many bits of the previous
+# one in the same timesheet reuse its image; 0 only collapses exact copies
+SCREENSHOT_DEDUP_DISTANCE: int = config('SCREENSHOT_DEDUP_DISTANCE', cast=int, default=0)
+# Format and quality of the variants made in the background; AVIF needs
+# a Pillow build with AVIF support
+SCREENSHOT_FORMAT: str = config('SCREENSHOT_FORMAT', cast=str, default='WEBP').upper()
+SCREENSHOT_QUALITY: int = config('SCREENSHOT_QUALITY', cast=int, default=80)
+THUMBNAIL_WIDTH: int = config('THUMBNAIL_WIDTH', cast=int, default=320)
+THUMBNAIL_QUALITY: int = config('THUMBNAIL_QUALITY', cast=int, default=60)
+# Delete the PNG once its compressed variant is written
+SCREENSHOT_KEEP_ORIGINAL: bool = config('SCREENSHOT_KEEP_ORIGINAL', cast=bool, default=True)
+
+MEDIA_TYPES = {".png": "image/png", ".webp": "image/webp", ".avif": "image/avif"}
+
+
+class ScreenshotTooLarge(Exception):
+    pass
+
+
+def today_timesheet_key(employee_id: int, day: date) -> str:
+    return f"timesheet_today_{employee_id}_{day.isoformat()}"
+
+
+async def cache_timesheet_id(r: Redis, employee_id: int, timesheet_id: int) -> None:
+    """Remember today's timesheet so uploads can skip the lookup"""
+    await r.set(today_timesheet_key(employee_id, date.today()), timesheet_id, ex=TIMESHEET_CACHE_TTL)
+
+
+async def today_timesheet_id(r: Redis, session: AsyncSession, employee_id: int) -> int | None:
+    """Today's timesheet id from redis, falling back to the database"""
+    cached = await r.get(today_timesheet_key(employee_id, date.today()))
+    if cached:
+        return int(cached)
+
+    timesheet_id = (await session.exec(
+        select(Timesheet.id).where(Timesheet.employee_id == employee_id,
+                                   Timesheet.work_date == date.today()))).first()
+    if timesheet_id is not None:
+        await cache_timesheet_id(r, employee_id, timesheet_id)
+    return timesheet_id
+
+
+async def save_upload(file: UploadFile, max_bytes: int = MAX_SCREENSHOT_BYTES) -> tuple[Path, int, str]:
+    """
+    Copy an upload to a temporary file chunk by chunk without blocking the
+    event loop, hashing it on the way. Raises ScreenshotTooLarge as soon as
+    more than `max_bytes` have been read and ValueError for an empty
+    upload. Returns the temporary path, the size and the sha256 of the content.
+    """
+    await asyncio.to_thread(UPLOAD_TMP_DIR.mkdir, parents=True, exist_ok=True)
+    tmp_path = UPLOAD_TMP_DIR / f"{uuid4().hex}.tmp"
+    f = await asyncio.to_thread(open, tmp_path, "wb")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise ScreenshotTooLarge()
+            digest.update(chunk)
+            await asyncio.to_thread(f.write, chunk)
+        if not size:
+            raise ValueError("Empty upload")
+        await asyncio.to_thread(f.close)
+    except BaseException:
+        await asyncio.to_thread(f.close)
+        await asyncio.to_thread(tmp_path.unlink, missing_ok=True)
+        raise
+    return tmp_path, size, digest.hexdigest()
+
+
+def blob_path(content_hash: str) -> str:
+    return f"{BLOB_DIR}/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.png"
+
+
+def store_blob(tmp_path: Path, content_hash: str) -> str:
+    """
+    Move an upload into the content-addressed store, or drop it if the same
+    bytes are already stored. Readers never see a partial image. Returns
+    the blob's storage key.
+    """
+    key = blob_path(content_hash)
+    if storage.exists(key):
+        tmp_path.unlink(missing_ok=True)
+        return key
+    storage.put_file(key, tmp_path)
+    return key
+
+
+def check_image(path: Path) -> None:
+    """Raises UnidentifiedImageError unless Pillow recognises the file; reads only the header"""
+    with Image.open(path):
+        pass
+
+
+def perceptual_hash(path: Path) -> int:
+    """64-bit difference hash; near-identical images differ in a few bits"""
+    with Image.open(path) as image:
+        small = image.convert("L").resize((9, 8), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = bits << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
+
+
+def last_screenshot_key(timesheet_id: int) -> str:
+    return f"screenshot_last_{timesheet_id}"
+
+
+async def near_duplicate(r: Redis, timesheet_id: int, tmp_path: Path,
+                         content_hash: str) -> tuple[str, str | None]:
+    """
+    Collapse a screenshot into the previous one of its timesheet when their
+    perceptual hashes are within SCREENSHOT_DEDUP_DISTANCE bits. Returns the
+    content hash to store the screenshot under and the upload's perceptual
+    hash as hex (None when near-duplicate detection is off).
+    """
+    if SCREENSHOT_DEDUP_DISTANCE <= 0:
+        return content_hash, None
+
+    phash = await asyncio.to_thread(perceptual_hash, tmp_path)
+    key = last_screenshot_key(timesheet_id)
+    last = await r.hgetall(key)
+    if last and (phash ^ int(last["phash"], 16)).bit_count() <= SCREENSHOT_DEDUP_DISTANCE:
+        return last["content_hash"], last["phash"]
+
+    await r.hset(key, mapping={"content_hash": content_hash, "phash": f"{phash:016x}"})
+    await r.expire(key, TIMESHEET_CACHE_TTL)
+    return content_hash, f"{phash:016x}"
+
+
+def add_blob_ref(session: Session, content_hash: str, filepath: str, size_bytes: int,
+                 phash: str | None = None) -> None:
+    """
+    Count one more screenshot pointing at a blob, creating its row if new.
+    A single upsert, so concurrent uploads of the same image cannot both
+    insert the row or lose an increment.
+    """
+    row = {"content_hash": content_hash, "filepath": filepath, "size_bytes": size_bytes,
+           "phash": phash, "ref_count": 1, "created_at": datetime.utcnow()}
+    if upsert(session, ScreenshotBlob, [row], ["content_hash"], [],
+              set_values={"ref_count": ScreenshotBlob.ref_count + 1}):
+        return
+
+    result = session.execute(update(ScreenshotBlob)
+                             .where(ScreenshotBlob.content_hash == content_hash)
+                             .values(ref_count=ScreenshotBlob.ref_count + 1))
+    if result.rowcount == 0:
+        session.execute(insert(ScreenshotBlob), [row])
+
+
+def release_blob(session: Session, content_hash: str, count: int = 1) -> list[str]:
+    """
+    Drop `count` references to a blob when screenshot rows pointing at it
+    are deleted, and its row once nothing points at it. Returns the storage
+    keys of the blob and its variants to delete after the commit, so a
+    rolled back delete never loses files.
+    """
+    session.execute(update(ScreenshotBlob)
+                    .where(ScreenshotBlob.content_hash == content_hash)
+                    .values(ref_count=ScreenshotBlob.ref_count - count))
+    # Locked by the UPDATE until commit, so the count read here is final
+    unused = (ScreenshotBlob.content_hash == content_hash, ScreenshotBlob.ref_count <= 0)
+    filepath = session.exec(select(ScreenshotBlob.filepath).where(*unused)).first()
+    if filepath is None:
+        return []
+    session.execute(delete(ScreenshotBlob).where(*unused))
+    stem = Path(filepath)
+    suffix = f".{SCREENSHOT_FORMAT.lower()}"
+    return [key.as_posix() for key in (stem, stem.with_suffix(suffix), stem.with_name(f"{stem.stem}_thumb{suffix}"))]
+
+
+def encode_image(image: Image.Image, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format=SCREENSHOT_FORMAT, quality=quality)
+    return buffer.getvalue()
+
+
+def make_variants(filepath: str) -> tuple[str, str]:
+    """
+    Store a compressed copy and a thumbnail of the screenshot stored under
+    `filepath`, next to it. Returns their storage keys.
+    """
+    suffix = f".{SCREENSHOT_FORMAT.lower()}"
+    compressed = Path(filepath).with_suffix(suffix).as_posix()
+    thumbnail = Path(filepath).with_name(f"{Path(filepath).stem}_thumb{suffix}").as_posix()
+    variant_type = media_type(compressed)
+
+    # Blobs are shared, so another screenshot may have made these already
+    if not (storage.exists(compressed) and storage.exists(thumbnail)):
+        with Image.open(io.BytesIO(storage.get_bytes(filepath))) as image:
+            image = image.convert("RGB")
+            storage.put_bytes(compressed, encode_image(image, SCREENSHOT_QUALITY), variant_type)
+            image.thumbnail((THUMBNAIL_WIDTH, THUMBNAIL_WIDTH * 4))
+            storage.put_bytes(thumbnail, encode_image(image, THUMBNAIL_QUALITY), variant_type)
+
+    if not SCREENSHOT_KEEP_ORIGINAL:
+        storage.delete(filepath)
+    return compressed, thumbnail
+
+
+def screenshot_key(screenshot, variant: str = "full") -> str | None:
+    """
+    Storage key of the requested variant: "thumb", "full" (the compressed
+    copy) or "original". Falls back to the next best file while the
+    variants are still being made or once the original has been dropped.
+    Decided from the row alone, so serving costs no storage round trip.
+    """
+    original = [screenshot.filepath] if SCREENSHOT_KEEP_ORIGINAL else []
+    candidates = {
+        "thumb": [screenshot.thumbnail_path, screenshot.compressed_path, screenshot.filepath],
+        "full": [screenshot.compressed_path, screenshot.filepath],
+        "original": original + [screenshot.compressed_path, screenshot.filepath],
+    }.get(variant, [])
+    for key in candidates:
+        if key:
+            # Clean the path just in case the DB stored it weirdly
+            return key.replace("screenshots/", "").replace("screenshots\\", "")
+    return None
+
+
+def media_type(key: str) -> str:
+    return MEDIA_TYPES.get(Path(key).suffix.lower(), "application/octet-stream")
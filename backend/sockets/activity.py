@@ -0,0 +1,18 @@
+import json
+import time
+from redis.asyncio import Redis
+
+# Deltas for the admin live activity stream; every worker relays them
+# to the admin sockets it holds
+ADMIN_ACTIVITY_CHANNEL = "activity:admin"
+
+
+async def publish_activity(r: Redis, event: str, **fields) -> None:
+    """Publish one activity delta, e.g. publish_activity(r, "timesheet_started", employee_id=1)"""
+    # The stream is best effort; never fail the request that caused the event
+    try:
+        await r.publish(ADMIN_ACTIVITY_CHANNEL, json.dumps(
+            {"event": event, "at": time.time(), **fields}, default=str
+        ))
+    except Exception as e:
+        print(f"activity publish error: {e}")
@@ -1,48 +1,200 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from sqlmodel import Session
-from data import get_session
+from data import engine
 from redis.asyncio import Redis
+from uuid import uuid4
 
 import asyncio
+import json
+import os
+import socket
+import time
 from auth.ws_auth import get_current_ws
+from sockets.activity import ADMIN_ACTIVITY_CHANNEL
 
 router = APIRouter()
 r = Redis(host='localhost', port=6379, db=0, decode_responses=True)
+
+# Connections are presumed gone this long after their last heartbeat
+PRESENCE_TTL = 30
+PRESENCE_HEARTBEAT = 10
+# A socket that takes longer than this to accept a message is dropped
+SEND_TIMEOUT = 5
+
+def presence_key(email:str, conn_id:str) -> str:
+    return f"presence:{email}:{conn_id}"
+
+def routes_key(email:str) -> str:
+    # Sorted set of "<worker>:<connection>" scored by expiry time
+    return f"ws_routes:{email}"
+
+def worker_channel(worker_id:str) -> str:
+    return f"ws_worker:{worker_id}"
+
 class WSConnectionManager():
+    """
+    Keeps this worker's sockets and tells the other workers where they are.
+    Every connection has a presence key and an entry in its user's routing
+    table, both refreshed by a heartbeat and left to expire if the worker
+    dies. Notifications are published only to the channels of workers
+    that hold a socket for the user, and each worker feeds its sockets from
+    one subscriber on its own channel, so idle sockets cost nothing.
+    The same subscriber relays the admin activity channel to the admin
+    live-stream sockets this worker holds.
+    """
     def __init__(self):
-        self.connections : dict[str, WebSocket] = {}
-        self.redis = None
-    async def init_redis(self):
-        if not self.redis:
-            self.redis = await r.from_url('redis://localhost')
-    async def connect(self, email:str, websocket: WebSocket ):
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:6]}"
+        self.connections : dict[str, dict[str, WebSocket]] = {}
+        self.admin_streams : dict[str, WebSocket] = {}
+        self.redis = r
+        self.tasks : list[asyncio.Task] = []
+    async def start(self):
+        if not self.tasks or any(task.done() for task in self.tasks):
+            for task in self.tasks:
+                task.cancel()
+            self.tasks = [asyncio.create_task(self.listen()), asyncio.create_task(self.heartbeat())]
+    async def listen(self):
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(worker_channel(self.worker_id), ADMIN_ACTIVITY_CHANNEL)
+                async for msg in pubsub.listen():
+                    if msg["type"] != "message":
+                        continue
+                    if msg["channel"] == ADMIN_ACTIVITY_CHANNEL:
+                        await self.send_activity(msg["data"])
+                        continue
+                    payload = json.loads(msg["data"])
+                    await self.send_notification(payload["email"], payload["message"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Lost the redis connection; resubscribe shortly
+                print(f"ws listener error: {e}")
+            finally:
+                # Release the old subscription before making a new one
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+            await asyncio.sleep(1)
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(PRESENCE_HEARTBEAT)
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for email, sockets in self.connections.items():
+                        for conn_id in sockets:
+                            self.register(pipe, email, conn_id)
+                    await pipe.execute()
+            except Exception as e:
+                print(f"ws heartbeat error: {e}")
+    def register(self, pipe, email:str, conn_id:str):
+        route = f"{self.worker_id}:{conn_id}"
+        pipe.set(presence_key(email, conn_id), self.worker_id, ex=PRESENCE_TTL)
+        pipe.zadd(routes_key(email), {route: time.time() + PRESENCE_TTL})
+        pipe.expire(routes_key(email), PRESENCE_TTL)
+    async def connect(self, email:str, websocket: WebSocket ) -> str:
         await websocket.accept()
-        self.connections[email] = websocket
-        await self.redis.sadd("Online users", email)
-    async def disconnect(self, email:str):
-        self.connections.pop(email, None)
-        await self.redis.srem("Online users",email)
+        conn_id = uuid4().hex
+        self.connections.setdefault(email, {})[conn_id] = websocket
+        async with self.redis.pipeline(transaction=False) as pipe:
+            self.register(pipe, email, conn_id)
+            await pipe.execute()
+        return conn_id
+    async def disconnect(self, email:str, conn_id:str):
+        sockets = self.connections.get(email, {})
+        sockets.pop(conn_id, None)
+        if not sockets:
+            self.connections.pop(email, None)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.delete(presence_key(email, conn_id))
+            pipe.zrem(routes_key(email), f"{self.worker_id}:{conn_id}")
+            await pipe.execute()
     async def send_notification(self, email:str, message:str):
-        if email in self.connections:
-            await self.connections[email].send_json({"message": message} )       
+        # Sent to every socket at once so one slow client can't hold up the rest
+        sockets = list(self.connections.get(email, {}).items())
+        results = await asyncio.gather(
+            *(asyncio.wait_for(websocket.send_json({"message": message}), SEND_TIMEOUT)
+              for _, websocket in sockets),
+            return_exceptions=True)
+        for (conn_id, _), result in zip(sockets, results):
+            if isinstance(result, Exception):
+                await self.disconnect(email, conn_id)
+
+    async def send_activity(self, event:str):
+        streams = list(self.admin_streams.items())
+        results = await asyncio.gather(
+            *(asyncio.wait_for(websocket.send_text(event), SEND_TIMEOUT)
+              for _, websocket in streams),
+            return_exceptions=True)
+        for (conn_id, _), result in zip(streams, results):
+            if isinstance(result, Exception):
+                self.admin_streams.pop(conn_id, None)
+
+manager = WSConnectionManager()
 
-manager = WSConnectionManager()                        
+async def live_workers(email:str) -> set[str]:
+    """Workers currently holding at least one socket for the user"""
+    now = time.time()
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.zremrangebyscore(routes_key(email), "-inf", now)
+        pipe.zrangebyscore(routes_key(email), now, "+inf")
+        _, routes = await pipe.execute()
+    return {route.rsplit(":", 1)[0] for route in routes}
+
+async def is_online(email:str) -> bool:
+    return bool(await live_workers(email))
+
+async def notify(email:str, message:str) -> int:
+    """Deliver a message to every socket of a user, whichever worker holds it"""
+    workers = await live_workers(email)
+    payload = json.dumps({"email": email, "message": message})
+    async with r.pipeline(transaction=False) as pipe:
+        for worker_id in workers:
+            pipe.publish(worker_channel(worker_id), payload)
+        await pipe.execute()
+    return len(workers)
 
 @router.websocket('/ws')
 async def ws_handler(ws:WebSocket):
-    await manager.init_redis()
-    user = await get_current_ws(ws)
+    with Session(engine) as session:
+        user = await get_current_ws(ws, session)
+    if not user:
+        return
     email = user.email
-    await manager.connect(email, ws)
-    pubsub = manager.redis.pubsub()
-    await pubsub.subscribe(f"notify:{email}")
-    
+    await manager.start()
+    conn_id = await manager.connect(email, ws)
+
+    try:
+        # Nothing to poll: just wait for the client to go away
+        while True:
+            await ws.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await manager.disconnect(email, conn_id)
+
+@router.websocket('/ws/admin/activity')
+async def admin_activity_handler(ws:WebSocket):
+    """
+    Live activity deltas for the admin dashboard: timesheet started/stopped,
+    usage synced and screenshot uploaded. Load the initial state once from
+    /admin/activity_snapshot, then apply these events on top of it.
+    """
+    with Session(engine) as session:
+        user = await get_current_ws(ws, session, required_role="admin")
+    if not user:
+        return
+    await manager.start()
+    await ws.accept()
+    conn_id = uuid4().hex
+    manager.admin_streams[conn_id] = ws
+
     try:
         while True:
-            msg = await pubsub.get_message(ignore_subscribe_messages=True)
-            if msg:
-                await manager.send_notification(email, msg["data"].decode())
-            await asyncio.sleep(0.01)    
+            await ws.receive_text()
     except WebSocketDisconnect:
-        await manager.disconnect(email)
-        await manager.redis.srem("online users", email)
\ No newline at end of file
+        pass
+    finally:
+        manager.admin_streams.pop(conn_id, None)
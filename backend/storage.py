@@ -0,0 +1,135 @@
+import os
+from pathlib import Path
+from uuid import uuid4
+from decouple import config
+from fastapi import Response
+from fastapi.responses import FileResponse, RedirectResponse
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # only needed for STORAGE_BACKEND=s3
+    boto3 = None
+
+# "local" keeps files under STORAGE_DIR, "s3" any S3-compatible bucket (e.g. MinIO)
+STORAGE_BACKEND: str = config('STORAGE_BACKEND', cast=str, default='local')
+STORAGE_DIR = Path(config('STORAGE_DIR', cast=str,
+                          default=str(Path(__file__).resolve().parents[1] / "screenshots")))
+# Location nginx serves STORAGE_DIR from as an internal location, e.g.
+# /protected-screenshots/; empty streams files from Python instead
+STORAGE_ACCEL_PREFIX: str = config('STORAGE_ACCEL_PREFIX', cast=str, default='')
+S3_BUCKET: str = config('S3_BUCKET', cast=str, default='screenshots')
+S3_ENDPOINT_URL: str | None = config('S3_ENDPOINT_URL', cast=str, default=None)
+S3_REGION: str | None = config('S3_REGION', cast=str, default=None)
+# Lifetime of presigned read URLs, in seconds
+STORAGE_URL_TTL: int = config('STORAGE_URL_TTL', cast=int, default=300)
+
+
+def content_disposition(filename: str | None) -> str | None:
+    return f'attachment; filename="{filename}"' if filename else None
+
+
+class LocalStorage():
+    """
+    Files on the API host's disk. Reads are handed to the fronting proxy
+    with X-Accel-Redirect when STORAGE_ACCEL_PREFIX is set, so no image
+    bytes pass through Python; without it they are streamed directly.
+    """
+    def __init__(self, root: Path = STORAGE_DIR, accel_prefix: str = STORAGE_ACCEL_PREFIX):
+        self.root = root
+        self.accel_prefix = accel_prefix
+
+    def path(self, key: str) -> Path:
+        return self.root / key
+
+    def exists(self, key: str) -> bool:
+        return self.path(key).exists()
+
+    def put_file(self, key: str, src: Path) -> None:
+        """Move a finished local file into place; atomic on the same filesystem"""
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(src, path)
+
+    def put_bytes(self, key: str, data: bytes, media_type: str) -> None:
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{uuid4().hex}.tmp")
+        try:
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def get_bytes(self, key: str) -> bytes:
+        return self.path(key).read_bytes()
+
+    def delete(self, key: str) -> None:
+        self.path(key).unlink(missing_ok=True)
+
+    def serve(self, key: str, media_type: str, filename: str | None = None) -> Response:
+        headers = {}
+        if filename:
+            headers["Content-Disposition"] = content_disposition(filename)
+        if self.accel_prefix:
+            headers["X-Accel-Redirect"] = f"{self.accel_prefix.rstrip('/')}/{key}"
+            return Response(media_type=media_type, headers=headers)
+        if not self.exists(key):
+            return Response(status_code=404)
+        return FileResponse(self.path(key), media_type=media_type, filename=filename)
+
+
+class S3Storage():
+    """
+    Objects in an S3-compatible bucket. Reads redirect the client to a
+    short-lived presigned URL, so any API worker can serve any screenshot
+    and the bytes never pass through Python.
+    """
+    def __init__(self, bucket: str = S3_BUCKET, endpoint_url: str | None = S3_ENDPOINT_URL,
+                 region: str | None = S3_REGION, url_ttl: int = STORAGE_URL_TTL):
+        if boto3 is None:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs boto3 installed")
+        self.bucket = bucket
+        self.url_ttl = url_ttl
+        # Credentials come from the usual AWS_* environment variables
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError:
+            return False
+
+    def put_file(self, key: str, src: Path) -> None:
+        try:
+            self.client.upload_file(str(src), self.bucket, key)
+        finally:
+            src.unlink(missing_ok=True)
+
+    def put_bytes(self, key: str, data: bytes, media_type: str) -> None:
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType=media_type)
+
+    def get_bytes(self, key: str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def serve(self, key: str, media_type: str, filename: str | None = None) -> Response:
+        params = {"Bucket": self.bucket, "Key": key, "ResponseContentType": media_type}
+        if filename:
+            params["ResponseContentDisposition"] = content_disposition(filename)
+        url = self.client.generate_presigned_url("get_object", Params=params, ExpiresIn=self.url_ttl)
+        # Reuse the redirect only while the URL behind it is still valid
+        return RedirectResponse(url, status_code=307,
+                                headers={"Cache-Control": f"private, max-age={self.url_ttl // 2}"})
+
+
+def get_storage():
+    if STORAGE_BACKEND == "s3":
+        return S3Storage()
+    return LocalStorage()
+
+
+storage = get_storage()
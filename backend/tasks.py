@@ -1,128 +1,307 @@
 from celery_config import celery_app
+from decouple import config
 from sqlmodel import Session, select, func
 from datetime import datetime, date, timedelta
-from database import engine
-from model import User, AppUsage, DashboardStats, Timesheet, Attendance, Applications
+from data import engine, upsert
+from model import User, AppUsage, DashboardStats, Timesheet, Attendance, Applications, StatsCheckpoint, Screenshots
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+from redis.asyncio import Redis
+from usage_queue import drain_registered_queues
+from screenshots import make_variants
+from writer import writer
+import asyncio
 import json
 
 
+DAILY_STATS_CHECKPOINT = "daily_stats"
+# An AppUsage id is taken when its row is inserted but only shows up once
+# the transaction commits, so on PostgreSQL a lower id can appear after a
+# higher one has been folded in. The checkpoint therefore only advances to
+# the highest id seen at least this many seconds ago, by when every
+# transaction holding a lower id has ended (keep it above the longest
+# write transaction). SQLite commits writes one at a time, in id order.
+STATS_COMMIT_LAG_SECONDS: int = config('STATS_COMMIT_LAG_SECONDS', cast=int,
+                                       default=0 if engine.dialect.name == "sqlite" else 120)
+
+
 @celery_app.task(name='tasks.calculate_daily_stats')
-def calculate_daily_stats():
+def calculate_daily_stats(full: bool = False):
     """
     Calculate and store dashboard stats for all users
-    Runs every hour
+    Runs every minute, folding in only AppUsage rows added since the last
+    run; pass full=True to rebuild today's stats from scratch
     """
     try:
         with Session(engine) as session:
-            employees = session.exec(
-                select(User).where(User.role == "employee")
-            ).all()
-            
             today = date.today()
-            today_start = datetime.combine(today, datetime.min.time())
-            today_end = datetime.combine(today, datetime.max.time())
-            
-            for emp in employees:
- 
-                usage_query = select(
-                    func.sum(AppUsage.duration),
-                    func.sum(AppUsage.idle_duration)
-                ).where(
-                    AppUsage.employee_id == emp.id,
-                    AppUsage.timestamp >= today_start,
-                    AppUsage.timestamp <= today_end
-                )
-                
-                result = session.exec(usage_query).first()
-                total_duration = result[0] or 0  
-                total_idle = result[1] or 0     
-                
-                total_hours = total_duration / 3600
-                idle_hours = total_idle / 3600
-                idle_percentage = (total_idle / total_duration * 100) if total_duration > 0 else 0
-                
-                apps_query = select(
-                    AppUsage.app,
-                    func.sum(AppUsage.duration).label('duration')
-                ).where(
-                    AppUsage.employee_id == emp.id,
-                    AppUsage.timestamp >= today_start,
-                    AppUsage.timestamp <= today_end
-                ).group_by(AppUsage.app).order_by(
-                    func.sum(AppUsage.duration).desc()
-                )
-                
-                app_results = session.exec(apps_query).all()
-                apps_dict = {}
-                
-                for app_name, duration in app_results:
-                    pct = (duration / total_duration * 100) if total_duration > 0 else 0
-                    apps_dict[app_name] = {
-                        "duration": duration,
-                        "percentage": round(pct, 2),
-                        "hours": round(duration / 3600, 2)
-                    }
-                
-                # ===== GET ATTENDANCE STATUS =====
-                attendance_query = select(Attendance).where(
-                    Attendance.employee_id == emp.id,
-                    Attendance.current_date == today
-                )
-                
-                attendance = session.exec(attendance_query).first()
-                attendance_status = attendance.status if attendance else "not_marked"
-                
-                pending_apps_query = select(func.count(Applications.id)).where(
-                    Applications.employee_id == emp.id,
-                    Applications.status == "pending"
-                )
-                
-                pending_apps = session.exec(pending_apps_query).first() or 0
-                
+            checkpoint = session.get(StatsCheckpoint, DAILY_STATS_CHECKPOINT)
+            read_checkpoint = (checkpoint.stats_date, checkpoint.last_usage_id) if checkpoint else None
+            latest_usage_id = session.exec(select(func.max(AppUsage.id))).first() or 0
+            max_usage_id, seen = usage_watermark(checkpoint, latest_usage_id, datetime.utcnow())
 
-                existing_stats = session.exec(
-                    select(DashboardStats).where(
-                        DashboardStats.employee_id == emp.id,
-                        DashboardStats.stats_date == today
-                    )
-                ).first()
-                
+            if full or not checkpoint or checkpoint.stats_date != today:
+                mode = "full"
+                rows = daily_stats_rows(session, today, max_usage_id=max_usage_id)
+            else:
+                mode = "incremental"
+                rows = daily_stats_rows(session, today,
+                                        min_usage_id=checkpoint.last_usage_id,
+                                        max_usage_id=max_usage_id,
+                                        base_apps=existing_apps(session, today))
 
-                if existing_stats:
-
-                    existing_stats.total_hours = round(total_hours, 2)
-                    existing_stats.idle_hours = round(idle_hours, 2)
-                    existing_stats.idle_percentage = round(idle_percentage, 2)
-                    existing_stats.apps_used = json.dumps(apps_dict)
-                    existing_stats.attendance_status = attendance_status
-                    existing_stats.pending_applications = pending_apps
-                    existing_stats.updated_at = datetime.utcnow()
-                    
-                    session.add(existing_stats)
-                else:
-                    new_stats = DashboardStats(
-                        employee_id=emp.id,
-                        stats_date=today,
-                        total_hours=round(total_hours, 2),
-                        idle_hours=round(idle_hours, 2),
-                        idle_percentage=round(idle_percentage, 2),
-                        apps_used=json.dumps(apps_dict),
-                        attendance_status=attendance_status,
-                        pending_applications=pending_apps,
-                        calculated_at=datetime.utcnow(),
-                        updated_at=datetime.utcnow()
-                    )
-                    
-                    session.add(new_stats)
-                
-                session.commit()
+        def save(session: Session) -> None:
+            # Moved first and in the same transaction as the stats, so a
+            # failed run is simply retried and an overlapping run, which
+            # would fold the same rows in twice, finds it moved and writes nothing
+            move_checkpoint(session, read_checkpoint, today, max_usage_id, seen)
+            save_daily_stats(session, today, rows)
+
+        writer.run(save)
         
-        return {"status": "success", "message": "Stats calculated for all users"}
-    
+        return {"status": "success", "message": f"Stats calculated for {len(rows)} users ({mode})"}
+
+    except CheckpointMoved:
+        return {"status": "skipped", "message": "Another run updated the stats first"}
+
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
 
+class CheckpointMoved(Exception):
+    pass
+
+
+def usage_watermark(checkpoint: StatsCheckpoint | None, latest_usage_id: int, now: datetime,
+                    lag_seconds: int | None = None) -> tuple[int, tuple[int, datetime]]:
+    """
+    Highest AppUsage id this run may fold in, and the (id, time) to keep
+    as seen for a later run. Without a lag that is simply latest_usage_id;
+    otherwise it is the id a previous run saw once that is lag_seconds
+    old, and the checkpoint stays put until then.
+    """
+    if lag_seconds is None:
+        lag_seconds = STATS_COMMIT_LAG_SECONDS
+    # The first run has no earlier sighting to wait on and holding back
+    # would write zeroed stats, so it folds in everything visible now
+    if lag_seconds <= 0 or not checkpoint:
+        return latest_usage_id, (latest_usage_id, now)
+
+    if checkpoint.seen_at is None:
+        return checkpoint.last_usage_id, (latest_usage_id, now)
+    if checkpoint.seen_at <= now - timedelta(seconds=lag_seconds):
+        return max(checkpoint.last_usage_id, checkpoint.seen_usage_id), (latest_usage_id, now)
+    return checkpoint.last_usage_id, (checkpoint.seen_usage_id, checkpoint.seen_at)
+
+
+def move_checkpoint(session: Session, read_checkpoint: tuple[date, int] | None,
+                    today: date, max_usage_id: int, seen: tuple[int, datetime]) -> None:
+    """
+    Compare-and-set the checkpoint from the (stats_date, last_usage_id) a
+    run started from to today/max_usage_id. Raises CheckpointMoved, which
+    rolls the run back, if another run moved it in between. The UPDATE
+    holds the row lock until commit, so concurrent runs are serialised.
+    """
+    now = datetime.utcnow()
+    seen_usage_id, seen_at = seen
+    if read_checkpoint is None:
+        session.add(StatsCheckpoint(name=DAILY_STATS_CHECKPOINT, stats_date=today,
+                                    last_usage_id=max_usage_id, seen_usage_id=seen_usage_id,
+                                    seen_at=seen_at, updated_at=now))
+        try:
+            # A concurrent first run fails on the primary key
+            session.flush()
+        except IntegrityError:
+            raise CheckpointMoved()
+        return
+
+    stats_date, last_usage_id = read_checkpoint
+    result = session.execute(
+        update(StatsCheckpoint)
+        .where(StatsCheckpoint.name == DAILY_STATS_CHECKPOINT,
+               StatsCheckpoint.stats_date == stats_date,
+               StatsCheckpoint.last_usage_id == last_usage_id)
+        .values(stats_date=today, last_usage_id=max_usage_id, seen_usage_id=seen_usage_id,
+                seen_at=seen_at, updated_at=now)
+    )
+    if result.rowcount != 1:
+        raise CheckpointMoved()
+
+
+def existing_apps(session: Session, today: date) -> dict[int, dict[str, int]]:
+    """Per app durations already folded into today's DashboardStats rows"""
+    stats = session.exec(
+        select(DashboardStats.employee_id, DashboardStats.apps_used).where(
+            DashboardStats.stats_date == today
+        )
+    ).all()
+
+    apps = {}
+    for employee_id, apps_used in stats:
+        apps_dict = json.loads(apps_used) if apps_used else {}
+        apps[employee_id] = {
+            app_name: app_data.get("duration", 0)
+            for app_name, app_data in apps_dict.items()
+        }
+    return apps
+
+
+def daily_stats_rows(session: Session, today: date, min_usage_id: int = 0,
+                     max_usage_id: int | None = None,
+                     base_apps: dict[int, dict[str, int]] | None = None) -> dict[int, dict]:
+    """
+    Build today's DashboardStats values for every employee with a fixed
+    number of grouped queries, whatever the number of employees.
+    Only AppUsage rows with min_usage_id < id <= max_usage_id are read and
+    their durations are added on top of base_apps.
+    """
+    today_start = datetime.combine(today, datetime.min.time())
+    today_end = datetime.combine(today, datetime.max.time())
+
+    employees = session.exec(
+        select(User.id, User.role).where(User.role == "employee")
+    ).all()
+
+    # Per employee, per app usage; employee totals are summed from it
+    usage_query = select(
+        AppUsage.employee_id,
+        AppUsage.app,
+        func.sum(AppUsage.duration)
+    ).where(
+        AppUsage.timestamp >= today_start,
+        AppUsage.timestamp <= today_end,
+        AppUsage.id > min_usage_id
+    ).group_by(AppUsage.employee_id, AppUsage.app)
+    if max_usage_id is not None:
+        usage_query = usage_query.where(AppUsage.id <= max_usage_id)
+    app_results = session.exec(usage_query).all()
+
+    # Idle time is only recorded on timesheets
+    idle_results = dict(session.exec(
+        select(
+            Timesheet.employee_id,
+            func.sum(Timesheet.idle_seconds)
+        ).where(
+            Timesheet.work_date == today
+        ).group_by(Timesheet.employee_id)
+    ).all())
+
+    attendance_results = {
+        employee_id: getattr(status, "value", status)
+        for employee_id, status in session.exec(
+            select(Attendance.employee_id, Attendance.status).where(
+                Attendance.current_date == today
+            )
+        ).all()
+    }
+
+    pending_results = dict(session.exec(
+        select(
+            Applications.employee_id,
+            func.count(Applications.id)
+        ).where(
+            Applications.status == "pending"
+        ).group_by(Applications.employee_id)
+    ).all())
+
+    usage_by_employee = {
+        employee_id: dict(apps) for employee_id, apps in (base_apps or {}).items()
+    }
+    for employee_id, app_name, duration in app_results:
+        apps = usage_by_employee.setdefault(employee_id, {})
+        apps[app_name] = apps.get(app_name, 0) + (duration or 0)
+
+    rows = {}
+    for employee_id, role in employees:
+        apps = sorted(usage_by_employee.get(employee_id, {}).items(), key=lambda a: a[1], reverse=True)
+        total_duration = sum(duration for _, duration in apps)
+        total_idle = idle_results.get(employee_id) or 0
+        rows[employee_id] = stats_values(
+            role,
+            total_duration,
+            total_idle,
+            apps,
+            attendance_results.get(employee_id, "not_marked"),
+            pending_results.get(employee_id, 0)
+        )
+
+    return rows
+
+
+def stats_values(role: str, total_duration: int, total_idle: int, apps: list,
+                 attendance_status: str, pending_apps: int) -> dict:
+    """Column values of a DashboardStats row from raw totals"""
+    total_hours = total_duration / 3600
+    idle_hours = total_idle / 3600
+    idle_percentage = (total_idle / total_duration * 100) if total_duration > 0 else 0
+
+    apps_dict = {}
+    for app_name, duration in apps:
+        pct = (duration / total_duration * 100) if total_duration > 0 else 0
+        apps_dict[app_name] = {
+            "duration": duration,
+            "percentage": round(pct, 2),
+            "hours": round(duration / 3600, 2)
+        }
+
+    return {
+        "role": role,
+        "total_hours": round(total_hours, 2),
+        "idle_hours": round(idle_hours, 2),
+        "idle_percentage": round(idle_percentage, 2),
+        "apps_used": json.dumps(apps_dict),
+        "attendance_status": attendance_status,
+        "pending_applications": pending_apps
+    }
+
+
+def save_daily_stats(session: Session, today: date, rows: dict[int, dict]) -> None:
+    """
+    Write all of today's stats rows in one bulk upsert on
+    (employee_id, stats_date). Dialects without ON CONFLICT get one bulk
+    UPDATE for rows that already exist and one bulk INSERT for the rest.
+    The caller commits.
+    """
+    if not rows:
+        return
+
+    now = datetime.utcnow()
+    values = [
+        {
+            "employee_id": employee_id,
+            "stats_date": today,
+            "calculated_at": now,
+            "updated_at": now,
+            **stats
+        }
+        for employee_id, stats in rows.items()
+    ]
+    update_columns = [column for column in values[0] if column not in ("employee_id", "stats_date", "calculated_at")]
+    if upsert(session, DashboardStats, values, ["employee_id", "stats_date"], update_columns):
+        return
+
+    existing = dict(session.exec(
+        select(DashboardStats.employee_id, DashboardStats.id).where(
+            DashboardStats.stats_date == today
+        )
+    ).all())
+
+    updates, inserts = [], []
+    for row in values:
+        if row["employee_id"] in existing:
+            updates.append({
+                "id": existing[row["employee_id"]],
+                **{column: row[column] for column in update_columns}
+            })
+        else:
+            inserts.append(row)
+
+    if updates:
+        session.execute(update(DashboardStats), updates)
+    if inserts:
+        session.execute(insert(DashboardStats), inserts)
+
+
 @celery_app.task(name='tasks.calculate_all_users_weekly_stats')
 def calculate_all_users_weekly_stats():
     """
@@ -167,3 +346,64 @@ def calculate_all_users_weekly_stats():
     
     except Exception as e:
         return {"status": "error", "message": str(e)}
+
+
+@celery_app.task(name='tasks.drain_usage_queues')
+def drain_usage_queues():
+    """
+    Drain every non-empty usage queue into AppUsage
+    Runs every DRAIN_FLUSH_INTERVAL seconds
+    """
+    async def run():
+        r = Redis(host="localhost", port=6379, db=0, decode_responses=True)
+        try:
+            with Session(engine) as session:
+                return await drain_registered_queues(r, session)
+        finally:
+            await r.aclose()
+
+    try:
+        result = asyncio.run(run())
+        return {"status": "success", **result}
+
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@celery_app.task(name='tasks.process_screenshot')
+def process_screenshot(screenshot_id: int):
+    """
+    Make the compressed copy and thumbnail of an uploaded screenshot
+    Queued by upload_screenshot so transcoding stays off the request path
+    """
+    try:
+        with Session(engine) as session:
+            screenshot = session.get(Screenshots, screenshot_id)
+            if not screenshot:
+                return {"status": "error", "message": f"Screenshot {screenshot_id} not found"}
+            filepath = screenshot.filepath
+            content_hash = screenshot.content_hash
+
+        compressed_path, thumbnail_path = make_variants(filepath)
+
+        def save(session: Session) -> None:
+            # Every screenshot sharing the blob shares its variants too
+            match = (Screenshots.content_hash == content_hash) if content_hash else (Screenshots.id == screenshot_id)
+            session.execute(
+                update(Screenshots)
+                .where(match, Screenshots.compressed_path.is_(None))
+                .values(compressed_path=compressed_path, thumbnail_path=thumbnail_path)
+            )
+
+        writer.run(save)
+        return {"status": "success", "compressed": compressed_path, "thumbnail": thumbnail_path}
+
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python tasks.py --full rebuilds today's dashboard stats without a worker
+    print(calculate_daily_stats(full="--full" in sys.argv[1:]))
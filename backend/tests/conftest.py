@@ -0,0 +1,53 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+import pytest
+
+# Modules are imported the way the API runs them, from the backend directory
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# data.py builds its engine at import time; keep it off the real database
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/test.db")
+
+# e.g. redis://localhost:6379/15; flushed before every test that uses it
+TEST_REDIS_URL = os.environ.get("TEST_REDIS_URL")
+
+# Benchmarks print their timings with -s and only run their largest sizes
+# when FULL_BENCHMARKS is set
+FULL_BENCHMARKS = bool(os.environ.get("FULL_BENCHMARKS"))
+full_benchmark = pytest.mark.skipif(not FULL_BENCHMARKS, reason="FULL_BENCHMARKS is not set")
+
+
+class RedisFactory():
+    """
+    Clients for one test, all talking to the same data: the database at
+    TEST_REDIS_URL when it is set, otherwise an in-process fake redis
+    """
+    def __init__(self):
+        if TEST_REDIS_URL:
+            from redis import Redis
+            Redis.from_url(TEST_REDIS_URL).flushdb()
+        else:
+            import fakeredis
+            self.server = fakeredis.FakeServer()
+
+    def client(self, decode_responses: bool = True):
+        """An asyncio client; make it inside the event loop that uses it"""
+        if TEST_REDIS_URL:
+            from redis.asyncio import Redis
+            return Redis.from_url(TEST_REDIS_URL, decode_responses=decode_responses)
+        import fakeredis
+        return fakeredis.FakeAsyncRedis(server=self.server, decode_responses=decode_responses)
+
+    def sync_client(self, decode_responses: bool = True):
+        if TEST_REDIS_URL:
+            from redis import Redis
+            return Redis.from_url(TEST_REDIS_URL, decode_responses=decode_responses)
+        import fakeredis
+        return fakeredis.FakeRedis(server=self.server, decode_responses=decode_responses)
+
+
+@pytest.fixture
+def redis_factory() -> RedisFactory:
+    return RedisFactory()
@@ -0,0 +1,134 @@
+"""
+Concurrent /employee/sync calls against the test database and redis from
+conftest, timing how long the event loop stalls while they run. The
+blocking variant is the route as it was before it moved to AsyncSession.
+"""
+import asyncio
+import json
+import time
+from datetime import date, datetime
+import httpx
+import pytest
+from fastapi import Depends, FastAPI, HTTPException
+from sqlalchemy import insert
+from sqlmodel import Session, select, delete
+import api.employee
+from api.employee import router
+from auth import jwt_hasher
+from auth.jwt_hasher import create_access_token, get_current_user
+from auth.principal_cache import PrincipalCache
+from auth.revocation import RevocationList
+from data import engine
+from migrations import upgrade
+from model import User, AppUsage, Timesheet, TimesheetStatus
+from usage_queue import push_usage_events, drain_usage
+from conftest import full_benchmark
+
+FIRST_ID = 9500
+
+
+def seed(employees: int) -> list[int]:
+    upgrade(engine)
+    employee_ids = list(range(FIRST_ID, FIRST_ID + employees))
+    with Session(engine) as session:
+        session.exec(delete(AppUsage).where(AppUsage.employee_id.in_(employee_ids)))
+        session.exec(delete(Timesheet).where(Timesheet.employee_id.in_(employee_ids)))
+        known = set(session.exec(select(User.id).where(User.id.in_(employee_ids))).all())
+        missing = [i for i in employee_ids if i not in known]
+        if missing:
+            session.execute(insert(User), [
+                {"id": i, "name": f"Sync {i}", "username": f"sync{i}", "email": f"sync{i}@example.com",
+                 "password": "x", "role": "employee", "is_active": True}
+                for i in missing
+            ])
+        session.execute(insert(Timesheet), [
+            {"employee_id": i, "work_date": date.today(), "status": TimesheetStatus.ACTIVE}
+            for i in employee_ids
+        ])
+        session.commit()
+    return employee_ids
+
+
+def make_app() -> FastAPI:
+    app = FastAPI()
+    app.include_router(router, prefix="/employee")
+
+    @app.post("/employee/sync_blocking")
+    async def sync_blocking(current_user: User = Depends(get_current_user("employee"))):
+        with Session(engine) as session:
+            timesheet = session.exec(select(Timesheet).where(
+                Timesheet.employee_id == current_user.id,
+                Timesheet.work_date == date.today(),
+                Timesheet.status == TimesheetStatus.ACTIVE)).first()
+            if not timesheet:
+                raise HTTPException(404, "No active timesheet")
+            synced = await drain_usage(api.employee.r, current_user.id, timesheet.id, current_user.role)
+        return {"synced": synced}
+
+    return app
+
+
+async def loop_stalls(done: asyncio.Event) -> list[float]:
+    """How late each 1 ms sleep woke up, in ms, until `done` is set"""
+    stalls = []
+    while not done.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        stalls.append((time.perf_counter() - started) * 1000 - 1)
+    return stalls
+
+
+def concurrent_syncs(redis_factory, monkeypatch, path: str, employees: int,
+                     events: int) -> tuple[float, list[float]]:
+    """Sync `employees` users with `events` queued each, all at once; returns
+    the wall time and how late the event loop woke up meanwhile"""
+    monkeypatch.setattr(jwt_hasher, "principal_cache", PrincipalCache())
+    monkeypatch.setattr(jwt_hasher, "revocation_list", RevocationList(redis_factory.sync_client()))
+    employee_ids = seed(employees)
+    tokens = [create_access_token({"sub": f"sync{i}", "id": i, "role": "employee"}) for i in employee_ids]
+
+    async def run():
+        redis = redis_factory.client()
+        monkeypatch.setattr(api.employee, "r", redis)
+        for employee_id in employee_ids:
+            await push_usage_events(redis, employee_id, [
+                json.dumps({"event": "usage", "id": f"{path}-{employee_id}-{n}", "app": "editor", "duration": 60,
+                            "timestamp": datetime(2024, 1, 15, 12).isoformat()})
+                for n in range(events)
+            ])
+
+        done = asyncio.Event()
+        ticker = asyncio.create_task(loop_stalls(done))
+        transport = httpx.ASGITransport(app=make_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=60) as client:
+            started = time.perf_counter()
+            responses = await asyncio.gather(*[
+                client.post(path, headers={"Authorization": f"Bearer {token}"}) for token in tokens
+            ])
+            seconds = time.perf_counter() - started
+        done.set()
+        stalls = await ticker
+        await redis.aclose()
+        assert [response.json() for response in responses] == [{"synced": events}] * employees
+        return seconds, stalls
+
+    seconds, stalls = asyncio.run(run())
+    with Session(engine) as session:
+        rows = session.exec(select(AppUsage.id).where(AppUsage.employee_id.in_(employee_ids))).all()
+    assert len(rows) == employees * events
+
+    print(f"\n{employees} concurrent syncs of {events} events via {path}: {seconds * 1000:.0f} ms, "
+          f"event loop stalled up to {max(stalls):.1f} ms")
+    return seconds, stalls
+
+
+def test_blocking_and_async_session_side_by_side(redis_factory, monkeypatch):
+    # Few enough that the blocking variant, which holds two pooled
+    # connections per request, cannot exhaust the pool and freeze the loop
+    for path in ("/employee/sync_blocking", "/employee/sync"):
+        concurrent_syncs(redis_factory, monkeypatch, path, 6, 200)
+
+
+@pytest.mark.parametrize("employees,events", [(50, 100), pytest.param(200, 500, marks=full_benchmark)])
+def test_concurrent_syncs_beyond_the_pool_size(redis_factory, monkeypatch, employees, events):
+    concurrent_syncs(redis_factory, monkeypatch, "/employee/sync", employees, events)
@@ -0,0 +1,33 @@
+from sqlmodel import Session, create_engine
+from data import engine_options
+from migrations import upgrade
+from model import ScreenshotBlob
+from screenshots import add_blob_ref, release_blob
+
+CONTENT_HASH = "ab" * 32
+FILEPATH = f"blobs/ab/ab/{CONTENT_HASH}.png"
+
+
+def test_blob_is_deleted_with_its_last_reference(tmp_path):
+    url = f"sqlite:///{tmp_path}/blobs.db"
+    engine = create_engine(url, **engine_options(url))
+    upgrade(engine)
+
+    with Session(engine) as session:
+        add_blob_ref(session, CONTENT_HASH, FILEPATH, 100)
+        add_blob_ref(session, CONTENT_HASH, FILEPATH, 100)
+        add_blob_ref(session, CONTENT_HASH, FILEPATH, 100)
+        session.commit()
+        assert session.get(ScreenshotBlob, CONTENT_HASH).ref_count == 3
+
+        assert release_blob(session, CONTENT_HASH, count=2) == []
+        session.commit()
+        session.expire_all()
+        assert session.get(ScreenshotBlob, CONTENT_HASH).ref_count == 1
+
+        keys = release_blob(session, CONTENT_HASH)
+        session.commit()
+        session.expire_all()
+        assert session.get(ScreenshotBlob, CONTENT_HASH) is None
+        assert FILEPATH in keys and len(keys) == 3
+    engine.dispose()
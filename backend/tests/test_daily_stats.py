@@ -0,0 +1,158 @@
+"""
+The daily stats task against the test database from conftest, and its
+queries timed against a seeded throwaway SQLite database
+"""
+import json
+import time
+from datetime import date, datetime, timedelta
+import pytest
+from sqlalchemy import insert, event, func
+from sqlmodel import Session, create_engine, select, delete
+import tasks
+from data import engine, engine_options
+from migrations import upgrade
+from model import (User, AppUsage, DashboardStats, StatsCheckpoint, Timesheet, Attendance, Applications,
+                   AttendanceStatus, ApplicationStatus)
+from tasks import (calculate_daily_stats, usage_watermark, move_checkpoint, daily_stats_rows, save_daily_stats,
+                   CheckpointMoved, DAILY_STATS_CHECKPOINT)
+from conftest import full_benchmark
+
+EMPLOYEE_ID = 9101
+
+
+def reset():
+    upgrade(engine)
+    with Session(engine) as session:
+        session.exec(delete(StatsCheckpoint))
+        session.exec(delete(DashboardStats).where(DashboardStats.employee_id == EMPLOYEE_ID))
+        session.exec(delete(AppUsage).where(AppUsage.employee_id == EMPLOYEE_ID))
+        if not session.get(User, EMPLOYEE_ID):
+            session.add(User(id=EMPLOYEE_ID, name="Stats", username="stats", email="stats@example.com",
+                             password="x", role="employee", is_active=True))
+        session.commit()
+
+
+def test_first_watermark_is_not_held_back():
+    now = datetime.utcnow()
+    assert usage_watermark(None, 42, now, lag_seconds=120) == (42, (42, now))
+
+
+def test_first_run_with_commit_lag_writes_current_usage(monkeypatch):
+    reset()
+    monkeypatch.setattr(tasks, "STATS_COMMIT_LAG_SECONDS", 120)
+    at = datetime.combine(date.today(), datetime.min.time()) + timedelta(hours=12)
+    with Session(engine) as session:
+        session.execute(insert(AppUsage), [
+            {"employee_id": EMPLOYEE_ID, "role": "employee", "app": app, "duration": 1800, "timestamp": at}
+            for app in ("editor", "browser")
+        ])
+        session.commit()
+
+    assert calculate_daily_stats()["status"] == "success"
+
+    with Session(engine) as session:
+        stats = session.exec(select(DashboardStats).where(DashboardStats.employee_id == EMPLOYEE_ID)).one()
+    assert stats.total_hours == 1
+    assert set(json.loads(stats.apps_used)) == {"editor", "browser"}
+
+
+def test_overlapping_run_writes_nothing(monkeypatch):
+    reset()
+    today = date.today()
+    with Session(engine) as session:
+        move_checkpoint(session, None, today, 10, (10, datetime.utcnow()))
+        session.commit()
+
+    # A run that read (today, 10) while another run moved it on to 20
+    real_rows = tasks.daily_stats_rows
+    def rows_after_another_run(session, *args, **kwargs):
+        with Session(engine) as other:
+            move_checkpoint(other, (today, 10), today, 20, (20, datetime.utcnow()))
+            other.commit()
+        return real_rows(session, *args, **kwargs)
+    monkeypatch.setattr(tasks, "daily_stats_rows", rows_after_another_run)
+    at = datetime.combine(today, datetime.min.time()) + timedelta(hours=12)
+    with Session(engine) as session:
+        session.execute(insert(AppUsage), [
+            {"employee_id": EMPLOYEE_ID, "role": "employee", "app": "editor", "duration": 600, "timestamp": at}
+        ])
+        session.commit()
+
+    assert calculate_daily_stats()["status"] == "skipped"
+
+    with Session(engine) as session:
+        checkpoint = session.get(StatsCheckpoint, DAILY_STATS_CHECKPOINT)
+        assert (checkpoint.stats_date, checkpoint.last_usage_id) == (today, 20)
+        assert session.exec(select(DashboardStats).where(DashboardStats.employee_id == EMPLOYEE_ID)).first() is None
+        # A second first run loses on the primary key the same way
+        with pytest.raises(CheckpointMoved):
+            move_checkpoint(session, None, today, 30, (30, datetime.utcnow()))
+        session.rollback()
+
+
+def seeded_engine(path, employees: int):
+    """A day of usage for each employee: 200 rows over 20 apps, a timesheet,
+    attendance and one pending leave application for every other employee"""
+    url = f"sqlite:///{path}/stats.db"
+    stats_engine = create_engine(url, **engine_options(url))
+    upgrade(stats_engine)
+    today = date.today()
+    at = datetime.combine(today, datetime.min.time()) + timedelta(hours=12)
+    with Session(stats_engine) as session:
+        session.execute(insert(User), [
+            {"name": f"Employee {i}", "username": f"employee{i}", "email": f"employee{i}@example.com",
+             "password": "x", "role": "employee", "is_active": True}
+            for i in range(employees)
+        ])
+        employee_ids = session.exec(select(User.id)).all()
+        for employee_id in employee_ids:
+            session.execute(insert(AppUsage), [
+                {"employee_id": employee_id, "role": "employee", "app": f"app{i % 20}", "duration": 60,
+                 "timestamp": at}
+                for i in range(200)
+            ])
+        session.execute(insert(Timesheet), [
+            {"employee_id": employee_id, "work_date": today, "idle_seconds": 600} for employee_id in employee_ids
+        ])
+        session.execute(insert(Attendance), [
+            {"employee_id": employee_id, "current_date": today, "status": AttendanceStatus.PRESENT}
+            for employee_id in employee_ids
+        ])
+        session.execute(insert(Applications), [
+            {"employee_id": employee_id, "body": "Leave", "status": ApplicationStatus.PENDING}
+            for employee_id in employee_ids[::2]
+        ])
+        session.commit()
+    return stats_engine
+
+
+@pytest.mark.parametrize("employees", [200, pytest.param(2000, marks=full_benchmark)])
+def test_stats_queries_do_not_grow_with_employees(tmp_path, employees):
+    stats_engine = seeded_engine(tmp_path, employees)
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(stats_engine, "before_cursor_execute", record)
+
+    started = time.perf_counter()
+    with Session(stats_engine) as session:
+        rows = daily_stats_rows(session, date.today())
+        save_daily_stats(session, date.today(), rows)
+        session.commit()
+    seconds = time.perf_counter() - started
+
+    # Five grouped reads and one bulk upsert, whatever the head count
+    assert len(statements) == 6
+    event.remove(stats_engine, "before_cursor_execute", record)
+    with Session(stats_engine) as session:
+        assert session.exec(select(func.count(DashboardStats.id))).one() == employees
+        first = session.exec(select(DashboardStats).order_by(DashboardStats.employee_id)).first()
+    assert first.total_hours == round(200 * 60 / 3600, 2)
+    assert first.idle_hours == round(600 / 3600, 2)
+    assert first.attendance_status == "present"
+    assert first.pending_applications == 1
+    assert len(json.loads(first.apps_used)) == 20
+    stats_engine.dispose()
+
+    print(f"\n{employees:,} employees, {employees * 200:,} usage rows: "
+          f"stats built and upserted in {seconds * 1000:.0f} ms with {len(statements)} statements")
@@ -0,0 +1,107 @@
+"""
+Streaming payroll exports from a seeded throwaway SQLite database, with
+a check that memory stays flat however long the range is. Run with -s
+to see the numbers.
+"""
+import csv
+import io
+import json
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+import pytest
+from sqlalchemy import insert
+from sqlmodel import Session, create_engine, select
+import exports
+from data import engine_options
+from migrations import upgrade
+from model import User, AppUsage, Timesheet, Attendance, AttendanceStatus, TimesheetStatus
+from exports import export_rows
+from conftest import full_benchmark
+
+START = date(2024, 1, 1)
+DAYS = 30
+USAGE_PER_DAY = 20
+
+
+@pytest.fixture
+def seeded(tmp_path, monkeypatch, request):
+    """A month of timesheets, attendance and app usage for `employees`"""
+    employees = getattr(request, "param", 5)
+    url = f"sqlite:///{tmp_path}/exports.db"
+    export_engine = create_engine(url, **engine_options(url))
+    upgrade(export_engine)
+    with Session(export_engine) as session:
+        session.execute(insert(User), [
+            {"name": f"Employee {i}", "username": f"employee{i}", "email": f"employee{i}@example.com",
+             "password": "x", "role": "employee"} for i in range(employees)
+        ])
+        employee_ids = session.exec(select(User.id)).all()
+        for day in range(DAYS):
+            work_date = START + timedelta(days=day)
+            at = datetime.combine(work_date, datetime.min.time()) + timedelta(hours=9)
+            session.execute(insert(Timesheet), [
+                {"employee_id": i, "work_date": work_date, "start_time": at, "end_time": at + timedelta(hours=8),
+                 "total_seconds": 8 * 3600, "status": TimesheetStatus.INACTIVE} for i in employee_ids
+            ])
+            session.execute(insert(Attendance), [
+                {"employee_id": i, "current_date": work_date, "status": AttendanceStatus.PRESENT}
+                for i in employee_ids
+            ])
+            session.execute(insert(AppUsage), [
+                {"employee_id": i, "role": "employee", "app": f"app{n}", "duration": 60,
+                 "timestamp": at + timedelta(minutes=n)}
+                for i in employee_ids for n in range(USAGE_PER_DAY)
+            ])
+        session.commit()
+    monkeypatch.setattr(exports, "engine", export_engine)
+    yield employee_ids
+    export_engine.dispose()
+
+
+def exported(*args, **kwargs) -> str:
+    return "".join(export_rows(*args, **kwargs))
+
+
+def test_csv_has_a_header_and_one_line_per_row(seeded):
+    rows = list(csv.reader(io.StringIO(exported("timesheets", "csv", START, START + timedelta(days=6)))))
+
+    assert rows[0] == ["id", "employee_id", "work_date", "start_time", "end_time", "total_seconds",
+                       "idle_seconds", "status"]
+    assert len(rows) == 1 + 7 * len(seeded)
+    assert rows[1][2] == START.isoformat() and rows[1][7] == "inactive"
+
+
+def test_ndjson_filters_by_employee_and_range(seeded):
+    first = seeded[0]
+    lines = exported("attendance", "ndjson", START, START, [first]).splitlines()
+
+    assert [json.loads(line) for line in lines] == [
+        {"id": 1, "employee_id": first, "current_date": START.isoformat(), "status": "present"}
+    ]
+    usage = [json.loads(line) for line in exported("app_usage", "ndjson", START, START, [first]).splitlines()]
+    assert len(usage) == USAGE_PER_DAY and {row["employee_id"] for row in usage} == {first}
+
+
+def export_peak(dataset: str, days: int) -> tuple[int, int, float]:
+    """Bytes exported, peak Python memory while exporting and seconds taken"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    size = sum(len(chunk) for chunk in export_rows(dataset, "csv", START, START + timedelta(days=days - 1)))
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size, peak, seconds
+
+
+@pytest.mark.parametrize("seeded", [200, pytest.param(2000, marks=full_benchmark)], indirect=True)
+def test_memory_stays_flat_over_a_month(seeded):
+    day_size, day_peak, _ = export_peak("app_usage", 1)
+    month_size, month_peak, seconds = export_peak("app_usage", DAYS)
+
+    assert month_size > 20 * day_size
+    # A month streams in the same memory as a day, give or take a batch
+    assert month_peak < 2 * day_peak
+    rows = len(seeded) * DAYS * USAGE_PER_DAY
+    print(f"\n{len(seeded):,} employees, {rows:,} app usage rows: {month_size / 2**20:,.1f} MiB of CSV "
+          f"in {seconds:.1f} s, peak {month_peak / 2**20:.1f} MiB (one day: {day_peak / 2**20:.1f} MiB)")
@@ -0,0 +1,61 @@
+from fastapi import FastAPI, Request, Response
+from fastapi.testclient import TestClient
+from http_cache import conditional_json, conditional_file, IMMUTABLE, REVALIDATE
+from storage import LocalStorage
+
+
+def make_client(tmp_path) -> TestClient:
+    storage = LocalStorage(root=tmp_path, accel_prefix="")
+    storage.put_bytes("blobs/ab/cd/abcd.png", b"\x89PNG image", "image/png")
+    stats = {"total_hours": 6.5, "apps_used": {"code": 3.0}}
+    app = FastAPI()
+
+    @app.get("/stats")
+    def get_stats(request: Request, response: Response):
+        return conditional_json(request, response, stats)
+
+    @app.get("/screenshot")
+    def get_screenshot(request: Request, final: bool = True):
+        key = "blobs/ab/cd/abcd.png"
+        return conditional_file(request, key, lambda: storage.serve(key, "image/png"), final=final)
+
+    return TestClient(app)
+
+
+def test_json_revalidates_to_304(tmp_path):
+    client = make_client(tmp_path)
+    first = client.get("/stats")
+    assert first.status_code == 200
+    assert first.headers["Cache-Control"] == REVALIDATE
+    etag = first.headers["ETag"]
+
+    again = client.get("/stats", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.content == b""
+    assert again.headers["ETag"] == etag
+
+    # Weak and listed validators match too; other tags get the body
+    assert client.get("/stats", headers={"If-None-Match": f'"other", W/{etag}'}).status_code == 304
+    assert client.get("/stats", headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_file_revalidates_to_304(tmp_path):
+    client = make_client(tmp_path)
+    first = client.get("/screenshot")
+    assert first.status_code == 200
+    assert first.content == b"\x89PNG image"
+    assert first.headers["Cache-Control"] == IMMUTABLE
+
+    again = client.get("/screenshot", headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
+    assert again.content == b""
+    assert again.headers["Cache-Control"] == IMMUTABLE
+
+
+def test_fallback_file_is_not_cached_for_good(tmp_path):
+    client = make_client(tmp_path)
+    first = client.get("/screenshot", params={"final": False})
+    assert first.headers["Cache-Control"] == REVALIDATE
+    again = client.get("/screenshot", params={"final": False},
+                       headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
@@ -0,0 +1,42 @@
+"""
+Live dashboard stats read from the redis counters from conftest, against
+the durable DashboardStats row they must never fall behind
+"""
+import asyncio
+import json
+from datetime import date, datetime
+from model import DashboardStats
+from live_stats import record_usage, read_live_stats
+
+EMPLOYEE_ID = 9601
+
+
+def test_counters_behind_the_durable_row_fall_back_to_it(redis_factory):
+    async def run():
+        r = redis_factory.client()
+        stats = DashboardStats(employee_id=EMPLOYEE_ID, role="employee", stats_date=date.today(),
+                               total_hours=1, idle_hours=0.5, attendance_status="present",
+                               apps_used=json.dumps({"editor": {"duration": 3600}}))
+        at = datetime.combine(date.today(), datetime.min.time())
+        try:
+            # e.g. redis restarted mid-day and only later usage was counted
+            async with r.pipeline(transaction=True) as pipe:
+                record_usage(pipe, EMPLOYEE_ID, [{"timestamp": at, "app": "editor", "duration": 600}])
+                await pipe.execute()
+            assert await read_live_stats(r, EMPLOYEE_ID, stats) is None
+
+            # Once they have caught up the counters are served, never with less idle time
+            async with r.pipeline(transaction=True) as pipe:
+                record_usage(pipe, EMPLOYEE_ID, [{"timestamp": at, "app": "browser", "duration": 3600}])
+                await pipe.execute()
+            live = await read_live_stats(r, EMPLOYEE_ID, stats)
+            assert live["today"]["hours"] == round(4200 / 3600, 2)
+            assert live["today"]["idle_hours"] == 0.5
+            assert [app["app_name"] for app in live["today"]["apps"]] == ["browser", "editor"]
+            assert live["attendance_status"] == "present"
+
+            assert await read_live_stats(r, EMPLOYEE_ID + 1, stats) is None
+        finally:
+            await r.aclose()
+
+    asyncio.run(run())
@@ -0,0 +1,71 @@
+"""
+Keyset pagination over a throwaway SQLite database
+"""
+from datetime import datetime
+import pytest
+from fastapi import Response
+from sqlalchemy import insert
+from sqlmodel import Session, create_engine, select
+from data import engine_options
+from migrations import upgrade
+from model import User, AppUsage
+from pagination import PageParams, paginate, NEXT_CURSOR_HEADER, TOTAL_COUNT_HEADER
+
+ROWS = 25
+
+
+@pytest.fixture
+def session(tmp_path):
+    url = f"sqlite:///{tmp_path}/pages.db"
+    engine = create_engine(url, **engine_options(url))
+    upgrade(engine)
+    with Session(engine) as session:
+        user = User(name="Pages", username="pages", email="pages@example.com", password="x", role="employee")
+        session.add(user)
+        session.commit()
+        # Same timestamp and app everywhere, so only the id tells rows apart
+        at = datetime(2024, 1, 15, 12)
+        session.execute(insert(AppUsage), [
+            {"employee_id": user.id, "role": "employee", "app": "editor", "duration": 60, "timestamp": at}
+            for _ in range(ROWS)
+        ])
+        session.commit()
+        yield session
+    engine.dispose()
+
+
+def all_pages(session: Session, limit: int, descending: bool = True) -> list[list[int]]:
+    pages, cursor = [], None
+    while True:
+        response = Response()
+        rows = paginate(session, select(AppUsage), AppUsage.id, response,
+                        PageParams(limit=limit, cursor=cursor, with_total=False), descending=descending)
+        pages.append([row.id for row in rows])
+        cursor = response.headers.get(NEXT_CURSOR_HEADER)
+        if cursor is None:
+            return pages
+        # The header goes back as the query parameter
+        cursor = int(cursor)
+
+
+@pytest.mark.parametrize("descending", [True, False])
+def test_cursor_walks_every_row_once(session, descending):
+    pages = all_pages(session, 10, descending)
+
+    assert [len(page) for page in pages] == [10, 10, 5]
+    ids = [row_id for page in pages for row_id in page]
+    assert ids == sorted(ids, reverse=descending)
+    assert len(set(ids)) == ROWS
+
+
+def test_last_page_has_no_cursor(session):
+    # A full last page still needs the extra row to know it is the last
+    pages = all_pages(session, ROWS)
+    assert [len(page) for page in pages] == [ROWS]
+
+    response = Response()
+    rows = paginate(session, select(AppUsage), AppUsage.id, response,
+                    PageParams(limit=10, cursor=min(pages[0]), with_total=True))
+    assert rows == []
+    assert NEXT_CURSOR_HEADER not in response.headers
+    assert response.headers[TOTAL_COUNT_HEADER] == str(ROWS)
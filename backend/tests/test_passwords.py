@@ -0,0 +1,143 @@
+"""
+Password hashing off the threadpool: back-pressure, rehash on login and
+a benchmark of unrelated endpoints during a login storm, against the
+test database from conftest
+"""
+import asyncio
+import statistics
+import time
+import anyio.to_thread
+import httpx
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.concurrency import run_in_threadpool
+from passlib.hash import bcrypt
+from sqlmodel import Session, select, func
+import api.auth_route
+from api.auth_route import router
+from auth.passwords import HashPool, HashPoolFull, hash_password, BCRYPT_ROUNDS
+from data import engine, get_session
+from migrations import upgrade
+from model import User
+from conftest import full_benchmark
+
+USER_ID = 9401
+PASSWORD = "Storm-Passw0rd"
+
+
+class ThreadpoolHashing():
+    """How signin hashed before HashPool: on the threadpool shared by every sync endpoint"""
+    async def run(self, fn, *args):
+        return await run_in_threadpool(fn, *args)
+
+
+def store_user(password_hash: str) -> None:
+    upgrade(engine)
+    with Session(engine) as session:
+        user = session.get(User, USER_ID) or User(id=USER_ID, name="Storm", username="storm",
+                                                  email="storm@example.com", role="employee")
+        user.password = password_hash
+        session.add(user)
+        session.commit()
+
+
+def stored_hash() -> str:
+    with Session(engine) as session:
+        return session.get(User, USER_ID).password
+
+
+def make_app() -> FastAPI:
+    app = FastAPI()
+    app.include_router(router, prefix="/auth")
+
+    # Stands in for the dashboards: a sync route on the shared threadpool
+    @app.get("/dashboard")
+    def dashboard(session: Session = Depends(get_session)):
+        return session.exec(select(func.count(User.id))).one()
+
+    return app
+
+
+async def sign_in(client: httpx.AsyncClient) -> httpx.Response:
+    return await client.post("/auth/signin", json={"username": "storm", "password": PASSWORD})
+
+
+def test_full_pool_refuses_right_away():
+    async def test():
+        pool = HashPool(workers=1, queue_limit=1)
+        running = asyncio.create_task(pool.run(time.sleep, 0.5))
+        await asyncio.sleep(0.05)
+        with pytest.raises(HashPoolFull):
+            await pool.run(time.sleep, 0)
+        await running
+        pool.executor.shutdown()
+    asyncio.run(test())
+
+
+def test_login_storm_gets_503_beyond_the_queue_limit(monkeypatch):
+    store_user(hash_password(PASSWORD))
+    pool = HashPool(workers=1, queue_limit=2)
+    monkeypatch.setattr(api.auth_route, "hash_pool", pool)
+
+    async def test():
+        transport = httpx.ASGITransport(app=make_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(*[sign_in(client) for _ in range(6)])
+    responses = asyncio.run(test())
+    pool.executor.shutdown()
+
+    codes = sorted(response.status_code for response in responses)
+    assert codes.count(200) >= 2 and codes.count(503) >= 1 and set(codes) == {200, 503}
+    assert all(response.headers["Retry-After"] == "1" for response in responses if response.status_code == 503)
+
+
+def test_outdated_cost_is_rehashed_on_login(monkeypatch):
+    store_user(bcrypt.using(rounds=4).hash(PASSWORD))
+    monkeypatch.setattr(api.auth_route, "hash_pool", ThreadpoolHashing())
+
+    async def test():
+        transport = httpx.ASGITransport(app=make_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await sign_in(client)
+    assert asyncio.run(test()).status_code == 200
+
+    assert bcrypt.from_string(stored_hash()).rounds == BCRYPT_ROUNDS
+    assert bcrypt.verify(PASSWORD, stored_hash())
+
+
+def storm(hashing, logins: int, threads: int) -> tuple[list[int], list[float]]:
+    """Sign in `logins` times at once while polling the dashboard; returns
+    the login status codes and the dashboard latencies in ms"""
+    async def test():
+        anyio.to_thread.current_default_thread_limiter().total_tokens = threads
+        transport = httpx.ASGITransport(app=make_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=60) as client:
+            logins_done = asyncio.gather(*[sign_in(client) for _ in range(logins)])
+            latencies = []
+            while not logins_done.done():
+                started = time.perf_counter()
+                assert (await client.get("/dashboard")).status_code == 200
+                latencies.append((time.perf_counter() - started) * 1000)
+                await asyncio.sleep(0.01)
+            return [response.status_code for response in await logins_done], latencies
+    return asyncio.run(test())
+
+
+@pytest.mark.parametrize("threads", [4, pytest.param(40, marks=full_benchmark)])
+def test_dashboard_latency_during_login_storm(monkeypatch, threads):
+    store_user(hash_password(PASSWORD))
+    logins = 2 * threads
+    pool = HashPool(workers=2, queue_limit=logins)
+
+    results = {}
+    for name, hashing in (("threadpool", ThreadpoolHashing()), ("process pool", pool)):
+        monkeypatch.setattr(api.auth_route, "hash_pool", hashing)
+        codes, latencies = storm(hashing, logins, threads)
+        assert codes == [200] * logins
+        results[name] = latencies
+    pool.executor.shutdown()
+
+    for name, latencies in results.items():
+        p99 = statistics.quantiles(latencies, n=100, method="inclusive")[98] if len(latencies) > 1 else latencies[0]
+        print(f"\n{logins} logins, {threads} threads, hashing on the {name}: dashboard p50 "
+              f"{statistics.median(latencies):.1f} ms, p99 {p99:.1f} ms over {len(latencies)} requests")
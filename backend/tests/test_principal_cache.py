@@ -0,0 +1,113 @@
+"""
+The principal cache behind get_current_user, with an A/B benchmark of
+/employee/event_buffering against the test database from conftest and
+the redis from conftest
+"""
+import time
+from datetime import datetime
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+from sqlmodel import Session
+import api.employee
+from auth import jwt_hasher
+from auth.jwt_hasher import create_access_token
+from auth.principal_cache import PrincipalCache
+from auth.revocation import RevocationList
+from data import engine
+from migrations import upgrade
+from model import User
+from usage_queue import usage_queue_key
+from conftest import full_benchmark
+
+USER_ID = 9301
+
+
+@pytest.fixture
+def cache(redis_factory, monkeypatch):
+    upgrade(engine)
+    with Session(engine) as session:
+        if not session.get(User, USER_ID):
+            session.add(User(id=USER_ID, name="Cached", username="cached", email="cached@example.com",
+                             password="x", role="employee", is_active=True))
+            session.commit()
+
+    cache = PrincipalCache()
+    monkeypatch.setattr(jwt_hasher, "principal_cache", cache)
+    monkeypatch.setattr(jwt_hasher, "revocation_list", RevocationList(redis_factory.sync_client()))
+    monkeypatch.setattr(api.employee, "r", redis_factory.client())
+    return cache
+
+
+def user(user_id: int, role: str = "employee") -> User:
+    return User(id=user_id, name="User", username=f"user{user_id}", email=f"user{user_id}@example.com",
+                role=role, is_active=True)
+
+
+def test_lru_evicts_least_recently_used():
+    cache = PrincipalCache(max_size=2)
+    cache.set(1, "a", user(1))
+    cache.set(2, "b", user(2))
+    cache.get(1, "a")
+    cache.set(3, "c", user(3))
+
+    assert cache.get(2, "b") is None
+    assert cache.get(1, "a").username == "user1"
+    assert cache.stats() == {"size": 2, "hits": 2, "redis_hits": 0, "misses": 1, "hit_ratio": 0.6667}
+
+
+def test_invalidate_user_reaches_the_redis_tier(redis_factory):
+    redis = redis_factory.sync_client()
+    worker, other = PrincipalCache(redis=redis), PrincipalCache(redis=redis)
+    worker.set(1, "a", user(1))
+    worker.set(1, "b", user(1))
+    worker.set(2, "a", user(2))
+
+    # Another worker resolves the token from redis
+    assert other.get(1, "a").username == "user1"
+    assert other.stats()["redis_hits"] == 1
+
+    worker.invalidate_user(1)
+    assert worker.get(1, "a") is None
+    assert PrincipalCache(redis=redis).get(1, "b") is None
+    assert PrincipalCache(redis=redis).get(2, "a").username == "user2"
+
+
+@pytest.mark.parametrize("requests", [500, pytest.param(5000, marks=full_benchmark)])
+def test_event_buffering_with_and_without_cache(cache, monkeypatch, requests):
+    app = FastAPI()
+    app.include_router(api.employee.router, prefix="/employee")
+    token = create_access_token({"sub": "cached", "id": USER_ID, "role": "employee"})
+    body = {"app": "editor", "duration": 60, "timestamp": datetime(2024, 1, 15, 12).isoformat()}
+
+    lookups = []
+    def record(conn, cursor, statement, *args):
+        if 'FROM "user"' in statement or "FROM user" in statement:
+            lookups.append(statement)
+    event.listen(engine, "before_cursor_execute", record)
+
+    timings = {}
+    try:
+        with TestClient(app) as client:
+            for enabled in (False, True):
+                monkeypatch.setattr(jwt_hasher, "PRINCIPAL_CACHE_ENABLED", enabled)
+                lookups.clear()
+                started = time.perf_counter()
+                for _ in range(requests):
+                    response = client.post("/employee/event_buffering", json=body,
+                                           headers={"Authorization": f"Bearer {token}"})
+                    assert response.status_code == 200
+                timings[enabled] = time.perf_counter() - started
+                # Only the first request of the cached run reads the user
+                assert len(lookups) == (1 if enabled else requests)
+            queued = client.portal.call(api.employee.r.llen, usage_queue_key(USER_ID))
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+    assert queued == 2 * requests
+    stats = cache.stats()
+    assert stats["hits"] == requests - 1
+    print(f"\n{requests:,} event_buffering requests: {requests / timings[False]:,.0f} req/s without "
+          f"the principal cache, {requests / timings[True]:,.0f} req/s with it "
+          f"(hit ratio {stats['hit_ratio']:.2%})")
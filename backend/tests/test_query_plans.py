@@ -0,0 +1,73 @@
+"""
+The hot tracking-table queries must be answered from an index. Each one
+is run through SQLite's EXPLAIN QUERY PLAN on a freshly migrated database
+and fails if any step is a SCAN of the table instead of a SEARCH.
+"""
+from datetime import date, datetime, timedelta
+import pytest
+from sqlmodel import create_engine, select, func
+from data import engine_options
+from migrations import upgrade
+from model import AppUsage, Timesheet, Attendance, Screenshots, DashboardStats
+from pagination import DEFAULT_PAGE_SIZE
+
+DAY = date(2024, 1, 15)
+DAY_START = datetime.combine(DAY, datetime.min.time())
+NEXT_DAY_START = DAY_START + timedelta(days=1)
+
+
+def page(statement, id_column):
+    """The first page as pagination.paginate runs it"""
+    return statement.order_by(id_column.desc()).limit(DEFAULT_PAGE_SIZE + 1)
+
+
+HOT_QUERIES = {
+    # Admin activity, attendance and screenshot pages
+    "appusage by employee and time": page(select(AppUsage).where(
+        AppUsage.employee_id == 1, AppUsage.role == "employee",
+        AppUsage.timestamp >= DAY_START, AppUsage.timestamp < NEXT_DAY_START), AppUsage.id),
+    "attendance by employee and date": page(select(Attendance).where(
+        Attendance.employee_id == 1, Attendance.current_date >= DAY,
+        Attendance.current_date <= DAY), Attendance.id),
+    "screenshots by employee and time": page(select(Screenshots).where(
+        Screenshots.employee_id == 1, Screenshots.timestamp >= DAY_START,
+        Screenshots.timestamp <= NEXT_DAY_START), Screenshots.id),
+    # Timesheet detail and summaries
+    "timesheets by employee and day": select(Timesheet).where(
+        Timesheet.employee_id == 1, Timesheet.work_date == DAY),
+    "appusage by timesheet": select(AppUsage.timesheet_id, AppUsage.app, func.sum(AppUsage.duration)).where(
+        AppUsage.timesheet_id.in_([1, 2, 3])).group_by(AppUsage.timesheet_id, AppUsage.app),
+    # Dashboard stats job
+    "appusage of the day": select(AppUsage.employee_id, AppUsage.app, func.sum(AppUsage.duration)).where(
+        AppUsage.timestamp >= DAY_START, AppUsage.timestamp <= NEXT_DAY_START).group_by(
+        AppUsage.employee_id, AppUsage.app),
+    "idle time of the day": select(Timesheet.employee_id, func.sum(Timesheet.idle_seconds)).where(
+        Timesheet.work_date == DAY).group_by(Timesheet.employee_id),
+    "stats of the day": select(DashboardStats.employee_id, DashboardStats.apps_used).where(
+        DashboardStats.stats_date == DAY),
+    # Employee dashboard
+    "stats by employee and day": select(DashboardStats).where(
+        DashboardStats.employee_id == 1, DashboardStats.stats_date == DAY),
+}
+
+
+@pytest.fixture(scope="module")
+def engine(tmp_path_factory):
+    url = f"sqlite:///{tmp_path_factory.mktemp('plans')}/plans.db"
+    engine = create_engine(url, **engine_options(url))
+    upgrade(engine)
+    yield engine
+    engine.dispose()
+
+
+def query_plan(engine, statement) -> list[str]:
+    sql = str(statement.compile(engine, compile_kwargs={"literal_binds": True}))
+    with engine.connect() as conn:
+        return [row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")]
+
+
+@pytest.mark.parametrize("name", HOT_QUERIES)
+def test_hot_query_uses_an_index(engine, name):
+    plan = query_plan(engine, HOT_QUERIES[name])
+    scans = [step for step in plan if step.startswith("SCAN ")]
+    assert not scans, f"{name} scans a table: {plan}"
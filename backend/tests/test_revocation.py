@@ -0,0 +1,111 @@
+"""
+Token revocation and single-use refresh tokens against the redis from
+conftest (a real one when TEST_REDIS_URL is set)
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+import pytest
+from auth import jwt_hasher
+from auth.principal_cache import PrincipalCache
+from auth.revocation import RevocationList, BloomFilter, REVOKED_TOKENS, used_refresh_key
+from model import User
+
+USER_ID = 9201
+
+
+@pytest.fixture
+def redis(redis_factory):
+    return redis_factory.sync_client()
+
+
+def worker(redis) -> RevocationList:
+    """One process's view of the revocation list, refreshed on every check"""
+    return RevocationList(redis, refresh_seconds=0)
+
+
+def access_payload(issued_at: float, jti: str | None = None) -> dict:
+    return {"id": USER_ID, "type": "access", "jti": jti or uuid4().hex, "iat": int(issued_at)}
+
+
+def test_refresh_token_is_claimed_once(redis):
+    revocations = worker(redis)
+    expires_at = time.time() + 3600
+
+    assert revocations.claim_refresh_token("abc", expires_at)
+    assert not revocations.claim_refresh_token("abc", expires_at)
+    # Another worker sees the claim straight away, without a refresh
+    assert not worker(redis).claim_refresh_token("abc", expires_at)
+    # Kept only as long as the token could be replayed
+    assert 3590 <= redis.ttl(used_refresh_key("abc")) <= 3600
+
+
+def test_concurrent_refreshes_have_one_winner(redis):
+    workers = [worker(redis) for _ in range(8)]
+    expires_at = time.time() + 3600
+
+    with ThreadPoolExecutor(len(workers)) as pool:
+        claims = list(pool.map(lambda w: w.claim_refresh_token("raced", expires_at), workers))
+    assert claims.count(True) == 1
+
+
+def test_revoke_user_tokens_reaches_other_workers(redis, monkeypatch):
+    revocations, other = worker(redis), worker(redis)
+    cache = PrincipalCache()
+    monkeypatch.setattr(jwt_hasher, "revocation_list", revocations)
+    monkeypatch.setattr(jwt_hasher, "principal_cache", cache)
+    cache.set(USER_ID, "signature", User(id=USER_ID, name="Revoked", username="revoked",
+                                         email="revoked@example.com", role="employee", is_active=True))
+    before = access_payload(time.time() - 10)
+
+    jwt_hasher.revoke_user_tokens(USER_ID)
+
+    assert revocations.is_revoked(before)
+    assert other.is_revoked(before)
+    assert other.is_revoked({**before, "type": "refresh"})
+    assert cache.get(USER_ID, "signature") is None
+    # Logging in again right away still works
+    assert not other.is_revoked(access_payload(time.time()))
+
+
+def test_revoked_token_reaches_other_workers(redis):
+    revocations, other = worker(redis), worker(redis)
+    revoked, kept = access_payload(time.time()), access_payload(time.time())
+
+    revocations.revoke_token(revoked["jti"], time.time() + 60)
+
+    assert other.is_revoked(revoked)
+    assert not other.is_revoked(kept)
+
+
+def test_bloom_hit_is_confirmed_in_redis(redis):
+    revocations = worker(redis)
+    payload = access_payload(time.time())
+    revocations._refresh_if_stale()
+    # A false positive: in the filter but never revoked
+    revocations.bloom.add(payload["jti"])
+    revocations.refresh_seconds = 3600
+
+    assert not revocations.is_revoked(payload)
+
+
+def test_expired_revocations_are_dropped(redis):
+    revocations = worker(redis)
+    revocations.revoke_token("expired", time.time() - 1)
+
+    revocations._refresh_if_stale()
+
+    assert redis.zscore(REVOKED_TOKENS, "expired") is None
+    assert "expired" not in revocations.bloom
+
+
+def test_bloom_filter_has_no_false_negatives_and_few_false_positives():
+    bloom = BloomFilter()
+    added = [uuid4().hex for _ in range(10000)]
+    for jti in added:
+        bloom.add(jti)
+
+    assert all(jti in bloom for jti in added)
+    false_positives = sum(uuid4().hex in bloom for _ in range(10000))
+    # About 0.01% at this load with 2^20 bits and 7 hashes
+    assert false_positives < 10
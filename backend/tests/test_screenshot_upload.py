@@ -0,0 +1,29 @@
+"""
+Uploads that are not images are refused before anything is stored, and
+leave nothing behind in the upload spool.
+"""
+import asyncio
+import io
+from types import SimpleNamespace
+import pytest
+from fastapi import HTTPException, UploadFile
+import screenshots
+from api import employee
+
+
+def test_non_image_upload_is_refused_and_cleaned_up(tmp_path, monkeypatch):
+    async def today_timesheet_id(r, session, employee_id):
+        return 1
+
+    spool = tmp_path / "tmp"
+    monkeypatch.setattr(screenshots, "UPLOAD_TMP_DIR", spool)
+    monkeypatch.setattr(screenshots, "SCREENSHOT_DEDUP_DISTANCE", 4)
+    monkeypatch.setattr(employee, "today_timesheet_id", today_timesheet_id)
+    upload = UploadFile(io.BytesIO(b"%PDF-1.7 definitely not a png"), filename="screen.png")
+
+    with pytest.raises(HTTPException) as refused:
+        asyncio.run(employee.upload_screenshot(
+            SimpleNamespace(headers={}), upload, session=None, current_user=SimpleNamespace(id=1)))
+
+    assert refused.value.status_code == 415
+    assert list(spool.iterdir()) == []
@@ -0,0 +1,108 @@
+"""
+Compressed copies and thumbnails of screenshots, with storage and
+bandwidth numbers on a generated sample set. Run with -s to see them.
+"""
+import io
+import random
+from types import SimpleNamespace
+from PIL import Image, ImageDraw, ImageFilter
+import pytest
+import screenshots
+from screenshots import make_variants, screenshot_key, THUMBNAIL_WIDTH, SCREENSHOT_FORMAT
+from storage import LocalStorage
+
+SIZE = (1920, 1080)
+# One screenshot every 5 minutes over a 40 hour week
+WEEK_OF_SCREENSHOTS = 40 * 12
+
+
+def desktop(seed: int) -> Image.Image:
+    """Flat panels, lines of text and an icon grid, like an editor or a browser"""
+    rng = random.Random(seed)
+    image = Image.new("RGB", SIZE, (246, 246, 246))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, SIZE[0], 40), fill=(40, 44, 52))
+    draw.rectangle((0, 40, 280, SIZE[1]), fill=(33, 37, 43))
+    for y in range(60, SIZE[1] - 20, 22):
+        x = 300 + rng.randrange(0, 80)
+        words = " ".join("".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randrange(2, 9)))
+                         for _ in range(rng.randrange(4, 14)))
+        draw.text((x, y), words, fill=rng.choice([(30, 30, 30), (0, 92, 197), (163, 21, 21)]))
+    for i in range(24):
+        x, y = 20 + (i % 4) * 62, 70 + (i // 4) * 62
+        draw.rectangle((x, y, x + 44, y + 44), fill=tuple(rng.randrange(60, 220) for _ in range(3)))
+    return image
+
+
+def photo(seed: int) -> Image.Image:
+    """Noisy, photo-like content such as a video call or an image viewer"""
+    rng = random.Random(seed)
+    noise = Image.frombytes("RGB", (SIZE[0] // 4, SIZE[1] // 4), rng.randbytes(SIZE[0] * SIZE[1] * 3 // 16))
+    return noise.resize(SIZE, Image.BICUBIC).filter(ImageFilter.GaussianBlur(2))
+
+
+def png_bytes(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    storage = LocalStorage(root=tmp_path, accel_prefix="")
+    monkeypatch.setattr(screenshots, "storage", storage)
+    return storage
+
+
+def test_variants_are_smaller_and_thumbnails_keep_the_aspect_ratio(storage):
+    storage.put_bytes("blobs/ab/cd/abcd.png", png_bytes(desktop(0)), "image/png")
+
+    compressed, thumbnail = make_variants("blobs/ab/cd/abcd.png")
+
+    assert compressed == f"blobs/ab/cd/abcd.{SCREENSHOT_FORMAT.lower()}"
+    assert thumbnail == f"blobs/ab/cd/abcd_thumb.{SCREENSHOT_FORMAT.lower()}"
+    with Image.open(storage.path(thumbnail)) as image:
+        assert image.format == SCREENSHOT_FORMAT
+        assert image.size == (THUMBNAIL_WIDTH, THUMBNAIL_WIDTH * SIZE[1] // SIZE[0])
+    assert storage.path(compressed).stat().st_size < storage.path("blobs/ab/cd/abcd.png").stat().st_size
+
+
+def test_served_variant_falls_back_while_variants_are_pending():
+    pending = SimpleNamespace(filepath="blobs/ab/cd/abcd.png", compressed_path=None, thumbnail_path=None)
+    done = SimpleNamespace(filepath="blobs/ab/cd/abcd.png", compressed_path="blobs/ab/cd/abcd.webp",
+                           thumbnail_path="blobs/ab/cd/abcd_thumb.webp")
+
+    assert screenshot_key(pending, "thumb") == "blobs/ab/cd/abcd.png"
+    assert screenshot_key(pending, "full") == "blobs/ab/cd/abcd.png"
+    assert screenshot_key(done, "thumb") == "blobs/ab/cd/abcd_thumb.webp"
+    assert screenshot_key(done, "full") == "blobs/ab/cd/abcd.webp"
+    assert screenshot_key(done, "unknown") is None
+
+
+def test_sample_set_sizes(storage):
+    samples = {"desktop": [desktop(seed) for seed in range(6)], "photo": [photo(seed) for seed in range(2)]}
+    totals = {"original": 0, "full": 0, "thumb": 0}
+
+    for kind, images in samples.items():
+        sizes = {"original": 0, "full": 0, "thumb": 0}
+        for i, image in enumerate(images):
+            original = f"blobs/{kind}/{i}.png"
+            storage.put_bytes(original, png_bytes(image), "image/png")
+            compressed, thumbnail = make_variants(original)
+            for variant, key in (("original", original), ("full", compressed), ("thumb", thumbnail)):
+                sizes[variant] += storage.path(key).stat().st_size
+        for variant in totals:
+            totals[variant] += sizes[variant]
+        print(f"\n{kind}: original {sizes['original'] / len(images) / 1024:,.0f} KiB, "
+              f"{SCREENSHOT_FORMAT} {sizes['full'] / len(images) / 1024:,.0f} KiB, "
+              f"thumbnail {sizes['thumb'] / len(images) / 1024:,.1f} KiB per screenshot")
+
+    count = sum(len(images) for images in samples.values())
+    assert totals["full"] < totals["original"]
+    assert totals["thumb"] * 10 < totals["original"]
+
+    per_screenshot = {variant: size / count for variant, size in totals.items()}
+    print(f"one employee-week gallery ({WEEK_OF_SCREENSHOTS} screenshots): "
+          f"{per_screenshot['original'] * WEEK_OF_SCREENSHOTS / 2**20:,.0f} MiB of originals, "
+          f"{per_screenshot['thumb'] * WEEK_OF_SCREENSHOTS / 2**20:,.1f} MiB of thumbnails; "
+          f"storage per screenshot {per_screenshot['full'] / per_screenshot['original']:.0%} of the PNG")
@@ -0,0 +1,180 @@
+"""
+Draining usage queues against the redis from conftest (a real one when
+TEST_REDIS_URL is set). Rows go to the test database from conftest.
+"""
+import asyncio
+import json
+import time
+from datetime import datetime
+import pytest
+from sqlmodel import Session, select, delete
+from data import engine
+from migrations import upgrade
+from model import AppUsage, User
+from usage_queue import (usage_queue_key, timesheet_queue_key, processing_key, dead_letter_key,
+                         push_usage_events, claim_chunk, parse_usage, usage_rows, insert_usage,
+                         requeue_processing, drain_usage, drain_idle_seconds, drain_registered_queues,
+                         parse_usage_batch, QUEUE_REGISTRY, USAGE_MAX_ATTEMPTS, MAX_BULK_EVENTS)
+from conftest import full_benchmark
+
+EMPLOYEE_ID = 9001
+
+
+def event(app: str, duration=60) -> str:
+    return json.dumps({"event": "usage", "id": f"{app}-event", "app": app, "duration": duration,
+                       "timestamp": datetime(2024, 1, 15, 12).isoformat()})
+
+
+def usage_apps() -> list[str]:
+    with Session(engine) as session:
+        return sorted(session.exec(select(AppUsage.app).where(AppUsage.employee_id == EMPLOYEE_ID)).all())
+
+
+def run(test, redis_factory):
+    async def wrapper():
+        upgrade(engine)
+        with Session(engine) as session:
+            session.exec(delete(AppUsage).where(AppUsage.employee_id == EMPLOYEE_ID))
+            session.commit()
+        r = redis_factory.client()
+        try:
+            await test(r)
+        finally:
+            await r.aclose()
+    asyncio.run(wrapper())
+
+
+def test_replayed_chunk_is_not_inserted_twice(redis_factory):
+    async def test(r):
+        await push_usage_events(r, EMPLOYEE_ID, [event("editor"), event("browser")])
+        # A drain commits its chunk, then dies before acknowledging it
+        processing = processing_key(EMPLOYEE_ID, "crashed")
+        messages = await claim_chunk(r, usage_queue_key(EMPLOYEE_ID), processing, 10)
+        rows, _ = usage_rows(parse_usage(messages)[0], EMPLOYEE_ID, None, "employee")
+        await insert_usage(rows)
+        await requeue_processing(r, processing)
+
+        assert await drain_usage(r, EMPLOYEE_ID, None, "employee") == 0
+        assert usage_apps() == ["browser", "editor"]
+    run(test, redis_factory)
+
+
+def test_rejected_event_is_dead_lettered_after_max_attempts(redis_factory):
+    async def test(r):
+        # A list cannot be stored as a duration, whatever the database
+        await push_usage_events(r, EMPLOYEE_ID, [event("editor"), event("poison", duration=[1]), "not json"])
+
+        assert await drain_usage(r, EMPLOYEE_ID, None, "employee") == 1
+        assert usage_apps() == ["editor"]
+        assert await r.lrange(dead_letter_key(EMPLOYEE_ID), 0, -1) == ["not json"]
+
+        for attempt in range(2, USAGE_MAX_ATTEMPTS + 1):
+            [queued] = await r.lrange(usage_queue_key(EMPLOYEE_ID), 0, -1)
+            assert json.loads(queued)["attempts"] == attempt - 1
+            assert await drain_usage(r, EMPLOYEE_ID, None, "employee") == 0
+
+        assert await r.llen(usage_queue_key(EMPLOYEE_ID)) == 0
+        dead = await r.lrange(dead_letter_key(EMPLOYEE_ID), 0, -1)
+        assert len(dead) == 2
+        assert json.loads(dead[1])["attempts"] == USAGE_MAX_ATTEMPTS
+        assert "error" in json.loads(dead[1])
+    run(test, redis_factory)
+
+
+def test_malformed_queue_head_does_not_stop_registered_drains(redis_factory):
+    async def test(r):
+        with Session(engine) as session:
+            if not session.get(User, EMPLOYEE_ID):
+                session.add(User(id=EMPLOYEE_ID, name="Queue", username="queue", email="queue@example.com",
+                                 password="x", role="employee"))
+                session.commit()
+
+        # Pushed straight onto the queue, so nothing was validated
+        await r.rpush(usage_queue_key(EMPLOYEE_ID), "not json", event("editor"))
+        await r.sadd(QUEUE_REGISTRY, EMPLOYEE_ID)
+
+        with Session(engine) as session:
+            result = await drain_registered_queues(r, session)
+
+        assert result["drained"] == 1
+        assert result["lag"] == [{"employee_id": EMPLOYEE_ID, "queue_length": 2, "oldest_event_age": None}]
+        assert usage_apps() == ["editor"]
+        assert await r.lrange(dead_letter_key(EMPLOYEE_ID), 0, -1) == ["not json"]
+    run(test, redis_factory)
+
+
+def test_batch_errors_are_keyed_by_position():
+    body = json.dumps([
+        {"app": "editor", "duration": 60, "timestamp": "2024-01-15T12:00:00"},
+        "editor",
+        {"app": "browser", "duration": 30},
+        {"app": "", "duration": 30, "timestamp": "2024-01-15T12:01:00"},
+        {"app": "terminal", "duration": 15, "timestamp": "2024-01-15T12:02:00"},
+    ]).encode()
+
+    events, errors = parse_usage_batch(body)
+
+    assert [json.loads(e)["app"] for e in events] == ["editor", "terminal"]
+    assert [error["index"] for error in errors] == [1, 2, 3]
+    assert errors[0]["errors"] == ["Event must be a JSON object"]
+    assert errors[1]["errors"] == ["Field required"]
+    assert errors[2]["errors"] == ["app and duration are required"]
+
+
+def test_ndjson_batch_skips_blank_lines_and_reports_bad_ones():
+    body = b"\n".join([
+        b'{"app": "editor", "duration": 60, "timestamp": "2024-01-15T12:00:00"}',
+        b"",
+        b"{not json",
+        b'  {"app": "browser", "duration": 30, "timestamp": "2024-01-15T12:01:00"}  ',
+    ])
+
+    events, errors = parse_usage_batch(body, ndjson=True)
+
+    assert [json.loads(e)["app"] for e in events] == ["editor", "browser"]
+    # Blank lines do not count towards the positions
+    assert errors == [{"index": 1, "errors": ["Event must be a JSON object"]}]
+
+
+@pytest.mark.parametrize("ndjson", [False, True])
+def test_oversized_batch_is_refused(ndjson):
+    def batch(count: int) -> bytes:
+        raw = [{"app": "editor", "duration": 1, "timestamp": "2024-01-15T12:00:00"}] * count
+        return ("\n".join(json.dumps(e) for e in raw) if ndjson else json.dumps(raw)).encode()
+
+    events, errors = parse_usage_batch(batch(MAX_BULK_EVENTS), ndjson)
+    assert len(events) == MAX_BULK_EVENTS and errors == []
+    with pytest.raises(ValueError, match=str(MAX_BULK_EVENTS)):
+        parse_usage_batch(batch(MAX_BULK_EVENTS + 1), ndjson)
+
+
+def test_non_array_batch_is_refused():
+    with pytest.raises(ValueError):
+        parse_usage_batch(b'{"app": "editor"}')
+
+
+@pytest.mark.parametrize("events", [1000, 10000, pytest.param(100000, marks=full_benchmark)])
+def test_drain_time(redis_factory, events):
+    async def test(r):
+        await push_usage_events(r, EMPLOYEE_ID, [
+            json.dumps({"event": "usage", "id": f"bench-{i}", "app": f"app{i % 20}", "duration": 60,
+                        "timestamp": datetime(2024, 1, 15, 12).isoformat()})
+            for i in range(events)
+        ])
+        await r.rpush(timesheet_queue_key(EMPLOYEE_ID),
+                      *[json.dumps({"event": "idle", "seconds": 30}) for _ in range(events)])
+
+        started = time.perf_counter()
+        assert await drain_usage(r, EMPLOYEE_ID, None, "employee") == events
+        usage_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        assert await drain_idle_seconds(r, EMPLOYEE_ID) == 30 * events
+        idle_seconds = time.perf_counter() - started
+
+        assert await r.llen(usage_queue_key(EMPLOYEE_ID)) == 0
+        assert await r.llen(timesheet_queue_key(EMPLOYEE_ID)) == 0
+        with Session(engine) as session:
+            assert len(session.exec(select(AppUsage.id).where(AppUsage.employee_id == EMPLOYEE_ID)).all()) == events
+        print(f"\n{events:,} queued events: usage drained in {usage_seconds * 1000:.0f} ms "
+              f"({events / usage_seconds:,.0f}/s), idle events in {idle_seconds * 1000:.0f} ms")
+    run(test, redis_factory)
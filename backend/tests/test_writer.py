@@ -0,0 +1,127 @@
+"""
+The single-writer queue and SQLite pragmas, with a benchmark of parallel
+syncing clients against a throwaway SQLite database
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import pytest
+from sqlalchemy import insert, event, func, text
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, create_engine, select
+from data import engine, engine_options, apply_sqlite_pragmas
+from migrations import upgrade
+from model import User, AppUsage
+from writer import WriteQueue, writer
+from conftest import full_benchmark
+
+# Each client syncs this many times, with this many usage rows per sync
+SYNCS = 20
+ROWS_PER_SYNC = 50
+
+
+@pytest.fixture
+def sqlite_engine(tmp_path):
+    url = f"sqlite:///{tmp_path}/writer.db"
+    engine = create_engine(url, **engine_options(url))
+    event.listen(engine, "connect", apply_sqlite_pragmas)
+    upgrade(engine)
+    yield engine
+    engine.dispose()
+
+
+def sync_job(employee_id: int):
+    rows = [{"employee_id": employee_id, "role": "employee", "app": "editor", "duration": 60,
+             "timestamp": datetime(2024, 1, 15, 12)} for _ in range(ROWS_PER_SYNC)]
+
+    def job(session: Session) -> int:
+        session.execute(insert(AppUsage), rows)
+        return len(rows)
+    return job
+
+
+def test_connections_use_wal_and_busy_timeout(sqlite_engine):
+    with sqlite_engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert connection.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+        assert connection.execute(text("PRAGMA busy_timeout")).scalar() > 0
+
+
+def test_failing_job_only_fails_its_caller(sqlite_engine):
+    writer = WriteQueue(sqlite_engine, max_wait_ms=50)
+
+    def bad_job(session: Session):
+        session.execute(insert(AppUsage), [{"employee_id": 1, "role": None, "app": "editor", "duration": 60}])
+
+    # Submitted together so they land in the same batch
+    futures = [writer.submit(sync_job(1)), writer.submit(bad_job), writer.submit(sync_job(1))]
+
+    assert futures[0].result() == ROWS_PER_SYNC
+    with pytest.raises(Exception):
+        futures[1].result()
+    assert futures[2].result() == ROWS_PER_SYNC
+    with Session(sqlite_engine) as session:
+        assert session.exec(select(func.count(AppUsage.id))).one() == 2 * ROWS_PER_SYNC
+
+
+def test_writer_does_not_wait_on_the_shared_pool():
+    # As when every pooled connection belongs to a request awaiting the writer
+    held = [engine.connect() for _ in range(engine.pool.size() + engine.pool._max_overflow)]
+    try:
+        assert writer.submit(lambda session: session.execute(text("SELECT 1")).scalar()).result(timeout=5) == 1
+    finally:
+        for connection in held:
+            connection.close()
+
+
+@pytest.mark.parametrize("clients", [8, pytest.param(64, marks=full_benchmark)])
+@pytest.mark.parametrize("single_writer", [True, False])
+def test_parallel_syncing_clients(sqlite_engine, clients, single_writer):
+    with Session(sqlite_engine) as session:
+        session.execute(insert(User), [
+            {"name": f"Client {i}", "username": f"client{i}", "email": f"client{i}@example.com",
+             "password": "x", "role": "employee"} for i in range(clients)
+        ])
+        session.commit()
+        employee_ids = session.exec(select(User.id)).all()
+
+    writer = WriteQueue(sqlite_engine, enabled=single_writer)
+    locked = []
+    reads = 0
+    writing = threading.Event()
+
+    def client(employee_id: int) -> None:
+        for _ in range(SYNCS):
+            try:
+                writer.run(sync_job(employee_id))
+            except OperationalError as e:
+                locked.append(e)
+
+    def reader() -> None:
+        # Dashboards keep reading while clients sync
+        nonlocal reads
+        while writing.is_set():
+            with Session(sqlite_engine) as session:
+                session.exec(select(func.count(AppUsage.id))).one()
+            reads += 1
+
+    writing.set()
+    read_thread = threading.Thread(target=reader)
+    read_thread.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        list(pool.map(client, employee_ids))
+    seconds = time.perf_counter() - started
+    writing.clear()
+    read_thread.join()
+
+    syncs = clients * SYNCS - len(locked)
+    with Session(sqlite_engine) as session:
+        assert session.exec(select(func.count(AppUsage.id))).one() == syncs * ROWS_PER_SYNC
+    if single_writer:
+        assert locked == []
+
+    mode = "single writer" if single_writer else "one transaction per sync"
+    print(f"\n{clients} clients, {mode}: {syncs / seconds:,.0f} syncs/s, "
+          f"{len(locked)} locked, {reads} reads alongside")
@@ -0,0 +1,71 @@
+"""
+Load test of the WebSocket fan-out: one connection manager holds many
+idle sockets, against the redis from conftest (a real one when
+TEST_REDIS_URL is set). Run with -s to see CPU use and delivery latency.
+"""
+import asyncio
+import statistics
+import time
+import pytest
+from sockets import ws
+from sockets.ws import WSConnectionManager, notify, worker_channel
+from conftest import full_benchmark
+
+# How long the sockets sit idle, and how many users are then notified
+IDLE_SECONDS = 1
+NOTIFIED = 100
+
+
+class FakeSocket():
+    def __init__(self):
+        self.received = asyncio.Queue()
+
+    async def accept(self):
+        pass
+
+    async def send_json(self, data):
+        await self.received.put((time.perf_counter(), data))
+
+
+@pytest.mark.parametrize("sockets", [2000, pytest.param(10000, marks=full_benchmark)])
+def test_idle_sockets_cost_nothing(redis_factory, monkeypatch, sockets):
+    async def run():
+        redis = redis_factory.client()
+        monkeypatch.setattr(ws, "r", redis)
+        manager = WSConnectionManager()
+        manager.redis = redis
+        try:
+            await manager.start()
+            channel = worker_channel(manager.worker_id)
+            while dict(await redis.pubsub_numsub(channel)).get(channel, 0) < 1:
+                await asyncio.sleep(0.01)
+            held = {f"user{i}@example.com": FakeSocket() for i in range(sockets)}
+            for email, socket in held.items():
+                await manager.connect(email, socket)
+
+            cpu, wall = time.process_time(), time.perf_counter()
+            await asyncio.sleep(IDLE_SECONDS)
+            idle_cpu = (time.process_time() - cpu) / (time.perf_counter() - wall)
+
+            latencies = []
+            for email in list(held)[:NOTIFIED]:
+                sent = time.perf_counter()
+                assert await notify(email, "hello") == 1
+                received, data = await asyncio.wait_for(held[email].received.get(), 2)
+                assert data == {"message": "hello"}
+                latencies.append((received - sent) * 1000)
+            assert all(socket.received.empty() for socket in held.values())
+        finally:
+            for task in manager.tasks:
+                task.cancel()
+            await asyncio.gather(*manager.tasks, return_exceptions=True)
+            await redis.aclose()
+
+        # Nothing wakes up per socket, so sitting idle costs no more CPU
+        # whatever the number of sockets
+        assert idle_cpu < 0.05
+        print(f"\n{sockets:,} idle sockets: {idle_cpu:.1%} of a CPU while idle, delivery latency "
+              f"p50 {statistics.median(latencies):.2f} ms, "
+              f"p99 {statistics.quantiles(latencies, n=100, method='inclusive')[98]:.2f} ms")
+
+    asyncio.run(run())
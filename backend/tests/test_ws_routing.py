@@ -0,0 +1,108 @@
+"""
+Per-worker WebSocket routing against the redis from conftest (a real one
+when TEST_REDIS_URL is set). Several connection managers stand in for
+several API workers.
+"""
+import asyncio
+from redis.asyncio import Redis
+from sockets import ws
+from sockets.ws import WSConnectionManager, notify, worker_channel
+
+
+class FakeSocket():
+    def __init__(self):
+        self.received = asyncio.Queue()
+
+    async def accept(self):
+        pass
+
+    async def send_json(self, data):
+        await self.received.put(data)
+
+
+class StalledSocket(FakeSocket):
+    async def send_json(self, data):
+        await asyncio.sleep(3600)
+
+
+class ClosedSocket(FakeSocket):
+    async def send_json(self, data):
+        raise RuntimeError("socket is closed")
+
+
+async def subscribed(redis: Redis, manager: WSConnectionManager) -> None:
+    """Wait for the manager's listener to be on its worker channel"""
+    channel = worker_channel(manager.worker_id)
+    while dict(await redis.pubsub_numsub(channel)).get(channel, 0) < 1:
+        await asyncio.sleep(0.01)
+
+
+def test_notify_reaches_sockets_on_every_worker(redis_factory, monkeypatch):
+    async def run():
+        redis = redis_factory.client()
+        monkeypatch.setattr(ws, "r", redis)
+        workers = [WSConnectionManager(), WSConnectionManager(), WSConnectionManager()]
+        for manager in workers:
+            manager.redis = redis
+        first, second, idle = workers
+        email = "routing-test@example.com"
+        await redis.delete(ws.routes_key(email))
+        try:
+            for manager in workers:
+                await manager.start()
+                await subscribed(redis, manager)
+            sockets = [FakeSocket(), FakeSocket()]
+            conn_ids = [await first.connect(email, sockets[0]), await second.connect(email, sockets[1])]
+
+            # Published to the two workers holding a socket, not the idle one
+            assert await notify(email, "hello") == 2
+            for socket in sockets:
+                assert await asyncio.wait_for(socket.received.get(), 2) == {"message": "hello"}
+
+            await second.disconnect(email, conn_ids[1])
+            assert await notify(email, "again") == 1
+            assert await asyncio.wait_for(sockets[0].received.get(), 2) == {"message": "again"}
+            assert sockets[1].received.empty()
+            await first.disconnect(email, conn_ids[0])
+        finally:
+            for manager in workers:
+                for task in manager.tasks:
+                    task.cancel()
+                await asyncio.gather(*manager.tasks, return_exceptions=True)
+            await redis.delete(ws.routes_key(email))
+            await redis.aclose()
+
+    asyncio.run(run())
+
+
+def test_stalled_and_closed_sockets_are_dropped_without_delaying_others(redis_factory, monkeypatch):
+    async def run():
+        redis = redis_factory.client()
+        monkeypatch.setattr(ws, "r", redis)
+        monkeypatch.setattr(ws, "SEND_TIMEOUT", 0.2)
+        manager = WSConnectionManager()
+        manager.redis = redis
+        email = "fanout-test@example.com"
+        try:
+            await manager.start()
+            await subscribed(redis, manager)
+            healthy, stalled, closed = FakeSocket(), StalledSocket(), ClosedSocket()
+            for socket in (stalled, closed, healthy):
+                await manager.connect(email, socket)
+
+            assert await notify(email, "hello") == 1
+            # Delivered while the stalled socket is still waiting on its send
+            assert await asyncio.wait_for(healthy.received.get(), 0.1) == {"message": "hello"}
+
+            # Then both bad sockets are disconnected once the timeout passes
+            while len(manager.connections[email]) > 1:
+                await asyncio.sleep(0.01)
+            assert list(manager.connections[email].values()) == [healthy]
+            assert await redis.zcard(ws.routes_key(email)) == 1
+        finally:
+            for task in manager.tasks:
+                task.cancel()
+            await asyncio.gather(*manager.tasks, return_exceptions=True)
+            await redis.aclose()
+
+    asyncio.run(run())
@@ -0,0 +1,486 @@
+import hashlib
+import json
+import time
+from datetime import datetime, date
+from uuid import uuid4
+from decouple import config
+from pydantic import ValidationError
+from redis.asyncio import Redis
+from sqlmodel import Session, select
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError, InterfaceError, TimeoutError as PoolTimeoutError
+from model import AppUsage, User, Timesheet
+from schema import UsageCreate
+from live_stats import record_usage
+from sockets.activity import publish_activity
+from writer import writer
+from data import insert_ignore
+
+# Values sent per RPUSH command inside one pipeline
+PUSH_CHUNK_SIZE = 1000
+# Upper bound on events accepted by a single bulk request
+MAX_BULK_EVENTS = 5000
+# Messages popped from redis and inserted per round trip while draining
+DRAIN_CHUNK_SIZE: int = config('DRAIN_CHUNK_SIZE', cast=int, default=500)
+# Processing lists claimed longer ago than this are considered orphaned
+PROCESSING_STALE_SECONDS = 300
+# Sorted set of in-flight processing lists, scored by claim time
+PROCESSING_REGISTRY = "usage_processing"
+# Set of employee ids whose usage queue may be non-empty
+QUEUE_REGISTRY = "usage_queues"
+# Drains an event may fail in before it is moved to the dead-letter list
+USAGE_MAX_ATTEMPTS: int = config('USAGE_MAX_ATTEMPTS', cast=int, default=5)
+# The database was unreachable or busy rather than refusing the rows
+TRANSIENT_DB_ERRORS = (OperationalError, InterfaceError, PoolTimeoutError)
+
+# Atomically move up to ARGV[1] messages from the head of KEYS[1]
+# to the processing list KEYS[2] and register it in KEYS[3]
+CLAIM_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    redis.call('RPUSH', KEYS[2], unpack(items))
+    redis.call('ZADD', KEYS[3], ARGV[2], KEYS[2])
+end
+return items
+"""
+
+# Put everything in the processing list KEYS[1] back at the head of
+# KEYS[2] in its original order and forget about it
+REQUEUE_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+for i = #items, 1, -1 do
+    redis.call('LPUSH', KEYS[2], items[i])
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[3], KEYS[1])
+if #items > 0 then
+    redis.call('SADD', KEYS[4], ARGV[1])
+end
+return #items
+"""
+
+# Drop employee ARGV[1] from the registry KEYS[2] if its queue KEYS[1]
+# is empty; checked atomically so a concurrent push is never missed
+UNREGISTER_SCRIPT = """
+if redis.call('LLEN', KEYS[1]) == 0 then
+    return redis.call('SREM', KEYS[2], ARGV[1])
+end
+return 0
+"""
+
+
+def usage_queue_key(user_id: int) -> str:
+    return f"queue_usage_{user_id}"
+
+
+def timesheet_queue_key(user_id: int) -> str:
+    return f"timesheet_{user_id}"
+
+
+def dead_letter_key(user_id: int) -> str:
+    return f"usage_dead_{user_id}"
+
+
+def processing_key(user_id: int, drain_id: str) -> str:
+    return f"processing_usage_{user_id}:{drain_id}"
+
+
+def processing_owner(key: str) -> int:
+    """Employee id a processing list belongs to"""
+    return int(key.split(":", 1)[0].rsplit("_", 1)[1])
+
+
+def usage_event(usage: UsageCreate) -> str:
+    """Serialize a validated usage payload the way the drain expects it"""
+    return json.dumps({
+        "event": "usage",
+        "id": uuid4().hex,
+        "app": usage.app,
+        "duration": usage.duration,
+        "timestamp": usage.timestamp.isoformat(),
+        "queued_at": time.time()
+    })
+
+
+def parse_usage_batch(body: bytes, ndjson: bool = False) -> tuple[list[str], list[dict]]:
+    """
+    Validate a batch of usage events sent as a JSON array or as NDJSON.
+    Returns the serialized valid events and one error entry per rejected
+    event, keyed by its position in the batch.
+    """
+    if ndjson:
+        raw_events = []
+        for line in body.decode("utf-8").splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                raw_events.append(json.loads(line))
+            except ValueError:
+                raw_events.append(None)
+    else:
+        raw_events = json.loads(body)
+        if not isinstance(raw_events, list):
+            raise ValueError("Expected a JSON array of usage events")
+
+    if len(raw_events) > MAX_BULK_EVENTS:
+        raise ValueError(f"A batch can contain at most {MAX_BULK_EVENTS} events")
+
+    events, errors = [], []
+    for index, raw in enumerate(raw_events):
+        if not isinstance(raw, dict):
+            errors.append({"index": index, "errors": ["Event must be a JSON object"]})
+            continue
+        try:
+            usage = UsageCreate.model_validate(raw)
+        except ValidationError as e:
+            errors.append({"index": index, "errors": [err["msg"] for err in e.errors()]})
+            continue
+        if not usage.app or not usage.duration:
+            errors.append({"index": index, "errors": ["app and duration are required"]})
+            continue
+        events.append(usage_event(usage))
+
+    return events, errors
+
+
+async def push_usage_events(r: Redis, user_id: int, events: list[str]) -> int:
+    """
+    Append already serialized usage events to the user's queue.
+    Large batches are split into several RPUSH commands but sent
+    in a single pipeline, so the whole batch costs one round trip.
+    """
+    if not events:
+        return 0
+
+    queue = usage_queue_key(user_id)
+    async with r.pipeline(transaction=False) as pipe:
+        for i in range(0, len(events), PUSH_CHUNK_SIZE):
+            pipe.rpush(queue, *events[i:i + PUSH_CHUNK_SIZE])
+        pipe.sadd(QUEUE_REGISTRY, user_id)
+        await pipe.execute()
+
+    return len(events)
+
+
+async def pop_chunk(r: Redis, queue: str, count: int) -> list[str]:
+    """Pop up to `count` messages from the head of a list in one MULTI/EXEC"""
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.lrange(queue, 0, count - 1)
+        pipe.ltrim(queue, count, -1)
+        messages, _ = await pipe.execute()
+    return messages
+
+
+def parse_usage(messages: list[str]) -> tuple[dict[str, dict], list[str]]:
+    """
+    Decode raw queue messages. Returns the events keyed by their id, which
+    is what makes inserting them idempotent, and the messages that could
+    not be decoded. Events queued before ids existed are keyed by a hash
+    of the message, which is just as stable across replays.
+    """
+    events, malformed = {}, []
+    for msg in messages:
+        try:
+            data = json.loads(msg)
+        except ValueError:
+            malformed.append(msg)
+            continue
+        if not isinstance(data, dict):
+            malformed.append(msg)
+            continue
+        data.setdefault("id", hashlib.sha256(msg.encode()).hexdigest())
+        events[data["id"]] = data
+    return events, malformed
+
+
+def usage_rows(events: dict[str, dict], employee_id: int, timesheet_id: int | None,
+               role: str) -> tuple[list[dict], list[str]]:
+    """
+    Turn decoded events into AppUsage rows, skipping incomplete events.
+    Also returns the ids of events whose values cannot be read.
+    """
+    rows, malformed = [], []
+    for event_id, data in events.items():
+        if data.get("event") != "usage":
+            continue
+        if not data.get("app") or not data.get("duration") or not data.get("timestamp"):
+            continue
+
+        try:
+            timestamp = datetime.fromisoformat(data["timestamp"])
+        except (TypeError, ValueError):
+            malformed.append(event_id)
+            continue
+        rows.append({
+            "employee_id": employee_id,
+            "timesheet_id": timesheet_id,
+            "role": role,
+            "app": data["app"],
+            "duration": data["duration"],
+            "timestamp": timestamp,
+            "event_id": event_id
+        })
+    return rows, malformed
+
+
+async def insert_usage(rows: list[dict]) -> list[dict]:
+    """
+    Insert AppUsage rows with one executemany INSERT through the write
+    queue, skipping events that are already in the table, e.g. from a
+    chunk whose drain died between commit and acknowledgement. Returns
+    the rows actually inserted.
+    """
+    if not rows:
+        return []
+
+    def insert_new(session: Session) -> list[dict]:
+        event_ids = [row["event_id"] for row in rows]
+        known = set(session.exec(select(AppUsage.event_id).where(AppUsage.event_id.in_(event_ids))).all())
+        new_rows = [row for row in rows if row["event_id"] not in known]
+        # The unique index settles a race with a replay of the same chunk
+        if new_rows and not insert_ignore(session, AppUsage, new_rows, ["event_id"]):
+            session.execute(insert(AppUsage), new_rows)
+        return new_rows
+
+    return await writer.run_async(insert_new)
+
+
+async def insert_usage_each(rows: list[dict]) -> tuple[list[dict], dict[str, Exception]]:
+    """
+    Insert rows one at a time after their chunk was refused, so only the
+    events the database rejects are held back. Returns the inserted rows
+    and the error of each rejected event.
+    """
+    inserted, failed = [], {}
+    for row in rows:
+        try:
+            inserted += await insert_usage([row])
+        except TRANSIENT_DB_ERRORS:
+            raise
+        except Exception as e:
+            failed[row["event_id"]] = e
+    return inserted, failed
+
+
+def retry_or_dead(events: dict[str, dict], failed: dict[str, Exception]) -> tuple[list[str], list[str]]:
+    """
+    Messages to queue again with their attempt counted, and those out of
+    attempts for the dead-letter list
+    """
+    retry, dead = [], []
+    for event_id, error in failed.items():
+        data = {**events[event_id], "attempts": events[event_id].get("attempts", 0) + 1}
+        if data["attempts"] >= USAGE_MAX_ATTEMPTS:
+            dead.append(json.dumps({**data, "error": str(error)[:500]}))
+        else:
+            retry.append(json.dumps(data))
+    return retry, dead
+
+
+async def claim_chunk(r: Redis, queue: str, processing: str, count: int) -> list[str]:
+    """Move up to `count` messages from `queue` into a processing list"""
+    claim = r.register_script(CLAIM_SCRIPT)
+    return await claim(keys=[queue, processing, PROCESSING_REGISTRY], args=[count, time.time()])
+
+
+async def ack_chunk(r: Redis, processing: str, employee_id: int, rows: list[dict],
+                    retry: list[str] | None = None, dead: list[str] | None = None) -> None:
+    """
+    Drop a processing list once its messages are committed and bump the
+    live dashboard counters for the committed rows in the same MULTI.
+    Messages in `retry` go back to the head of the queue and those in
+    `dead` to the employee's dead-letter list, in that MULTI as well.
+    """
+    async with r.pipeline(transaction=True) as pipe:
+        if retry:
+            pipe.lpush(usage_queue_key(employee_id), *reversed(retry))
+            pipe.sadd(QUEUE_REGISTRY, employee_id)
+        if dead:
+            pipe.rpush(dead_letter_key(employee_id), *dead)
+        pipe.delete(processing)
+        pipe.zrem(PROCESSING_REGISTRY, processing)
+        record_usage(pipe, employee_id, rows)
+        await pipe.execute()
+
+
+async def requeue_processing(r: Redis, processing: str) -> int:
+    """Return an unacknowledged processing list to the head of its queue"""
+    requeue = r.register_script(REQUEUE_SCRIPT)
+    owner = processing_owner(processing)
+    return await requeue(keys=[processing, usage_queue_key(owner), PROCESSING_REGISTRY, QUEUE_REGISTRY],
+                         args=[owner])
+
+
+async def unregister_if_empty(r: Redis, employee_id: int) -> None:
+    unregister = r.register_script(UNREGISTER_SCRIPT)
+    await unregister(keys=[usage_queue_key(employee_id), QUEUE_REGISTRY], args=[employee_id])
+
+
+async def drain_usage(r: Redis, employee_id: int, timesheet_id: int | None,
+                      role: str, chunk_size: int = DRAIN_CHUNK_SIZE) -> int:
+    """
+    Move everything queued for an employee into AppUsage, exactly once.
+    Each chunk is moved atomically to a processing list, inserted through
+    the write queue and committed before the processing list is dropped;
+    events carry ids, so a chunk replayed after a crash in between is
+    not inserted twice. If the database is unavailable the chunk goes
+    back to the head of the queue, and if the process dies the recovery
+    sweep puts it back instead. If the database refuses the chunk its
+    events are inserted one by one; the rejected ones are queued again
+    and moved to the dead-letter list after USAGE_MAX_ATTEMPTS drains,
+    so one bad event cannot hold up the queue for good.
+    """
+    queue = usage_queue_key(employee_id)
+    processing = processing_key(employee_id, uuid4().hex)
+    synced = 0
+
+    while True:
+        messages = await claim_chunk(r, queue, processing, chunk_size)
+        if not messages:
+            break
+
+        events, dead = parse_usage(messages)
+        rows, unreadable = usage_rows(events, employee_id, timesheet_id, role)
+        dead += [json.dumps(events[event_id]) for event_id in unreadable]
+        retry = []
+        try:
+            try:
+                rows = await insert_usage(rows)
+            except TRANSIENT_DB_ERRORS:
+                raise
+            except Exception:
+                rows, failed = await insert_usage_each(rows)
+                retry, failed_dead = retry_or_dead(events, failed)
+                dead += failed_dead
+        except Exception:
+            await requeue_processing(r, processing)
+            raise
+
+        await ack_chunk(r, processing, employee_id, rows, retry, dead)
+        synced += len(rows)
+        if rows:
+            apps: dict[str, int] = {}
+            for row in rows:
+                apps[row["app"]] = apps.get(row["app"], 0) + row["duration"]
+            await publish_activity(r, "usage_synced", employee_id=employee_id,
+                                   timesheet_id=timesheet_id, apps=apps)
+
+        # Requeued events are retried on the next drain, not straight away
+        if retry or len(messages) < chunk_size:
+            break
+
+    await unregister_if_empty(r, employee_id)
+    return synced
+
+
+async def recover_processing(r: Redis, older_than: float = PROCESSING_STALE_SECONDS) -> int:
+    """
+    Replay processing lists left behind by drains that died between
+    claiming a chunk and acknowledging it. Only lists older than
+    `older_than` seconds are touched so live drains are left alone.
+    """
+    cutoff = time.time() - older_than
+    orphaned = await r.zrangebyscore(PROCESSING_REGISTRY, "-inf", cutoff)
+
+    replayed = 0
+    for processing in orphaned:
+        replayed += await requeue_processing(r, processing)
+    return replayed
+
+
+def queued_at(message: str | None) -> float | None:
+    """
+    When a queued message was pushed, or None if that cannot be told.
+    Malformed messages are left for drain_usage to dead-letter.
+    """
+    if not message:
+        return None
+    try:
+        value = json.loads(message).get("queued_at")
+        return float(value) if value is not None else None
+    except (ValueError, AttributeError, TypeError):
+        return None
+
+
+async def queue_lag(r: Redis) -> list[dict]:
+    """
+    Queue length and age of the oldest queued event for every employee
+    in the registry, most lagging first.
+    """
+    employee_ids = [int(i) for i in await r.smembers(QUEUE_REGISTRY)]
+    if not employee_ids:
+        return []
+
+    async with r.pipeline(transaction=False) as pipe:
+        for employee_id in employee_ids:
+            pipe.llen(usage_queue_key(employee_id))
+            pipe.lindex(usage_queue_key(employee_id), 0)
+        results = await pipe.execute()
+
+    now = time.time()
+    lag = []
+    for i, employee_id in enumerate(employee_ids):
+        length, oldest = results[2 * i], queued_at(results[2 * i + 1])
+        lag.append({
+            "employee_id": employee_id,
+            "queue_length": length,
+            "oldest_event_age": round(now - oldest, 3) if oldest else None
+        })
+
+    lag.sort(key=lambda x: x["oldest_event_age"] or 0, reverse=True)
+    return lag
+
+
+async def drain_registered_queues(r: Redis, session: Session, chunk_size: int = DRAIN_CHUNK_SIZE) -> dict:
+    """
+    Drain every queue in the registry, attaching rows to the employee's
+    timesheet for today when there is one. Used by the background worker
+    so usage reaches the database even if the client never syncs.
+    """
+    await recover_processing(r)
+    lag = await queue_lag(r)
+    employee_ids = [entry["employee_id"] for entry in lag]
+    if not employee_ids:
+        return {"drained": 0, "lag": lag}
+
+    roles = dict(session.exec(
+        select(User.id, User.role).where(User.id.in_(employee_ids))
+    ).all())
+    timesheets = dict(session.exec(
+        select(Timesheet.employee_id, Timesheet.id).where(
+            Timesheet.employee_id.in_(employee_ids),
+            Timesheet.work_date == date.today())
+    ).all())
+
+    drained = 0
+    for employee_id in employee_ids:
+        # Leave queues of unknown users alone rather than dropping their data
+        if employee_id not in roles:
+            continue
+        drained += await drain_usage(r, employee_id, timesheets.get(employee_id),
+                                     roles[employee_id], chunk_size)
+
+    return {"drained": drained, "lag": lag}
+
+
+async def drain_idle_seconds(r: Redis, employee_id: int, chunk_size: int = DRAIN_CHUNK_SIZE) -> int:
+    """Drain the timesheet event queue and return the idle seconds it reported"""
+    queue = timesheet_queue_key(employee_id)
+    idle_seconds = 0
+
+    while True:
+        messages = await pop_chunk(r, queue, chunk_size)
+        if not messages:
+            break
+
+        for msg in messages:
+            data = json.loads(msg)
+            if data.get("event") == "idle":
+                idle_seconds += int(data["seconds"])
+
+        if len(messages) < chunk_size:
+            break
+
+    return idle_seconds
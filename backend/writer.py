@@ -0,0 +1,108 @@
+import asyncio
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable
+from decouple import config
+from sqlalchemy import Engine
+from sqlmodel import Session
+from data import engine, create_writer_engine
+
+# Funnel writes through one thread; on by default for SQLite only
+DB_SINGLE_WRITER: bool = config('DB_SINGLE_WRITER', cast=bool, default=engine.dialect.name == "sqlite")
+# Most jobs committed together, and how long to wait for more to arrive
+DB_WRITER_BATCH: int = config('DB_WRITER_BATCH', cast=int, default=100)
+DB_WRITER_WAIT_MS: int = config('DB_WRITER_WAIT_MS', cast=int, default=5)
+
+WriteJob = Callable[[Session], Any]
+
+
+class WriteQueue():
+    """
+    Runs write jobs (callables taking a Session) on a single thread and
+    commits them in batches, so SQLite only ever sees one writer from this
+    process and readers are never blocked by a pile of small transactions.
+    If a batch fails its jobs are retried one by one, so one bad job only
+    fails its own caller. When disabled (e.g. on PostgreSQL) every job runs
+    in its own session and transaction in the caller's thread.
+    """
+    def __init__(self, engine: Engine, enabled: bool = True,
+                 max_batch: int = DB_WRITER_BATCH, max_wait_ms: int = DB_WRITER_WAIT_MS):
+        self.engine = engine
+        self.enabled = enabled
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.jobs: queue.Queue = queue.Queue()
+        self.thread: threading.Thread | None = None
+        self.pid: int | None = None
+        self.lock = threading.Lock()
+
+    def submit(self, job: WriteJob) -> Future:
+        future = Future()
+        if not self.enabled:
+            try:
+                future.set_result(self._run_alone(job))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        self._ensure_thread()
+        self.jobs.put((job, future))
+        return future
+
+    def run(self, job: WriteJob) -> Any:
+        """Run a write job and wait for its commit"""
+        return self.submit(job).result()
+
+    async def run_async(self, job: WriteJob) -> Any:
+        """Run a write job without blocking the event loop"""
+        if not self.enabled:
+            return await asyncio.to_thread(self._run_alone, job)
+        return await asyncio.wrap_future(self.submit(job))
+
+    def _ensure_thread(self) -> None:
+        # Also restarts the thread in a forked child (e.g. Celery prefork workers)
+        with self.lock:
+            if self.thread and self.thread.is_alive() and self.pid == os.getpid():
+                return
+            if self.pid != os.getpid():
+                self.jobs = queue.Queue()
+                self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._worker, name="db-writer", daemon=True)
+            self.thread.start()
+
+    def _worker(self) -> None:
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.jobs.get(timeout=self.max_wait))
+                except queue.Empty:
+                    break
+            self._run_batch(batch)
+
+    def _run_batch(self, batch: list) -> None:
+        try:
+            with Session(self.engine, expire_on_commit=False) as session:
+                results = [job(session) for job, _ in batch]
+                session.commit()
+        except Exception:
+            for job, future in batch:
+                try:
+                    future.set_result(self._run_alone(job))
+                except Exception as e:
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _run_alone(self, job: WriteJob) -> Any:
+        with Session(self.engine, expire_on_commit=False) as session:
+            result = job(session)
+            session.commit()
+            return result
+
+
+writer = WriteQueue(create_writer_engine() if DB_SINGLE_WRITER else engine, enabled=DB_SINGLE_WRITER)
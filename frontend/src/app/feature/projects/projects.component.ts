@@ -3,6 +3,7 @@ import { Component, OnInit} from '@angular/core';
 import { HttpClient, HttpClientModule } from '@angular/common/http';
 import { CommonModule } from '@angular/common';
 import { FormsModule } from '@angular/forms';
+import { getAllPages } from '../../services/pagination';
 
 interface Projects {
   id: number;
@@ -63,7 +64,7 @@ export class ProjectsComponent implements OnInit {
   // ===== ADMIN FUNCTIONS =====
 
   loadEmployees() {
-    this.http.get<Employee[]>('http://localhost:9000/admin/get_all_employees').subscribe({
+    getAllPages<Employee>(this.http, 'http://localhost:9000/admin/get_all_employees').subscribe({
       next: (res) => {
         this.employees = res;
       },
@@ -76,7 +77,7 @@ export class ProjectsComponent implements OnInit {
 
   loadProjects() {
     this.isLoading = true;
-    this.http.get<Projects[]>('http://localhost:9000/admin/view_projects').subscribe({
+    getAllPages<Projects>(this.http, 'http://localhost:9000/admin/view_projects').subscribe({
       next: (res) => {
         this.projects = res;  
         this.isLoading = false;
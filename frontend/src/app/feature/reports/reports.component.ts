@@ -3,6 +3,7 @@ import { Component, OnInit, OnDestroy } from '@angular/core';
 import { HttpClient, HttpClientModule } from '@angular/common/http';
 import { CommonModule } from '@angular/common';
 import { FormsModule } from '@angular/forms';
+import { getAllPages } from '../../services/pagination';
 
 interface Applications {
   id: number;
@@ -51,7 +52,7 @@ export class ReportsComponent implements OnInit {
   }
 
   loadEmployees() {
-    this.http.get<Employee[]>('http://localhost:9000/admin/get_all_employees').subscribe({
+    getAllPages<Employee>(this.http, 'http://localhost:9000/admin/get_all_employees').subscribe({
       next: (res) => {
         this.employees = res;
       },
@@ -67,7 +68,7 @@ export class ReportsComponent implements OnInit {
     this.errorMessage = null;
     this.selectedEmployeeId = null;
 
-    this.http.get<Applications[]>('http://localhost:9000/admin/view_applications').subscribe({
+    getAllPages<Applications>(this.http, 'http://localhost:9000/admin/view_applications').subscribe({
       next: (res) => {
         this.applications = res;
         this.isLoading = false;
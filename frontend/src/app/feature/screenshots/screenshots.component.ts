@@ -4,6 +4,7 @@ import { CommonModule } from '@angular/common';
 import { FormsModule } from '@angular/forms';
 import { AuthService } from '../../services/authservice';
 import { ActivatedRoute } from '@angular/router';
+import { getAllPages } from '../../services/pagination';
 interface Screenshot {
   id: number;
   image_url: string;
@@ -62,7 +63,7 @@ export class ScreenshotsComponent implements OnInit {
 
 
   loadEmployees() {
-    this.http.get<Employee[]>('http://localhost:9000/admin/get_all_employees').subscribe({
+    getAllPages<Employee>(this.http, 'http://localhost:9000/admin/get_all_employees').subscribe({
       next: (res) => {
         this.employees = res;
       },
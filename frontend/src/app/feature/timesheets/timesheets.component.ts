@@ -4,6 +4,7 @@ import { HttpClient } from '@angular/common/http';
 import { CommonModule } from '@angular/common';
 import { FormsModule } from '@angular/forms';
 import { ActivatedRoute } from '@angular/router';
+import { getAllPages } from '../../services/pagination';
 
 interface Timesheet {
   id: number;
@@ -222,7 +223,7 @@ export class TimesheetsComponent implements OnInit, OnDestroy {
 
   loadEmployees(): Promise<void> {
     return new Promise((resolve) => {
-      this.http.get<Employee[]>('http://localhost:9000/admin/get_all_employees').subscribe({
+      getAllPages<Employee>(this.http, 'http://localhost:9000/admin/get_all_employees').subscribe({
         next: (res) => {
           this.employees = res;
           resolve();
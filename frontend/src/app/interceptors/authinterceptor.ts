@@ -1,7 +1,15 @@
-import { HttpInterceptorFn } from '@angular/common/http';
+import { HttpErrorResponse, HttpInterceptorFn, HttpRequest } from '@angular/common/http';
 import { inject } from '@angular/core';
+import { catchError, switchMap, throwError } from 'rxjs';
 import { AuthService } from '../services/authservice';
 
+const withToken = (req: HttpRequest<unknown>, token: string) =>
+  req.clone({
+    setHeaders: {
+      Authorization: `Bearer ${token}`,
+    },
+  });
+
 export const AuthInterceptor: HttpInterceptorFn = (req, next) => {
   const auth = inject(AuthService);
 
@@ -19,11 +27,19 @@ export const AuthInterceptor: HttpInterceptorFn = (req, next) => {
   }
 
   console.log('AuthInterceptor - Adding Bearer token');
-  return next(
-    req.clone({
-      setHeaders: {
-        Authorization: `Bearer ${token}`,
-      },
+  return next(withToken(req, token)).pipe(
+    catchError((error) => {
+      // Access tokens are short lived: refresh once and replay the request
+      if (!(error instanceof HttpErrorResponse) || error.status !== 401 || !auth.getRefreshToken()) {
+        return throwError(() => error);
+      }
+      return auth.refreshAccessToken().pipe(
+        catchError((refreshError) => {
+          auth.logout();
+          return throwError(() => refreshError);
+        }),
+        switchMap((newToken) => next(withToken(req, newToken)))
+      );
     })
   );
-};
\ No newline at end of file
+};
@@ -1,5 +1,8 @@
 import { Injectable, Inject, PLATFORM_ID, signal } from '@angular/core';
 import { isPlatformBrowser } from '@angular/common';
+import { HttpClient, HttpHeaders } from '@angular/common/http';
+import { Observable, defer, firstValueFrom, throwError } from 'rxjs';
+import { finalize, map, shareReplay, tap } from 'rxjs/operators';
 import { invoke } from '@tauri-apps/api/core';
 
 interface TokenPayload {
@@ -7,11 +10,33 @@ interface TokenPayload {
   username: string;
   role: string;
   id: number;
+  exp?: number;
 }
 
+interface TokenResponse {
+  access_token: string;
+  refresh_token: string;
+}
+
+// Refresh this long before the access token expires, so the desktop agent
+// (which gets the token through set_auth_token) never holds an expired one
+const REFRESH_MARGIN_MS = 60 * 1000;
+
+// Web Lock held while a tab spends the refresh token that all tabs share
+const REFRESH_LOCK = 'auth-refresh';
+
 @Injectable({ providedIn: 'root' })
 export class AuthService {
   private ACCESS_TOKEN = 'token';
+  private REFRESH_TOKEN = 'refresh_token';
+  private refreshUrl = 'http://localhost:9000/auth/refresh';
+  private logoutUrl = 'http://localhost:9000/auth/logout';
+
+  // One refresh at a time: refresh tokens are single use, so parallel 401s
+  // must share the same request instead of each spending the token.
+  // Other tabs are kept out by REFRESH_LOCK.
+  private refreshInFlight: Observable<string> | null = null;
+  private refreshTimer: ReturnType<typeof setTimeout> | null = null;
 
   isAuthenticated = signal(false);
   isReady = signal(false);
@@ -19,26 +44,49 @@ export class AuthService {
   userId = signal<number | null>(null);
   username = signal<string | null>(null);
 
-  constructor(@Inject(PLATFORM_ID) private platformId: Object) {
+  constructor(@Inject(PLATFORM_ID) private platformId: Object, private http: HttpClient) {
     if (isPlatformBrowser(this.platformId)) {
       const token = localStorage.getItem(this.ACCESS_TOKEN);
       if (token) {
         this.isAuthenticated.set(true);
         this.decodeToken(token);
         invoke('set_auth_token', { token });
+        this.scheduleRefresh(token);
       }
+      // Another tab refreshed or logged out
+      window.addEventListener('storage', (event) => this.onStorage(event));
     }
     this.isReady.set(true);
   }
 
-  setToken(token: string) {
+  setToken(token: string, refreshToken?: string) {
     if (!isPlatformBrowser(this.platformId)) return;
 
     localStorage.setItem(this.ACCESS_TOKEN, token);
+    if (refreshToken) {
+      localStorage.setItem(this.REFRESH_TOKEN, refreshToken);
+    }
+    this.useToken(token);
+  }
+
+  private useToken(token: string): void {
     this.isAuthenticated.set(true);
     this.decodeToken(token);
 
     invoke('set_auth_token', { token });
+    this.scheduleRefresh(token);
+  }
+
+  private onStorage(event: StorageEvent): void {
+    // A null key means the whole storage was cleared
+    if (event.key !== this.ACCESS_TOKEN && event.key !== null) return;
+
+    const token = this.getToken();
+    if (token) {
+      this.useToken(token);
+    } else if (this.isAuthenticated()) {
+      this.clearSession();
+    }
   }
 
   getToken(): string | null {
@@ -47,14 +95,82 @@ export class AuthService {
       : null;
   }
 
+  getRefreshToken(): string | null {
+    return isPlatformBrowser(this.platformId)
+      ? localStorage.getItem(this.REFRESH_TOKEN)
+      : null;
+  }
+
+  // Exchange the refresh token for a new access/refresh pair
+  refreshAccessToken(): Observable<string> {
+    const refreshToken = this.getRefreshToken();
+    if (!refreshToken) {
+      return throwError(() => new Error('No refresh token'));
+    }
+    if (!this.refreshInFlight) {
+      this.refreshInFlight = defer(() => this.withRefreshLock(() => this.refreshOnce(refreshToken))).pipe(
+        finalize(() => (this.refreshInFlight = null)),
+        shareReplay(1)
+      );
+    }
+    return this.refreshInFlight;
+  }
+
+  // Runs holding REFRESH_LOCK. A tab that waited for the lock finds the
+  // token already rotated by another tab and takes the new pair as is,
+  // since spending the old one again would be refused as a replay.
+  private refreshOnce(refreshToken: string): Promise<string> {
+    const current = this.getRefreshToken();
+    const token = this.getToken();
+    if (!current) {
+      return Promise.reject(new Error('No refresh token'));
+    }
+    if (current !== refreshToken && token) {
+      this.useToken(token);
+      return Promise.resolve(token);
+    }
+    return firstValueFrom(
+      this.http.post<TokenResponse>(this.refreshUrl, { refresh_token: current }).pipe(
+        tap((response) => this.setToken(response.access_token, response.refresh_token)),
+        map((response) => response.access_token)
+      )
+    );
+  }
+
+  private withRefreshLock<T>(refresh: () => Promise<T>): Promise<T> {
+    // Without Web Locks tabs may still race; the loser is logged out
+    if (!('locks' in navigator)) return refresh();
+    return navigator.locks.request(REFRESH_LOCK, refresh);
+  }
+
+  private scheduleRefresh(token: string): void {
+    if (this.refreshTimer) {
+      clearTimeout(this.refreshTimer);
+      this.refreshTimer = null;
+    }
+    const exp = this.readPayload(token)?.exp;
+    if (!exp || !this.getRefreshToken()) return;
+
+    const delay = Math.max(exp * 1000 - Date.now() - REFRESH_MARGIN_MS, 0);
+    this.refreshTimer = setTimeout(() => {
+      this.refreshAccessToken().subscribe({
+        error: () => this.logout(),
+      });
+    }, delay);
+  }
+
+  private readPayload(token: string): TokenPayload | null {
+    // JWT format: header.payload.signature
+    const parts = token.split('.');
+    if (parts.length !== 3) return null;
+    return JSON.parse(atob(parts[1].replace(/-/g, '+').replace(/_/g, '/'))) as TokenPayload;
+  }
+
   private decodeToken(token: string): void {
     try {
-      // JWT format: header.payload.signature
-      const parts = token.split('.');
-      if (parts.length !== 3) return;
-
       // Decode the payload (second part)
-      const decoded = JSON.parse(atob(parts[1])) as TokenPayload;
+      const decoded = this.readPayload(token);
+      if (!decoded) return;
       console.log('Decoded JWT payload:', decoded);
       this.userRole.set(decoded.role);
       this.userId.set(decoded.id);
@@ -77,7 +193,28 @@ export class AuthService {
   logout() {
     if (!isPlatformBrowser(this.platformId)) return;
 
+    // Revoke both tokens server side; the interceptor skips /auth/ URLs
+    const token = this.getToken();
+    const refreshToken = this.getRefreshToken();
+    if (token && refreshToken) {
+      this.http.post(this.logoutUrl, { refresh_token: refreshToken }, {
+        headers: new HttpHeaders({ Authorization: `Bearer ${token}` })
+      }).subscribe({
+        error: (error) => console.error('Error revoking tokens on logout:', error)
+      });
+    }
+
     localStorage.removeItem(this.ACCESS_TOKEN);
+    localStorage.removeItem(this.REFRESH_TOKEN);
+    this.clearSession();
+  }
+
+  // Forget the session in this tab only, once its tokens are gone
+  private clearSession(): void {
+    if (this.refreshTimer) {
+      clearTimeout(this.refreshTimer);
+      this.refreshTimer = null;
+    }
     this.isAuthenticated.set(false);
     this.userRole.set(null);
     this.userId.set(null);
@@ -85,4 +222,4 @@ export class AuthService {
 
     invoke('clear_auth_token');
   }
-}
\ No newline at end of file
+}
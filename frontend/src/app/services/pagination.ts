@@ -0,0 +1,24 @@
+import { HttpClient, HttpParams } from '@angular/common/http';
+import { EMPTY, Observable } from 'rxjs';
+import { expand, map, reduce } from 'rxjs/operators';
+
+// Set by the backend list endpoints while more rows follow
+const NEXT_CURSOR_HEADER = 'X-Next-Cursor';
+
+// GET every page of a paginated list endpoint, following X-Next-Cursor
+// until the last page, and emit all the rows once
+export function getAllPages<T>(http: HttpClient, url: string): Observable<T[]> {
+  const page = (cursor: string | null) => http.get<T[]>(url, {
+    observe: 'response',
+    params: cursor ? new HttpParams().set('cursor', cursor) : undefined
+  });
+
+  return page(null).pipe(
+    expand((res) => {
+      const cursor = res.headers.get(NEXT_CURSOR_HEADER);
+      return cursor ? page(cursor) : EMPTY;
+    }),
+    map((res) => res.body ?? []),
+    reduce((rows, pageRows) => rows.concat(pageRows), [] as T[])
+  );
+}
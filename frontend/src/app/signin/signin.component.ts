@@ -61,7 +61,7 @@ onSubmit() {
       const token = response.access_token;
        if(token){
 
-        this.authService.setToken(token);
+        this.authService.setToken(token, response.refresh_token);
         console.log("Token saved", token)
         this.openPopup(response.message);
 